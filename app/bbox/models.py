@@ -3,6 +3,7 @@ from sqlalchemy import orm
 
 
 from database.core import Base
+from app.image.models import Image
 
 
 class BBox(Base):
@@ -13,12 +14,20 @@ class BBox(Base):
     ry1 = sa.Column(sa.REAL, nullable=False, comment='Relative y-coordinate of topleft point')
     rx2 = sa.Column(sa.REAL, nullable=False, comment='Relative x-coordinate of bottomright point')
     ry2 = sa.Column(sa.REAL, nullable=False, comment='Relative y-coordinate of bottomright point')
+    version = sa.Column(sa.Integer, nullable=False, default=1, server_default='1',
+                        comment='Incremented on every update to detect concurrent modifications')
+    model = sa.Column(sa.String(255), nullable=True, comment='Name of the model which predicted the bbox')
+    model_version = sa.Column(sa.String(255), nullable=True, comment='Version of the model which predicted the bbox')
     image = orm.relationship("Image", back_populates="bboxes")
-    label = orm.relationship("Label", back_populates="bbox", uselist=False, cascade="delete", lazy="selectin")
+    label = orm.relationship("Label", back_populates="bbox", uselist=False, cascade="delete",
+                             passive_deletes=True, lazy="selectin")
+
+    # selected by a subquery only where it is undeferred, and it raises if it is accessed without being loaded
+    image_hash = orm.column_property(sa.select(Image.hash).where(Image.id == image_id).correlate_except(Image)
+                                     .scalar_subquery(),
+                                     deferred=True, raiseload=True)
 
     def __repr__(self):
         return f'BBox(id={self.id!r}, image={self.image_id!r} bbox={self.rx1, self.ry1, self.rx2, self.ry2})'
 
-    @property
-    def _columns_exclude_updating(self):
-        return ['id', 'image_id']
+    _columns_exclude_updating = ['id', 'image_id', 'version', 'model', 'model_version']
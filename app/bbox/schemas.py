@@ -19,6 +19,10 @@ class BBoxCreate(BBoxBase):
 class BBoxRead(BBoxBase):
     id: int
     image_id: int
+    image_hash: Optional[str]
+    version: int
+    model: Optional[str]
+    model_version: Optional[str]
     label: Optional[LabelRead]
 
     class Config:
@@ -34,3 +38,4 @@ class BBoxPaginated(BaseModel):
 
 class BBoxUpdate(BBoxBase):
     id: int
+    version: Optional[int]
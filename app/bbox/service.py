@@ -1,20 +1,26 @@
 from typing import List, Optional, Tuple
 
-from sqlalchemy import select, asc, desc, func
+from sqlalchemy import select, asc, desc, func, delete, or_
 from sqlalchemy.sql import selectable
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import selectinload, undefer
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.ext.asyncio import AsyncSession
 
-from database.service import joined_table_names, get_one as _get_one
+from database.service import joined_table_names, get_one as _get_one, update_one as _update_one
 from app.image.models import Image
+from app.image.service import get_hash as get_image_hash
 from app.label.models import Label
 from app.label.schemas import LabelFilter
 from .models import BBox
 from .schemas import BBoxBase, BBoxUpdate
 
 
-async def insert(session: AsyncSession, pairs: List[Tuple[int, BBoxBase]]) -> \
-        List[Optional[BBox]]:
+async def insert(session: AsyncSession, pairs: List[Tuple[int, BBoxBase]],
+                 model: Optional[Tuple[str, str]] = None) -> List[Optional[BBox]]:
+    """
+    :param model: tuple(name, version) of the model which predicted the bboxes
+    """
+    model_name, model_version = model or (None, None)
     result = []
     for image_id, bbox_base in pairs:
         query = select(BBox).where(BBox.image_id == image_id)
@@ -25,7 +31,7 @@ async def insert(session: AsyncSession, pairs: List[Tuple[int, BBoxBase]]) -> \
 
         if db_bbox is None:
             db_bbox = BBox(image_id=image_id, rx1=bbox_base.rx1, ry1=bbox_base.ry1,
-                           rx2=bbox_base.rx2, ry2=bbox_base.ry2)
+                           rx2=bbox_base.rx2, ry2=bbox_base.ry2, model=model_name, model_version=model_version)
             session.add(db_bbox)
             result.append(db_bbox)
         else:
@@ -38,18 +44,51 @@ async def get_one(session: AsyncSession, bbox_id: int, silent: bool = False) ->
     return await _get_one(session, BBox, bbox_id, silent)
 
 
+async def get_many(session: AsyncSession, bbox_ids: List[int]) -> List[BBox]:
+    """
+    :return: bboxes in the order of `bbox_ids`. Ids that do not exist are ignored.
+    """
+    stmt = _stmt_bbox(undefer(BBox.image_hash)).where(BBox.id.in_(bbox_ids))
+    bboxes = {o.id: o for o in await session.scalars(stmt)}
+    return [bboxes[o] for o in bbox_ids if o in bboxes]
+
+
+async def get_reviewed(session: AsyncSession, image_ids: List[int]) -> List[BBox]:
+    return list(await session.scalars(
+        select(BBox).join(Label).where(BBox.image_id.in_(image_ids), Label.reviewed.is_(True))))
+
+
+async def delete_unreviewed(session: AsyncSession, image_ids: List[int], commit: bool = True) -> int:
+    """
+    Delete bboxes of images which are not reviewed, with their labels, in a single statement
+    :return: number of deleted bboxes
+    """
+    unreviewed = select(BBox.id).outerjoin(Label).where(
+        BBox.image_id.in_(image_ids), or_(Label.id.is_(None), Label.reviewed.is_(False)))
+    r = await session.execute(delete(BBox).where(BBox.id.in_(unreviewed)).execution_options(synchronize_session=False))
+    if commit:
+        await session.commit()
+    return r.rowcount
+
+
+async def count(session: AsyncSession, file_id: int) -> int:
+    return await session.scalar(select(func.count(BBox.id)).join(Image).where(Image.file_id == file_id))
+
+
 async def update(session: AsyncSession, bbox: BBoxUpdate) -> BBox:
-    db_bbox = await get_one(session, bbox.id)
-    db_bbox.update(**bbox.dict(exclude_unset=True))
-    session.add(db_bbox)
-    await session.commit()
+    db_bbox = await _update_one(session, BBox, bbox.id, bbox.dict(exclude_unset=True), version=bbox.version)
+    # hashes of images are cached, so it usually costs no query
+    set_committed_value(db_bbox, 'image_hash', await get_image_hash(session, db_bbox.image_id))
     return db_bbox
 
 
 async def get_all(session: AsyncSession, image_id: int = None, file_id: int = None,
                   label_filter: LabelFilter = None,
                   label_sort: Optional[List[dict]] = None) -> List[BBox]:
-    stmt = _stmt_bbox()
+    """
+    :return: bboxes with their images loaded
+    """
+    stmt = _stmt_bbox(selectinload(BBox.image))
     stmt = _stmt_image_id(stmt, image_id)
     stmt = _stmt_file_id(stmt, file_id)
     stmt = _stmt_label_filter(stmt, label_filter)
@@ -62,7 +101,7 @@ async def get_all_paginated(session: AsyncSession, image_id: int = None, file_id
                             label_filter: LabelFilter = None,
                             label_sort: Optional[List[dict]] = None,
                             page: int = 1, items_per_page: int = -1) -> dict:
-    stmt = _stmt_bbox()
+    stmt = _stmt_bbox(undefer(BBox.image_hash))
     stmt = _stmt_image_id(stmt, image_id)
     stmt = _stmt_file_id(stmt, file_id)
     stmt = _stmt_label_filter(stmt, label_filter)
@@ -81,8 +120,8 @@ async def get_all_paginated(session: AsyncSession, image_id: int = None, file_id
     }
 
 
-def _stmt_bbox():
-    return select(BBox).options(selectinload(BBox.image)).execution_options(populate_existing=True)
+def _stmt_bbox(*options):
+    return select(BBox).options(*options).execution_options(populate_existing=True)
 
 
 def _stmt_image_id(stmt: selectable, image_id: Optional[int] = None):
@@ -0,0 +1,14 @@
+from .schemas import BBoxBase
+
+
+def iou(a: BBoxBase, b: BBoxBase) -> float:
+    """
+    Intersection over union of two bboxes in relative coordinates
+    """
+    w = min(a.rx2, b.rx2) - max(a.rx1, b.rx1)
+    h = min(a.ry2, b.ry2) - max(a.ry1, b.ry1)
+    if w <= 0 or h <= 0:
+        return 0.0
+    intersection = w * h
+    union = (a.rx2 - a.rx1) * (a.ry2 - a.ry1) + (b.rx2 - b.rx1) * (b.ry2 - b.ry1) - intersection
+    return intersection / union if union > 0 else 0.0
@@ -1,13 +1,16 @@
 from typing import List, Optional
 
-from fastapi import APIRouter, Depends
+from fastapi import APIRouter, Depends, Request, Query
 
 from common.exceptions import ParameterValueError
 from database.core import get_session
 from app.label.schemas import LabelFilter
 from app.label.utils import verify_label_filter, verify_label_sort
+from app.image.crop import crop_response, crops_response, MAX_CROPS_PER_REQUEST
+from app.image.responses import REVALIDATE
+from app.image.service import get_hash as get_image_hash
 from .schemas import BBoxPaginated, BBoxRead, BBoxUpdate
-from .service import get_all_paginated, update
+from .service import get_all_paginated, get_many, get_one, update
 
 
 router = APIRouter()
@@ -27,9 +30,52 @@ async def get_bboxes(image_id: Optional[int] = None, file_id: Optional[int] = No
     return BBoxPaginated.parse_obj(bboxes)
 
 
+@router.get('/crops')
+async def get_bbox_crops(request: Request, ids: Optional[List[int]] = Query(None),
+                         image_id: Optional[int] = None, file_id: Optional[int] = None,
+                         label_filter: Optional[LabelFilter] = Depends(verify_label_filter),
+                         label_sort: Optional[List[dict]] = Depends(verify_label_sort),
+                         page: int = 1, items_per_page: int = MAX_CROPS_PER_REQUEST,
+                         size: int = 256, format: str = 'jpeg',
+                         session=Depends(get_session)):
+    """
+    Get regions of many bboxes in a single multipart/form-data response to fill a page of a grid at once.
+    Each part is named by the id of its bbox.
+    Bboxes are given by `ids`, or otherwise by the same filter and pagination as `GET /bboxes`.
+    Pages have at most `MAX_CROPS_PER_REQUEST` bboxes, which is also the page size of all bboxes(-1).
+    """
+    if ids:
+        if len(ids) > MAX_CROPS_PER_REQUEST:
+            raise ParameterValueError(key='number of ids', value=len(ids), should=f'at most {MAX_CROPS_PER_REQUEST}')
+        bboxes = await get_many(session, ids)
+    else:
+        if items_per_page < 1 or items_per_page > MAX_CROPS_PER_REQUEST:
+            items_per_page = MAX_CROPS_PER_REQUEST
+        bboxes = (await get_all_paginated(
+            session, image_id=image_id, file_id=file_id,
+            label_filter=label_filter, label_sort=label_sort,
+            page=page, items_per_page=items_per_page
+        ))['items']
+    return await crops_response(request, [(str(o.id), o.image_hash, (o.rx1, o.ry1, o.rx2, o.ry2)) for o in bboxes],
+                                size, format, cache_control=REVALIDATE)
+
+
 @router.put('/{bbox_id}', response_model=BBoxRead)
 async def update_bbox(bbox_id: int, bbox: BBoxUpdate, session=Depends(get_session)):
     if bbox_id != bbox.id:
         raise ParameterValueError(key='id', value=bbox.id, should=bbox_id)
     bbox = await update(session, bbox)
     return BBoxRead.from_orm(bbox)
+
+
+@router.get('/{bbox_id}/crop')
+async def get_bbox_crop(request: Request, bbox_id: int, size: int = 256, format: str = 'jpeg',
+                        session=Depends(get_session)):
+    """
+    Get the region of a bbox, shrunk to fit in `size` x `size`.
+    Coordinates of a bbox can be updated, so clients should revalidate the cached crop.
+    """
+    db_bbox = await get_one(session, bbox_id)
+    image_hash = await get_image_hash(session, db_bbox.image_id)
+    return await crop_response(request, image_hash, (db_bbox.rx1, db_bbox.ry1, db_bbox.rx2, db_bbox.ry2),
+                               size, format, cache_control=REVALIDATE)
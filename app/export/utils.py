@@ -2,11 +2,12 @@ import os
 import aiofiles
 import pickle
 import yaml
-from typing import List, Optional
+from typing import List, Optional, Set
 
 from config import CONFIG
 from common.exceptions import ParameterError
 
+from app.image.storage import IMAGE_STORAGE, read_location
 from app.image.utils import get_image_file_path
 from app.bbox.models import BBox
 from app.label.utils import label_types, label_names_by_type, translate
@@ -16,6 +17,19 @@ def get_export_dir():
     return os.path.join(CONFIG['path']['data'], 'exports')
 
 
+def hashes_referenced_by_exports() -> Set[str]:
+    """
+    :return: hashes of image files that symbolic links in export directory point to
+    """
+    hashes = set()
+    for root, _, filenames in os.walk(get_export_dir()):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            if os.path.islink(path):
+                hashes.add(os.path.splitext(os.path.basename(os.readlink(path)))[0])
+    return hashes
+
+
 def group_bboxes_by_image(bboxes: List[BBox]) -> List[dict]:
     images = {}
     for bbox in bboxes:
@@ -53,11 +67,16 @@ async def export_to_yolo(dirname: str, bboxes: List[BBox]) -> Optional[str]:
         labels = []
         for i in idx_range[usage]:
             image = images[i]['image']
-            origin_image_path = get_image_file_path(image.hash)
-            rel_origin_image_path = get_image_file_path(image.hash, return_relative=True)
+            origin_image_location = IMAGE_STORAGE.locate(image.hash)
+            rel_origin_image_path = get_image_file_path(image.hash, not_exist_ok=True, return_relative=True)
             target_image_path = os.path.join(image_dir, rel_origin_image_path)
             os.makedirs(os.path.dirname(target_image_path), exist_ok=True)
-            os.symlink(origin_image_path, target_image_path)
+            if isinstance(origin_image_location, str):
+                os.symlink(origin_image_location, target_image_path)
+            else:
+                # images packed in segment files can't be linked
+                async with aiofiles.open(target_image_path, 'wb') as f:
+                    await f.write(read_location(origin_image_location))
 
             target_bbox_path = os.path.join(bbox_dir, rel_origin_image_path).replace('.jpg', '.txt')
             os.makedirs(os.path.dirname(target_bbox_path), exist_ok=True)
@@ -20,12 +20,18 @@ class File(Base):
                          comment='Number of bboxes extracted by the inference model from total images')
     cnt_download_failure = sa.Column(sa.Integer, nullable=True)
     cnt_duplicated_image = sa.Column(sa.Integer, nullable=True)
+    cnt_near_duplicated_image = sa.Column(sa.Integer, nullable=True,
+                                          comment='Number of images similar to existing images by perceptual hash')
+    cnt_cached_prediction = sa.Column(sa.Integer, nullable=True,
+                                      comment='Number of images whose predictions were found in the prediction cache')
+    cnt_inference_failure = sa.Column(sa.Integer, nullable=True,
+                                      comment='Number of images which failed to be inferred')
     error = sa.Column(sa.Text, nullable=True, comment='Why failed to read the file')
-    images = orm.relationship("Image", back_populates="file", cascade="delete")
+    deleted_at = sa.Column(sa.DateTime, nullable=True,
+                           comment='When deletion was requested. Rows are purged in the background')
+    images = orm.relationship("Image", back_populates="file", cascade="delete", passive_deletes=True)
 
     def __repr__(self):
         return f'File(id={self.id!r}, name={self.name!r})'
 
-    @property
-    def _columns_exclude_updating(self):
-        return ['id', 'created_at', 'name', 'size']
+    _columns_exclude_updating = ['id', 'created_at', 'name', 'size']
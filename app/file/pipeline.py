@@ -0,0 +1,227 @@
+import asyncio
+import logging
+from collections import Counter
+from contextlib import aclosing
+from typing import List, Tuple
+
+import aiohttp
+
+from config import CONFIG
+from common.aiopool import as_completed_map
+from database.core import get_session
+from app.image.schemas import ImageRead
+from app.image.service import insert as insert_images, mark_failed
+from app.image.storage import IMAGE_STORAGE
+from app.image.utils import unpin_image_hashes
+from app.model_inference.cache import PREDICTION_CACHE
+from app.model_inference.service import create_inference_client, inference_error, persist as persist_predictions
+from app.model_serving.state import get_served_model
+
+from .progress import PROGRESS
+from .schemas import FileRead, FileUpdate
+from .service import update
+from .utils import download_image
+
+DOWNLOAD_WORKERS = 10
+DEFAULT_QUEUE_SIZE = 64
+INSERT_BATCH_SIZE = 32
+PERSIST_BATCH_SIZE = 256
+# put by a stage to tell the next stage that there are no more items
+_END = None
+
+
+def queue_size() -> int:
+    return int((CONFIG.get('pipeline') or {}).get('queue_size') or DEFAULT_QUEUE_SIZE)
+
+
+async def _take(queue: asyncio.Queue, max_items: int) -> Tuple[list, bool]:
+    """
+    Wait for an item and take more of them as long as they are ready, so that a busy stage works in batches
+    :return: tuple(items, whether the previous stage has finished)
+    """
+    items = [await queue.get()]
+    while len(items) < max_items and not queue.empty() and items[-1] is not _END:
+        items.append(queue.get_nowait())
+    if items[-1] is _END:
+        return items[:-1], True
+    return items, False
+
+
+class FilePipeline:
+    """
+    Download, insert, infer and persist images of a file in stages running at the same time.
+    Each image moves to the next stage as soon as it is ready, and bounded queues between stages
+    make a fast stage wait for a slow one instead of piling images up in memory.
+    Counts of the file are updated once images are inserted, and `cnt_bbox` when all stages are done.
+    Images are marked as inferred when their predictions are saved, so `model_inference.service.resume`
+    infers only the rest of them if the server stops in the middle.
+    An image which fails to be inferred doesn't stop the others. It is marked with the reason when all stages are done.
+    Images passing each stage are counted in memory by `progress` for GET /files/progress.
+    """
+    def __init__(self, file: FileRead, urls: List[str]):
+        self.file = file
+        self._urls = urls
+        self._downloaded = asyncio.Queue(maxsize=queue_size())
+        self._inserted = asyncio.Queue(maxsize=queue_size())
+        self._inferred = asyncio.Queue(maxsize=queue_size())
+        self._cnt_downloaded = 0
+        self._cnt_bbox = 0
+        self._inference_failed = False
+        # reasons why images failed to be inferred by image id
+        self._failures = {}
+        self.progress = PROGRESS.start(file.id, total=len(urls))
+
+    async def run(self):
+        stages = [asyncio.ensure_future(o) for o in
+                  (self._download(), self._insert(), self._infer(), self._persist())]
+        try:
+            await asyncio.gather(*stages)
+        except BaseException:
+            for stage in stages:
+                stage.cancel()
+            # gather is done as soon as a stage is cancelled, so wait for the others to clean up
+            await asyncio.gather(*stages, return_exceptions=True)
+            # images downloaded but not inserted yet would stay pinned, and never be collected
+            downloaded = []
+            while not self._downloaded.empty():
+                downloaded.append(self._downloaded.get_nowait())
+            unpin_image_hashes([o.hash for o in downloaded if o is not _END])
+            PROGRESS.finish(self.file.id, error='Cancelled')
+            raise
+        PROGRESS.finish(self.file.id, error=self.file.error)
+        if not self._inference_failed:
+            self.file.cnt_bbox = self._cnt_bbox
+        try:
+            await self._update_file()
+        except Exception as e:
+            logging.critical(f'Failed to update cnt_bbox of file "{self.file.name}". reason: {e}')
+
+    async def _update_file(self):
+        async for session in get_session():
+            await update(session, FileUpdate(**self.file.dict()))
+
+    async def _download(self):
+        # downloaded images are pinned until they are inserted,
+        # so ones which are not passed to the next stage yet are unpinned if the pipeline is cancelled
+        unconsumed = Counter()
+        async with aiohttp.ClientSession() as http:
+            async def download(url):
+                try:
+                    ok, image = await download_image(http, url)
+                except Exception as e:
+                    return False, f'url: {url}. reason: {e}'
+                if ok:
+                    unconsumed[image.hash] += 1
+                return ok, image
+
+            try:
+                # closed explicitly, so that its workers stop downloading as soon as the pipeline is cancelled
+                async with aclosing(as_completed_map(download, self._urls, tasks=DOWNLOAD_WORKERS)) as results:
+                    async for _, (ok, image) in results:
+                        if ok:
+                            self._cnt_downloaded += 1
+                            self.progress.add('downloaded')
+                            await self._downloaded.put(image)
+                            unconsumed[image.hash] -= 1
+                        else:
+                            self.progress.skip()
+                            logging.debug(f'Failed to download an image of file "{self.file.name}". {image}')
+            except asyncio.CancelledError:
+                unpin_image_hashes(unconsumed.elements())
+                raise
+        await self._downloaded.put(_END)
+
+    async def _insert(self):
+        file = self.file
+        file.cnt_image, file.cnt_near_duplicated_image = 0, 0
+        cnt_skipped_near_duplicate = 0
+        async for session in get_session():
+            end = False
+            while not end:
+                images, end = await _take(self._downloaded, INSERT_BATCH_SIZE)
+                if not images:
+                    continue
+                try:
+                    db_images, matches = await insert_images(session=session, images=images, file_id=file.id)
+                except Exception as e:
+                    await session.rollback()
+                    file.error = 'Failed to insert images'
+                    logging.critical(f'Failed to insert images in file "{file.name}" to DB. reason: {e}')
+                    self.progress.skip(len(images))
+                    continue
+                finally:
+                    unpin_image_hashes([o.hash for o in images])
+
+                file.cnt_image += len(db_images)
+                self.progress.add('inserted', len(db_images))
+                # duplicates and skipped near-duplicates
+                self.progress.skip(len(images) - len(db_images))
+                file.cnt_near_duplicated_image += len(matches)
+                cnt_skipped_near_duplicate += len(matches) - sum(o.near_duplicate_of is not None for o in db_images)
+                for db_image in db_images:
+                    image = ImageRead.from_orm(db_image)
+                    await self._inserted.put((image, IMAGE_STORAGE.locate(image.hash)))
+        await self._inserted.put(_END)
+
+        file.cnt_download_failure = file.cnt_url - self._cnt_downloaded
+        # skipped near-duplicates are only counted as near-duplicates
+        file.cnt_duplicated_image = self._cnt_downloaded - file.cnt_image - cnt_skipped_near_duplicate
+        try:
+            await self._update_file()
+        except Exception as e:
+            logging.critical(f'Failed to update counts of images of file "{file.name}". reason: {e}')
+
+    async def _infer(self):
+        exhausted = False
+
+        async def inserted_images():
+            nonlocal exhausted
+            while (item := await self._inserted.get()) is not _END:
+                yield item
+            exhausted = True
+
+        client = None
+        try:
+            client = create_inference_client(cache=PREDICTION_CACHE)
+            async for (image, _), predictions in client.infer_stream(inserted_images()):
+                self.progress.add('inferred')
+                await self._inferred.put((image.id, predictions))
+        except Exception as e:
+            self._inference_failed = True
+            self.file.cnt_bbox = -1
+            self.file.error = inference_error(e)
+            logging.critical(f'Failed to get inference result of file "{self.file.name}". reason: {e}')
+            # keep taking images so that the others are still inserted
+            while not exhausted and await self._inserted.get() is not _END:
+                self.progress.skip()
+        if client is not None:
+            self.file.cnt_cached_prediction = (self.file.cnt_cached_prediction or 0) + client.cache_hits
+            self._failures = client.take_failures()
+            self.file.cnt_inference_failure = len(self._failures)
+            self.progress.skip(len(self._failures))
+        await self._inferred.put(_END)
+
+    async def _persist(self):
+        model = get_served_model()
+        async for session in get_session():
+            end = False
+            while not end:
+                items, end = await _take(self._inferred, PERSIST_BATCH_SIZE)
+                if not items:
+                    continue
+                result = [o for _, predictions in items for o in predictions]
+                try:
+                    self._cnt_bbox += await persist_predictions(session, result, image_ids=[o[0] for o in items],
+                                                              model=model)
+                except Exception as e:
+                    await session.rollback()
+                    self.file.error = 'Failed to insert bboxes'
+                    logging.critical(f'Failed to insert bboxes of file "{self.file.name}". reason: {e}')
+                    self.progress.skip(len(items))
+                    continue
+                self.progress.add('persisted', len(items))
+            try:
+                await mark_failed(session, self._failures)
+            except Exception as e:
+                await session.rollback()
+                logging.critical(f'Failed to mark images of file "{self.file.name}" failed to be inferred. reason: {e}')
@@ -0,0 +1,163 @@
+import asyncio
+import json
+from collections import deque
+from datetime import datetime
+from time import monotonic
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from config import CONFIG
+
+STAGES = ('downloaded', 'inserted', 'inferred', 'persisted')
+DEFAULT_INTERVAL = 1.0
+DEFAULT_WINDOW = 10.0
+# finished files are kept this number of seconds so that clients see how they ended
+FINISHED_RETENTION = 60.0
+# seconds between comments sent to keep an idle event stream open through proxies
+KEEPALIVE_INTERVAL = 15.0
+
+
+def progress_interval() -> float:
+    """
+    Seconds between samples of counters and between events of the progress stream
+    """
+    return float((CONFIG.get('pipeline') or {}).get('progress_interval') or DEFAULT_INTERVAL)
+
+
+def throughput_window() -> float:
+    """
+    Seconds of the latest samples which throughput is measured over
+    """
+    return float((CONFIG.get('pipeline') or {}).get('throughput_window') or DEFAULT_WINDOW)
+
+
+class FileProgress:
+    """
+    Counters of images of a file which passed each stage of processing.
+    They are only kept in memory and incremented by a batch of images at a time, so tracking them costs no DB writes.
+    Counters are sampled at most once per `progress_interval` to measure throughput over a rolling window.
+    """
+    def __init__(self, file_id: int, total: Optional[int] = None):
+        """
+        :param total: number of images expected to enter the first stage, if it is known
+        """
+        self.file_id = file_id
+        self.total = total
+        self.counts = dict.fromkeys(STAGES, 0)
+        # images which never reach the last stage, e.g. failed downloads and duplicates
+        self.skipped = 0
+        self.error = None
+        self.started_at = datetime.utcnow()
+        self.finished_at = None
+        self._interval = progress_interval()
+        self._window = throughput_window()
+        self._samples = deque([(monotonic(), tuple(self.counts.values()))])
+
+    def add(self, stage: str, n: int = 1):
+        self.counts[stage] += n
+        self._sample()
+
+    def skip(self, n: int = 1):
+        self.skipped += n
+        self._sample()
+
+    def _sample(self, force: bool = False):
+        now = monotonic()
+        if not force and now - self._samples[-1][0] < self._interval:
+            return
+        self._samples.append((now, tuple(self.counts.values())))
+        # keep the last sample older than the window as the start of the window
+        while len(self._samples) > 2 and self._samples[1][0] <= now - self._window:
+            self._samples.popleft()
+
+    @property
+    def finished(self) -> bool:
+        return self.finished_at is not None
+
+    def throughput(self) -> Dict[str, float]:
+        """
+        :return: images per second of each stage over the rolling window
+        """
+        self._sample()
+        now = monotonic()
+        first, first_counts = self._samples[0]
+        if self.finished or now - first <= 0:
+            return dict.fromkeys(STAGES, 0.0)
+        return {stage: (self.counts[stage] - a) / (now - first) for stage, a in zip(STAGES, first_counts)}
+
+    def eta(self, throughput: Optional[Dict[str, float]] = None) -> Optional[float]:
+        """
+        :return: seconds until the rest of images are persisted at the current throughput, if it can be estimated
+        """
+        throughput = throughput or self.throughput()
+        if self.total is None or self.finished or throughput['persisted'] <= 0:
+            return None
+        return max(0, self.total - self.skipped - self.counts['persisted']) / throughput['persisted']
+
+    def finish(self, error: Optional[str] = None):
+        self.error = error
+        self.finished_at = datetime.utcnow()
+        self._sample(force=True)
+
+    def dict(self) -> dict:
+        throughput = self.throughput()
+        return {'file_id': self.file_id, 'total': self.total, **self.counts, 'skipped': self.skipped,
+                'throughput': throughput, 'eta': self.eta(throughput), 'started_at': self.started_at,
+                'finished_at': self.finished_at, 'error': self.error}
+
+
+class ProgressRegistry:
+    """
+    Progress of files being processed in this process, and of files finished within `FINISHED_RETENTION` seconds
+    """
+    def __init__(self):
+        self._files: Dict[int, FileProgress] = {}
+
+    def start(self, file_id: int, total: Optional[int] = None) -> FileProgress:
+        self._files[file_id] = FileProgress(file_id, total)
+        return self._files[file_id]
+
+    def finish(self, file_id: int, error: Optional[str] = None):
+        if file_id in self._files:
+            self._files[file_id].finish(error)
+
+    def _expire(self):
+        expired_before = datetime.utcnow().timestamp() - FINISHED_RETENTION
+        for file_id in [k for k, v in self._files.items()
+                        if v.finished and v.finished_at.timestamp() < expired_before]:
+            del self._files[file_id]
+
+    def get(self, file_id: int) -> Optional[FileProgress]:
+        self._expire()
+        return self._files.get(file_id)
+
+    def get_all(self) -> List[FileProgress]:
+        self._expire()
+        return list(self._files.values())
+
+    def clear(self):
+        self._files.clear()
+
+
+PROGRESS = ProgressRegistry()
+
+
+async def progress_events(is_disconnected: Callable[[], Awaitable[bool]]) -> AsyncIterator[str]:
+    """
+    Server-Sent Events of progress of files. Each `progress` event has a list of progress of files which changed
+    since the previous event, and it is sent at most once per `progress_interval`.
+    """
+    sent = {}
+    idle = 0.0
+    interval = progress_interval()
+    while not await is_disconnected():
+        current = {o.file_id: o.dict() for o in PROGRESS.get_all()}
+        changed = [v for k, v in current.items() if sent.get(k) != v]
+        sent = current
+        if changed:
+            idle = 0.0
+            yield f'event: progress\ndata: {json.dumps(changed, default=datetime.isoformat)}\n\n'
+        elif idle >= KEEPALIVE_INTERVAL:
+            idle = 0.0
+            yield ': keep-alive\n\n'
+        await asyncio.sleep(interval)
+        idle += interval
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Dict, Optional
 from datetime import datetime
 from pydantic import BaseModel
 
@@ -20,6 +20,9 @@ class FileRead(FileBase):
     cnt_bbox: Optional[int]
     cnt_download_failure: Optional[int]
     cnt_duplicated_image: Optional[int]
+    cnt_near_duplicated_image: Optional[int]
+    cnt_cached_prediction: Optional[int]
+    cnt_inference_failure: Optional[int]
     error: Optional[str]
 
     class Config:
@@ -33,4 +36,22 @@ class FileUpdate(BaseModel):
     cnt_bbox: Optional[int]
     cnt_download_failure: Optional[int]
     cnt_duplicated_image: Optional[int]
+    cnt_near_duplicated_image: Optional[int]
+    cnt_cached_prediction: Optional[int]
+    cnt_inference_failure: Optional[int]
+    error: Optional[str]
+
+
+class FileProgressRead(BaseModel):
+    file_id: int
+    total: Optional[int]
+    downloaded: int
+    inserted: int
+    inferred: int
+    persisted: int
+    skipped: int
+    throughput: Dict[str, float]
+    eta: Optional[float]
+    started_at: datetime
+    finished_at: Optional[datetime]
     error: Optional[str]
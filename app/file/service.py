@@ -1,20 +1,34 @@
+from datetime import datetime
 from typing import List, Optional
 
-from sqlalchemy import select
+from sqlalchemy import select, delete as sa_delete
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
 
 from common.exceptions import ParameterNotFoundError, ParameterExistError
+from database.service import update_one
+from app.bbox.models import BBox
+from app.image.models import Image
+from app.label.models import Label
+from app.image.service import forget_hashes
 from .models import File
 from .schemas import FileCreate, FileUpdate
 
+PURGE_CHUNK_SIZE = 1000
+
 
 async def get_all(session: AsyncSession) -> List[File]:
-    return [o for o in (await session.scalars(select(File)))]
+    return [o for o in (await session.scalars(select(File).where(File.deleted_at.is_(None))))]
+
+
+async def get_all_deleted(session: AsyncSession) -> List[File]:
+    return [o for o in (await session.scalars(select(File).where(File.deleted_at.is_not(None))))]
 
 
-async def get_one(session: AsyncSession, file_id: int, silent=False) -> Optional[File]:
+async def get_one(session: AsyncSession, file_id: int, silent=False, include_deleted=False) -> Optional[File]:
     r = await session.get(File, file_id)
+    if r is not None and r.deleted_at is not None and not include_deleted:
+        r = None
     if r is None and not silent:
         raise ParameterNotFoundError(f'File {file_id}')
     return r
@@ -31,14 +45,47 @@ async def insert(session: AsyncSession, file: FileCreate) -> File:
 
 
 async def update(session: AsyncSession, file: FileUpdate) -> File:
-    db_file = await get_one(session, file.id)
-    db_file.update(**file.dict(exclude_unset=True))
-    session.add(db_file)
-    await session.commit()
-    return db_file
+    return await update_one(session, File, file.id, file.dict(exclude_unset=True))
 
 
 async def delete(session: AsyncSession, file_id: int):
-    db_file = await get_one(session, file_id)
+    db_file = await get_one(session, file_id, include_deleted=True)
     await session.delete(db_file)
     await session.commit()
+
+
+async def soft_delete(session: AsyncSession, file_id: int) -> File:
+    """
+    Mark a file as deleted so that it disappears from the api immediately.
+    Its rows are removed later by `purge`
+    """
+    await get_one(session, file_id)
+    return await update_one(session, File, file_id, {'deleted_at': datetime.utcnow()})
+
+
+async def purge(session: AsyncSession, file_id: int, chunk_size: int = PURGE_CHUNK_SIZE) -> int:
+    """
+    Delete the images of a file in chunks, then the file itself.
+    Labels and bboxes of the images are deleted by queries rather than loaded into memory.
+    They are deleted explicitly instead of by ON DELETE CASCADE,
+    since tables created before the constraint had it are never altered.
+    Each chunk is committed separately not to hold a write lock for a long time.
+    :return: number of deleted images
+    """
+    cnt_image = 0
+    while True:
+        image_ids = list(await session.scalars(
+            select(Image.id).where(Image.file_id == file_id).limit(chunk_size)))
+        if not image_ids:
+            break
+        bbox_ids = select(BBox.id).where(BBox.image_id.in_(image_ids))
+        await session.execute(sa_delete(Label).where(Label.bbox_id.in_(bbox_ids)))
+        await session.execute(sa_delete(BBox).where(BBox.image_id.in_(image_ids)))
+        await session.execute(sa_delete(Image).where(Image.id.in_(image_ids)))
+        await session.commit()
+        forget_hashes(image_ids)
+        cnt_image += len(image_ids)
+
+    await session.execute(sa_delete(File).where(File.id == file_id))
+    await session.commit()
+    return cnt_image
@@ -1,5 +1,7 @@
+import asyncio
 import hashlib
 import imghdr
+import logging
 import os
 import io
 from typing import Tuple, Union, List
@@ -15,9 +17,12 @@ from fastapi import UploadFile, HTTPException
 from config import CONFIG
 from common.exceptions import ParameterEmptyError, ParameterExistError, \
     ParameterNotFoundError, ParameterValueError
-from common.aiopool import AioTaskPool
 from app.image.schemas import ImageBase
-from app.image.utils import get_image_file_path
+from app.image.utils import pin_image_hashes, unpin_image_hashes
+from app.image.storage import IMAGE_STORAGE
+from app.image.pyramid import create_variants
+from app.image.phash import compute_dhash
+from app.utils import cpu_pool
 
 from .schemas import FileCreate
 
@@ -103,17 +108,7 @@ async def urls_from_file(name: str, silent: bool = False) -> Tuple[bool, Union[s
             raise e
 
 
-async def download_images(image_urls: List[str]) -> List[ImageBase]:
-    async with aiohttp.ClientSession() as session:
-        async with AioTaskPool(tasks=10) as pool:
-            for url in image_urls:
-                pool.apply(_download_image_task(session, url))
-            images = await pool.wait()
-
-    return [o[1] for o in images if type(o) == tuple and o[0]]
-
-
-async def _download_image_task(session, image_url) -> Tuple[bool, Union[str, ImageBase]]:
+async def download_image(session, image_url) -> Tuple[bool, Union[str, ImageBase]]:
     async with session.get(image_url) as response:
         if response.status != 200:
             return False, f'url: {image_url}. response: {response.status}'
@@ -127,19 +122,25 @@ async def _download_image_task(session, image_url) -> Tuple[bool, Union[str, Ima
         if not verify_image_file(None, image_data):
             return False, f'url: {image_url}. failed to determine image type'
 
+        image_hash = hashlib.sha256(image_data).hexdigest()
+        # unpinned by the caller after the image is inserted to DB
+        pin_image_hashes([image_hash])
         try:
-            image_hash = hashlib.sha256(image_data).hexdigest()
-            image_file = get_image_file_path(image_hash, not_exist_ok=True)
-            image_dir = os.path.dirname(image_file)
-            os.makedirs(image_dir, exist_ok=True)
-            if not os.path.exists(image_file):
-                async with aiofiles.open(image_file, 'wb') as f:
-                    await f.write(image_data)
+            await IMAGE_STORAGE.write(image_hash, image_data)
+            try:
+                await create_variants(image_hash)
+            except Exception as e:
+                logging.warning(f'Failed to create variants of image {image_hash}. reason: {e}')
 
             pil_image = PIL.Image.open(io.BytesIO(image_data))
+            phash = await cpu_pool.run(compute_dhash, image_data)
             return True, ImageBase(hash=image_hash, width=pil_image.width, height=pil_image.height,
-                                   url=image_url)
+                                   url=image_url, phash=phash)
         except Exception as e:
+            unpin_image_hashes([image_hash])
             return False, str(e)
+        except asyncio.CancelledError:
+            unpin_image_hashes([image_hash])
+            raise
 
 
@@ -1,16 +1,20 @@
-import asyncio
 import logging
 from typing import List
-from fastapi import APIRouter, Depends, UploadFile, Response
+from fastapi import APIRouter, Depends, UploadFile, Request, Response
+from fastapi.responses import StreamingResponse
 
-from common.exceptions import ParameterError
+from common.exceptions import ParameterError, ParameterNotFoundError, ParameterConflictError
 from database.core import get_session
-from app.image.service import insert as insert_images
-from app.model_inference.service import infer as infer_images
+from app.image.service import count_uninferred
+from app.model_inference.service import reinfer as reinfer_images, reinfer_failed as reinfer_failed_images
+from app.model_serving.state import get_served_model
+from app.utils import run_in_background
 
-from .schemas import FileRead, FileUpdate
-from .service import insert, get_all, get_one, delete, update
-from .utils import verify_csv_file, save_file, remove_file, urls_from_file, download_images
+from .schemas import FileRead, FileUpdate, FileProgressRead
+from .service import insert, get_all, get_all_deleted, get_one, soft_delete, purge, update
+from .utils import verify_csv_file, save_file, remove_file, urls_from_file
+from .pipeline import FilePipeline
+from .progress import PROGRESS, progress_events
 
 
 router = APIRouter()
@@ -21,7 +25,7 @@ async def create_file(file: UploadFile = Depends(verify_csv_file), session=Depen
     file_info, _ = await save_file(file)
     db_file = await insert(session, file_info)
     if db_file:
-        asyncio.create_task(download_and_infer(db_file))
+        run_in_background(download_and_infer(db_file))
     return db_file
 
 
@@ -30,20 +34,93 @@ async def get_files(session=Depends(get_session)):
     return await get_all(session)
 
 
+@router.get('/progress', response_model=List[FileProgressRead])
+async def get_files_progress():
+    """
+    Progress of files being processed, and of files finished in the last minute
+    """
+    return [o.dict() for o in PROGRESS.get_all()]
+
+
+@router.get('/progress/stream')
+async def stream_files_progress(request: Request):
+    """
+    Server-Sent Events of progress of files, sent when it changes instead of polling GET /files
+    """
+    return StreamingResponse(progress_events(request.is_disconnected), media_type='text/event-stream',
+                             headers={'cache-control': 'no-cache'})
+
+
 @router.get('/{file_id}', response_model=FileRead)
 async def get_file(file_id: int, session=Depends(get_session)):
     return await get_one(session, file_id)
 
 
+@router.get('/{file_id}/progress', response_model=FileProgressRead)
+async def get_file_progress(file_id: int):
+    progress = PROGRESS.get(file_id)
+    if progress is None:
+        raise ParameterNotFoundError(f'Progress of file {file_id}')
+    return progress.dict()
+
+
 @router.delete('/{file_id}')
 async def delete_file(file_id: int, session=Depends(get_session)):
-    db_file = await get_one(session, file_id)
-    if db_file:
-        await delete(session, file_id)
-        await remove_file(db_file.name)
+    db_file = await soft_delete(session, file_id)
+    await remove_file(db_file.name)
+    run_in_background(purge_file(file_id))
     return Response(status_code=204)
 
 
+@router.post('/{file_id}/reinfer')
+async def reinfer_file(file_id: int, session=Depends(get_session)):
+    """
+    Infer images of a file again with the served model in the background.
+    Reviewed bboxes are kept, and images already inferred by the served model are skipped.
+    """
+    db_file = await get_one(session, file_id)
+    if get_served_model() is None:
+        raise ParameterConflictError('Model', 'is not served by the inference server')
+    if db_file.cnt_bbox is None:
+        raise ParameterConflictError(f'File {file_id}', 'is still being processed')
+    run_in_background(reinfer_images(db_file))
+    return Response(status_code=202)
+
+
+@router.post('/{file_id}/reinfer/failed')
+async def reinfer_failed_file(file_id: int, session=Depends(get_session)):
+    """
+    Infer images of a file again which failed to be inferred, in the background.
+    It responds 204 without doing anything if there are no such images.
+    """
+    db_file = await get_one(session, file_id)
+    if db_file.cnt_bbox is None:
+        raise ParameterConflictError(f'File {file_id}', 'is still being processed')
+    if not await count_uninferred(session, file_id):
+        return Response(status_code=204)
+    run_in_background(reinfer_failed_images(db_file))
+    return Response(status_code=202)
+
+
+async def purge_file(file_id: int):
+    async for session in get_session():
+        try:
+            cnt_image = await purge(session, file_id)
+            logging.info(f'Purged file {file_id} with {cnt_image} images')
+        except Exception as e:
+            logging.critical(f'Failed to purge file {file_id}. reason: {e}')
+
+
+async def purge_deleted_files():
+    """
+    Resume purging files that were deleted but not purged before the server stopped
+    """
+    async for session in get_session():
+        file_ids = [o.id for o in await get_all_deleted(session)]
+    for file_id in file_ids:
+        await purge_file(file_id)
+
+
 async def download_and_infer(file: FileRead):
     async for session in get_session():
         status, content = await urls_from_file(file.name, silent=True)
@@ -62,27 +139,4 @@ async def download_and_infer(file: FileRead):
         if not status:
             return
 
-        images = await download_images(content)
-
-        try:
-            db_images = await insert_images(session=session, images=images, file_id=file.id)
-        except ParameterError as e:
-            logging.critical(f'Failed to insert images in file "{file.name}" to DB. reason: {e}')
-            return
-
-        try:
-            file.cnt_download_failure = file.cnt_url - len(images)
-            file.cnt_image = len(db_images)
-            file.cnt_duplicated_image = len(images) - len(db_images)
-            await update(session, FileUpdate(**file.dict()))
-        except ParameterError as e:
-            logging.critical(f'Failed to update values '
-                             f'({file.cnt_download_failure}, {file.cnt_image}, {file.cnt_duplicated_image}) '
-                             f'to (cnt_download_failure, cnt_image, cnt_duplicated_image) columns '
-                             f'of file "{file.name}". reason: {e}')
-            return
-
-        if not db_images:
-            return
-
-    asyncio.create_task(infer_images(file))
+    await FilePipeline(file, content).run()
@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import io
+import os
+from collections import OrderedDict
+from typing import Tuple, Optional, List
+
+import aiofiles
+import PIL.Image
+from fastapi import Request, Response
+
+from config import CONFIG
+from common.exceptions import ParameterValueError
+from app.utils import cpu_pool
+from .responses import IMMUTABLE, make_etag, etag_matches, content_response, multipart_response
+from .storage import IMAGE_STORAGE, Location, open_location
+
+CROP_FORMATS = {'jpeg': ('JPEG', 'image/jpeg'), 'webp': ('WEBP', 'image/webp')}
+MIN_CROP_SIZE = 16
+MAX_CROP_SIZE = 2048
+MAX_CROPS_PER_REQUEST = 200
+
+
+def get_crop_cache_dirpath() -> str:
+    return os.path.join(CONFIG['path']['data'], 'cache', 'crops')
+
+
+def verify_crop_parameters(box: Tuple[float, float, float, float], size: int, fmt: str):
+    rx1, ry1, rx2, ry2 = box
+    if not all(0 <= o <= 1 for o in box) or rx1 >= rx2 or ry1 >= ry2:
+        raise ParameterValueError(key='(rx1, ry1, rx2, ry2)', value=box,
+                                  should='0 <= rx1 < rx2 <= 1 and 0 <= ry1 < ry2 <= 1')
+    if not MIN_CROP_SIZE <= size <= MAX_CROP_SIZE:
+        raise ParameterValueError(key='size', value=size, should=f'between {MIN_CROP_SIZE} and {MAX_CROP_SIZE}')
+    if fmt not in CROP_FORMATS:
+        raise ParameterValueError(key='format', value=fmt, choice=list(CROP_FORMATS.keys()))
+
+
+def render_crop(location: Location, box: Tuple[float, float, float, float], size: int, fmt: str, quality: int = 85) -> bytes:
+    """
+    Crop a region of an image and shrink it to fit in `size` x `size`.
+    It is CPU-bound, so run it in `cpu_pool`.
+    :param box: relative coordinates (rx1, ry1, rx2, ry2) of the region
+    :return: encoded bytes of the cropped image
+    """
+    rx1, ry1, rx2, ry2 = box
+    with open_location(location) as f, PIL.Image.open(f) as im:
+        # let the JPEG decoder scale the image down(by 1/2, 1/4 or 1/8) if the region is much larger than `size`
+        scale = max((rx2 - rx1) * im.width, (ry2 - ry1) * im.height) / size
+        if scale >= 2:
+            im.draft('RGB', (int(im.width / scale), int(im.height / scale)))
+        region = im.crop((round(rx1 * im.width), round(ry1 * im.height),
+                          round(rx2 * im.width), round(ry2 * im.height)))
+        region = region.convert('RGB')
+    region.thumbnail((size, size), PIL.Image.Resampling.LANCZOS)
+
+    buffer = io.BytesIO()
+    region.save(buffer, format=CROP_FORMATS[fmt][0], quality=quality)
+    return buffer.getvalue()
+
+
+async def crop_response(request: Request, image_hash: str, box: Tuple[float, float, float, float],
+                        size: int, fmt: str, cache_control: str = IMMUTABLE) -> Response:
+    verify_crop_parameters(box, size, fmt)
+    etag = make_etag(CROP_CACHE.key(image_hash, box, size, fmt))
+    if etag_matches(request, etag):
+        # no need to render the crop
+        return content_response(request, b'', etag, CROP_FORMATS[fmt][1], cache_control)
+    data = await CROP_CACHE.get(image_hash, box, size, fmt)
+    return content_response(request, data, etag, CROP_FORMATS[fmt][1], cache_control)
+
+
+async def crops_response(request: Request, crops: List[Tuple[str, str, Tuple[float, float, float, float]]],
+                         size: int, fmt: str, cache_control: str = IMMUTABLE) -> Response:
+    """
+    Send many crops in a single multipart/form-data response. Crops are rendered concurrently in `cpu_pool`.
+    :param crops: list of tuple(name of the part, image hash, relative coordinates of the region)
+    """
+    if len(crops) > MAX_CROPS_PER_REQUEST:
+        raise ParameterValueError(key='number of crops', value=len(crops), should=f'at most {MAX_CROPS_PER_REQUEST}')
+    for _, _, box in crops:
+        verify_crop_parameters(box, size, fmt)
+
+    keys = [f'{name}:{CROP_CACHE.key(image_hash, box, size, fmt)}' for name, image_hash, box in crops]
+    etag = make_etag(hashlib.sha1('\n'.join(keys).encode()).hexdigest())
+    if etag_matches(request, etag):
+        return multipart_response(request, [], etag, cache_control)
+
+    data = await asyncio.gather(*(CROP_CACHE.get(image_hash, box, size, fmt) for _, image_hash, box in crops))
+    media_type = CROP_FORMATS[fmt][1]
+    parts = [(name, f'{name}.{fmt}', media_type, o) for (name, _, _), o in zip(crops, data)]
+    return multipart_response(request, parts, etag, cache_control)
+
+
+class CropCache:
+    """
+    Disk cache of rendered crops keyed by (image hash, region, size, format).
+    When the total size exceeds `max_bytes`, the least recently used crops are evicted.
+    """
+    def __init__(self, max_bytes: int, quality: int = 85):
+        self._max_bytes = max_bytes
+        self._quality = quality
+        self._index: Optional[OrderedDict] = None
+        self._total_bytes = 0
+        self._rendering = {}
+
+    @staticmethod
+    def key(image_hash: str, box: Tuple[float, float, float, float], size: int, fmt: str) -> str:
+        return '_'.join([image_hash, *(f'{o:.4f}' for o in box), str(size)]) + f'.{fmt}'
+
+    @staticmethod
+    def path(key: str) -> str:
+        return os.path.join(get_crop_cache_dirpath(), key[:2], key)
+
+    async def get(self, image_hash: str, box: Tuple[float, float, float, float], size: int, fmt: str) -> bytes:
+        self._load_index()
+        key = self.key(image_hash, box, size, fmt)
+        if key in self._index:
+            try:
+                async with aiofiles.open(self.path(key), 'rb') as f:
+                    data = await f.read()
+                self._index.move_to_end(key)
+                os.utime(self.path(key))
+                return data
+            except FileNotFoundError:
+                self._total_bytes -= self._index.pop(key)
+
+        # render the same crop only once even if it is requested concurrently
+        if key not in self._rendering:
+            self._rendering[key] = asyncio.ensure_future(self._render(key, image_hash, box, size, fmt))
+            self._rendering[key].add_done_callback(lambda _: self._rendering.pop(key, None))
+        return await asyncio.shield(self._rendering[key])
+
+    async def _render(self, key, image_hash, box, size, fmt) -> bytes:
+        data = await cpu_pool.run(render_crop, IMAGE_STORAGE.locate(image_hash), box, size, fmt, self._quality)
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        async with aiofiles.open(f'{path}.tmp', 'wb') as f:
+            await f.write(data)
+        os.replace(f'{path}.tmp', path)
+
+        self._index[key] = len(data)
+        self._total_bytes += len(data)
+        self._evict()
+        return data
+
+    def _load_index(self):
+        if self._index is not None:
+            return
+        entries = []
+        cache_dir = get_crop_cache_dirpath()
+        if os.path.exists(cache_dir):
+            for shard in os.listdir(cache_dir):
+                with os.scandir(os.path.join(cache_dir, shard)) as it:
+                    for entry in it:
+                        if not entry.name.endswith('.tmp'):
+                            stat = entry.stat()
+                            entries.append((stat.st_mtime, entry.name, stat.st_size))
+        self._index = OrderedDict((name, size) for _, name, size in sorted(entries))
+        self._total_bytes = sum(self._index.values())
+        self._evict()
+
+    def _evict(self):
+        while self._total_bytes > self._max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._total_bytes -= size
+            try:
+                os.remove(self.path(key))
+            except FileNotFoundError:
+                pass
+
+
+CROP_CACHE = CropCache(max_bytes=int((CONFIG.get('crop') or {}).get('cache_size') or 1024 ** 3),
+                       quality=int((CONFIG.get('crop') or {}).get('quality') or 85))
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import time
+from typing import List, Optional, Set
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import CONFIG
+from common.exceptions import OperationError
+from database.core import get_session
+from app.export.utils import hashes_referenced_by_exports
+from .models import Image
+from .schemas import ImageGCReport, ImageGCStatistics
+from .pyramid import variant_sizes
+from .storage import IMAGE_STORAGE, ImageStorage, parse_key, variant_key
+from .utils import is_image_hash_pinned
+
+
+class ImageGarbageCollector:
+    """
+    Delete images of the content-addressed image storage
+    that are referenced by neither rows of `Image` nor symbolic links of exports.
+    With the packed storage backend, segment files are compacted after each periodic run.
+
+    Image files are written before their rows of `Image` are inserted.
+    To avoid deleting them, files pinned by ingestion(`pin_image_hashes`)
+    and files modified within `min_age` seconds are never deleted.
+    """
+    def __init__(self, config: Optional[dict] = None, storage: Optional[ImageStorage] = None):
+        config = config or {}
+        self._storage = storage or IMAGE_STORAGE
+        self._period = float(config['period']) if config.get('period') else None
+        self._batch_size = int(config.get('batch_size') or 1000)
+        self._batch_interval = float(config.get('batch_interval') or 0)
+        self._min_age = float(config.get('min_age') or 0)
+        self._running = False
+        self._reclaimed_bytes = 0
+        self._deleted_files = 0
+        self._last_report = None
+
+    def statistics(self) -> ImageGCStatistics:
+        return ImageGCStatistics(running=self._running,
+                                 reclaimed_bytes=self._reclaimed_bytes,
+                                 deleted_files=self._deleted_files,
+                                 last_report=self._last_report)
+
+    async def run(self, session: AsyncSession, dry_run: bool = True) -> ImageGCReport:
+        """
+        :param dry_run: If true, report orphaned image files without deleting them
+        """
+        if self._running:
+            raise OperationError('Garbage collection of image files is already running')
+        self._running = True
+        try:
+            report = ImageGCReport(dry_run=dry_run, started_at=time.time())
+            referenced_by_exports = hashes_referenced_by_exports()
+
+            batch = []
+            for key in self._storage.keys():
+                image_hash, size = parse_key(key)
+                if size != 0:
+                    # variants are collected with their original images
+                    continue
+                report.scanned += 1
+                if image_hash not in referenced_by_exports:
+                    batch.append(image_hash)
+                if len(batch) >= self._batch_size:
+                    await self._collect(session, batch, report)
+                    batch = []
+                    await asyncio.sleep(self._batch_interval)
+            if batch:
+                await self._collect(session, batch, report)
+
+            report.finished_at = time.time()
+            if not dry_run:
+                self._reclaimed_bytes += report.reclaimed_bytes
+                self._deleted_files += report.orphans
+            self._last_report = report
+            return report
+        finally:
+            self._running = False
+
+    async def _collect(self, session: AsyncSession, batch: List[str], report: ImageGCReport):
+        referenced = await self._referenced(session, batch)
+        min_mtime = time.time() - self._min_age
+
+        orphans = []
+        for image_hash in batch:
+            if image_hash in referenced:
+                continue
+            stat = self._storage.stat(image_hash)
+            if stat is None:
+                continue
+            if is_image_hash_pinned(image_hash) or stat[1] > min_mtime:
+                report.skipped += 1
+                continue
+            orphans.append((image_hash, stat[0]))
+        if not orphans:
+            return
+
+        # an ingestion reusing an orphaned file may pin it, insert its row and unpin it while the query is awaited,
+        # so orphans are queried again. Nothing is awaited after that until they are deleted
+        referenced = await self._referenced(session, [image_hash for image_hash, _ in orphans])
+        for image_hash, size in orphans:
+            if image_hash in referenced or is_image_hash_pinned(image_hash):
+                report.skipped += 1
+                continue
+            if not report.dry_run:
+                self._storage.delete(image_hash)
+            report.orphans += 1
+            report.reclaimed_bytes += size
+            report.reclaimed_bytes += self._collect_variants(image_hash, report.dry_run)
+
+    @staticmethod
+    async def _referenced(session: AsyncSession, hashes: List[str]) -> Set[str]:
+        return set(await session.scalars(select(Image.hash).where(Image.hash.in_(hashes))))
+
+    def _collect_variants(self, image_hash: str, dry_run: bool) -> int:
+        reclaimed_bytes = 0
+        for size in variant_sizes():
+            key = variant_key(image_hash, size)
+            if dry_run:
+                stat = self._storage.stat(key)
+                reclaimed_bytes += stat[0] if stat else 0
+            else:
+                reclaimed_bytes += self._storage.delete(key)
+        return reclaimed_bytes
+
+    async def run_periodically(self):
+        if self._period is None:
+            return
+        while True:
+            await asyncio.sleep(self._period)
+            try:
+                async for session in get_session():
+                    report = await self.run(session, dry_run=False)
+                logging.info(f'Garbage collection of image files is done. '
+                             f'deleted {report.orphans} files, reclaimed {report.reclaimed_bytes} bytes')
+                compaction = await self._storage.compact()
+                if compaction.compacted_segments:
+                    logging.info(f'Compaction of image storage is done. {compaction}')
+            except Exception as e:
+                logging.critical(f'Failed to collect garbage of image files. reason: {e}')
+
+
+IMAGE_GC = ImageGarbageCollector(CONFIG.get('image_gc'))
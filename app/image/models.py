@@ -7,6 +7,8 @@ from database.core import Base
 
 class Image(Base):
     __tablename__ = 'image'
+    # never reuse ids of deleted images, because clients cache image files by their ids
+    __table_args__ = {'sqlite_autoincrement': True}
     id = sa.Column(sa.Integer, primary_key=True)
     file_id = sa.Column(sa.ForeignKey('file.id', ondelete="CASCADE"))
     hash = sa.Column(sa.String(64), unique=True, nullable=False,
@@ -14,12 +16,21 @@ class Image(Base):
     width = sa.Column(sa.Integer, nullable=False)
     height = sa.Column(sa.Integer, nullable=False)
     url = sa.Column(sa.String(255), nullable=False)
+    phash = sa.Column(sa.BigInteger, nullable=True,
+                      comment='Perceptual hash(dHash) to find near-duplicate images')
+    near_duplicate_of = sa.Column(sa.ForeignKey('image.id', ondelete="SET NULL"), nullable=True,
+                                  comment='Id of an image which this image is a near-duplicate of')
+    inferred_at = sa.Column(sa.DateTime, nullable=True, index=True,
+                            comment='When predictions of the image were saved. Null if it is not inferred yet')
+    inferred_model = sa.Column(sa.String(255), nullable=True, comment='Name of the model which inferred the image')
+    inferred_model_version = sa.Column(sa.String(255), nullable=True,
+                                       comment='Version of the model which inferred the image')
+    inference_error = sa.Column(sa.String(255), nullable=True,
+                                comment='Why the image failed to be inferred. Null unless its last inference failed')
     file = orm.relationship("File", back_populates="images")
-    bboxes = orm.relationship("BBox", back_populates="image", cascade="delete")
+    bboxes = orm.relationship("BBox", back_populates="image", cascade="delete", passive_deletes=True)
 
     def __repr__(self):
         return f'Image(id={self.id!r}, hash={self.hash!r}, width={self.width!r}, height={self.height!r})'
 
-    @property
-    def _columns_exclude_updating(self):
-        return ['id', 'file_id', 'hash', 'width', 'height']
+    _columns_exclude_updating = ['id', 'file_id', 'hash', 'width', 'height', 'phash']
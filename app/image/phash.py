@@ -0,0 +1,125 @@
+import io
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+
+import PIL.Image
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import CONFIG
+from common.exceptions import ParameterValueError
+from .models import Image
+
+DHASH_SIZE = 8
+LOAD_BATCH_SIZE = 10000
+NEAR_DUPLICATE_ACTIONS = ['flag', 'skip']
+_UINT64 = (1 << 64) - 1
+
+
+def compute_dhash(data: bytes) -> int:
+    """
+    64 bit difference hash of an image, which is robust to re-encoding and resizing.
+    Each bit tells whether a pixel is brighter than its right neighbor in a 9x8 grayscale thumbnail.
+    It is CPU-bound, so run it in `cpu_pool`.
+    :return: signed 64 bit integer to be stored in a BIGINT column
+    """
+    with PIL.Image.open(io.BytesIO(data)) as im:
+        im.draft('L', (DHASH_SIZE * 4, DHASH_SIZE * 4))
+        pixels = list(im.convert('L').resize((DHASH_SIZE + 1, DHASH_SIZE), PIL.Image.Resampling.BILINEAR).getdata())
+    dhash = 0
+    for y in range(DHASH_SIZE):
+        for x in range(DHASH_SIZE):
+            row = y * (DHASH_SIZE + 1)
+            dhash = (dhash << 1) | (pixels[row + x] > pixels[row + x + 1])
+    return dhash - (1 << 64) if dhash >= (1 << 63) else dhash
+
+
+def hamming_distance(a: int, b: int) -> int:
+    return bin((a ^ b) & _UINT64).count('1')
+
+
+class NearDuplicateIndex:
+    """
+    In-memory multi-index of perceptual hashes to find images within a Hamming distance.
+
+    Hashes are split into `distance + 1` chunks and each chunk is indexed by its own table.
+    By the pigeonhole principle, a hash within `distance` has at least one chunk equal to the query,
+    so only images sharing a chunk are compared instead of all images.
+    """
+    def __init__(self, distance: int, action: str = 'flag'):
+        if not 0 <= distance < 32:
+            raise ParameterValueError(key='near_duplicate.distance', value=distance, should='between 0 and 31')
+        if action not in NEAR_DUPLICATE_ACTIONS:
+            raise ParameterValueError(key='near_duplicate.action', value=action, choice=NEAR_DUPLICATE_ACTIONS)
+        self.distance = distance
+        self.action = action
+        n_chunks = distance + 1
+        bounds = [64 * i // n_chunks for i in range(n_chunks + 1)]
+        self._chunks = [(lo, (1 << (hi - lo)) - 1) for lo, hi in zip(bounds, bounds[1:])]
+        self._tables: List[Dict[int, List[int]]] = [defaultdict(list) for _ in self._chunks]
+        self._hashes: Dict[int, int] = {}
+
+    def __len__(self):
+        return len(self._hashes)
+
+    def _chunk_values(self, phash: int) -> List[int]:
+        phash &= _UINT64
+        return [(phash >> shift) & mask for shift, mask in self._chunks]
+
+    def add(self, image_id: int, phash: int):
+        if image_id in self._hashes:
+            return
+        self._hashes[image_id] = phash
+        for table, value in zip(self._tables, self._chunk_values(phash)):
+            table[value].append(image_id)
+
+    def remove(self, image_ids: Iterable[int]):
+        for image_id in image_ids:
+            phash = self._hashes.pop(image_id, None)
+            if phash is None:
+                continue
+            for table, value in zip(self._tables, self._chunk_values(phash)):
+                table[value].remove(image_id)
+                if not table[value]:
+                    del table[value]
+
+    def find(self, phash: int) -> Optional[int]:
+        """
+        :return: id of the nearest image within `distance`. None if there is no such image.
+        """
+        nearest = None
+        for table, value in zip(self._tables, self._chunk_values(phash)):
+            for image_id in table.get(value, []):
+                distance = hamming_distance(phash, self._hashes[image_id])
+                if distance <= self.distance and (nearest is None or (distance, image_id) < nearest):
+                    nearest = (distance, image_id)
+        return None if nearest is None else nearest[1]
+
+    async def load(self, session: AsyncSession):
+        """
+        Rebuild the index from all images
+        """
+        self._tables = [defaultdict(list) for _ in self._chunks]
+        self._hashes = {}
+        last_id = 0
+        while True:
+            rows = (await session.execute(
+                select(Image.id, Image.phash).where(Image.id > last_id, Image.phash.is_not(None))
+                .order_by(Image.id).limit(LOAD_BATCH_SIZE))).all()
+            if not rows:
+                break
+            for image_id, phash in rows:
+                self.add(image_id, phash)
+            last_id = rows[-1][0]
+
+
+def create_near_duplicate_index(config: Optional[dict] = None) -> Optional[NearDuplicateIndex]:
+    """
+    :return: None if detection of near-duplicates is disabled
+    """
+    if not config or config.get('distance') in (None, ''):
+        return None
+    return NearDuplicateIndex(int(config['distance']), config.get('action') or 'flag')
+
+
+NEAR_DUPLICATES = create_near_duplicate_index(CONFIG.get('near_duplicate'))
@@ -0,0 +1,178 @@
+import io
+import json
+import logging
+import os
+from typing import List, Optional, Tuple
+
+import PIL.Image
+from sqlalchemy import select
+
+from config import CONFIG
+from database.core import get_session
+from app.utils import cpu_pool
+from .models import Image
+from .storage import IMAGE_STORAGE, Location, variant_key, open_location
+
+BACKFILL_BATCH_SIZE = 100
+
+
+def pyramid_sizes() -> List[int]:
+    """
+    :return: long edge sizes of downscaled variants in ascending order. Empty if the pyramid is disabled
+    """
+    sizes = (CONFIG.get('pyramid') or {}).get('sizes') or []
+    if isinstance(sizes, str):
+        sizes = sizes.split(',')
+    return sorted(int(o) for o in sizes)
+
+
+def inference_input_size() -> Optional[int]:
+    """
+    :return: long edge size which images are downsized to before inference. None if originals are sent
+    """
+    size = (CONFIG.get('inference_server') or {}).get('input_size')
+    return int(size) if size else None
+
+
+def variant_sizes() -> List[int]:
+    """
+    :return: long edge sizes of all variants which may be stored, including downsized inputs of inference
+    """
+    return sorted(set(pyramid_sizes()) | ({inference_input_size()} - {None}))
+
+
+def nearest_image_key(image_hash: str, size: Optional[int] = None) -> str:
+    """
+    :return: key of the smallest variant size whose long edge is at least `size`, whether the variant exists or not.
+             key of the original image if there is no such size or `size` is not given.
+    """
+    if size is not None:
+        for variant_size in pyramid_sizes():
+            if variant_size >= size:
+                return variant_key(image_hash, variant_size)
+    return image_hash
+
+
+def locate_nearest_image(image_hash: str, size: Optional[int] = None) -> Tuple[str, Location]:
+    """
+    :return: tuple(key, location) of the smallest variant whose long edge is at least `size` in `IMAGE_STORAGE`.
+             tuple(key, location) of the original image if the variant doesn't exist or `size` is not given.
+    :raises: `ParameterNotFoundError` if the original image does not exist
+    """
+    key = nearest_image_key(image_hash, size)
+    if key != image_hash:
+        location = IMAGE_STORAGE.locate(key, not_exist_ok=True)
+        if location is not None:
+            return key, location
+    return image_hash, IMAGE_STORAGE.locate(image_hash)
+
+
+def render_variants(location: Location, sizes: List[int], quality: int = 85) -> List[Tuple[int, bytes]]:
+    """
+    Encode downscaled variants of an image. It is CPU-bound, so run it in `cpu_pool`.
+    Variants larger than the original image are not rendered.
+    :param sizes: long edge sizes of variants
+    :return: list of tuple(long edge size, encoded bytes of variant)
+    """
+    result = []
+    with open_location(location) as f, PIL.Image.open(f) as im:
+        long_edge = max(im.size)
+        sizes = [o for o in sizes if o < long_edge]
+        if not sizes:
+            return result
+        # decode just enough pixels for the largest variant
+        largest = max(sizes)
+        im.draft('RGB', (im.width * largest // long_edge, im.height * largest // long_edge))
+        im = im.convert('RGB')
+
+    for size in sorted(sizes, reverse=True):
+        im.thumbnail((size, size), PIL.Image.Resampling.LANCZOS)
+        buffer = io.BytesIO()
+        im.save(buffer, format='JPEG', quality=quality)
+        result.append((size, buffer.getvalue()))
+    return result
+
+
+def read_image_size(location: Location) -> Tuple[int, int]:
+    """
+    :return: tuple(width, height) of an image, which is read from its header without decoding pixels
+    """
+    with open_location(location) as f, PIL.Image.open(f) as im:
+        return im.size
+
+
+async def create_variants(image_hash: str) -> int:
+    """
+    :return: number of written variants
+    """
+    sizes = [o for o in pyramid_sizes() if not IMAGE_STORAGE.exists(variant_key(image_hash, o))]
+    if not sizes:
+        return 0
+    variants = await cpu_pool.run(render_variants, IMAGE_STORAGE.locate(image_hash), sizes)
+    for size, data in variants:
+        await IMAGE_STORAGE.write(variant_key(image_hash, size), data)
+    return len(variants)
+
+
+class PyramidBackfill:
+    """
+    Create variants of images that were inserted before the pyramid was enabled.
+    Progress is saved as the last processed image id in a checkpoint file,
+    so that the job resumes from there after a restart.
+    """
+    def __init__(self, batch_size: int = BACKFILL_BATCH_SIZE):
+        self._batch_size = batch_size
+        self._running = False
+        self._processed = 0
+
+    @staticmethod
+    def checkpoint_path() -> str:
+        return os.path.join(CONFIG['path']['data'], 'pyramid_backfill.json')
+
+    def _load_checkpoint(self) -> Optional[int]:
+        if not os.path.exists(self.checkpoint_path()):
+            return None
+        with open(self.checkpoint_path(), 'r') as f:
+            return json.load(f)['last_image_id']
+
+    def _save_checkpoint(self, last_image_id: int):
+        with open(f'{self.checkpoint_path()}.tmp', 'w') as f:
+            json.dump({'last_image_id': last_image_id}, f)
+        os.replace(f'{self.checkpoint_path()}.tmp', self.checkpoint_path())
+
+    def status(self) -> dict:
+        return {'running': self._running, 'processed': self._processed,
+                'last_image_id': self._load_checkpoint()}
+
+    def pending(self) -> bool:
+        return os.path.exists(self.checkpoint_path())
+
+    async def run(self):
+        if self._running or not pyramid_sizes():
+            return
+        self._running = True
+        self._processed = 0
+        try:
+            last_image_id = self._load_checkpoint() or 0
+            self._save_checkpoint(last_image_id)
+            while True:
+                async for session in get_session():
+                    rows = (await session.execute(
+                        select(Image.id, Image.hash).where(Image.id > last_image_id)
+                        .order_by(Image.id).limit(self._batch_size))).all()
+                if not rows:
+                    break
+                for image_id, image_hash in rows:
+                    try:
+                        await create_variants(image_hash)
+                    except Exception as e:
+                        logging.warning(f'Failed to create variants of image {image_id}. reason: {e}')
+                    self._processed += 1
+                last_image_id = rows[-1][0]
+                self._save_checkpoint(last_image_id)
+            os.remove(self.checkpoint_path())
+        finally:
+            self._running = False
+
+
+PYRAMID_BACKFILL = PyramidBackfill()
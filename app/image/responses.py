@@ -0,0 +1,161 @@
+import os
+import uuid
+from typing import Optional, Tuple, List
+
+import aiofiles
+from fastapi import Request, Response
+from fastapi.responses import FileResponse, StreamingResponse
+
+from common.exceptions import ParameterNotFoundError
+from .storage import Location, read_location
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+CHUNK_SIZE = 64 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def make_etag(*parts) -> str:
+    return '"' + '-'.join(str(o) for o in parts) + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """
+    Weak comparison of `If-None-Match` header as specified in RFC 9110
+    """
+    if_none_match = request.headers.get('if-none-match')
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    candidates = [o.strip() for o in if_none_match.split(',')]
+    return etag in [o[2:] if o.startswith('W/') else o for o in candidates]
+
+
+def parse_range(request: Request, etag: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    :return: None if the whole content should be sent.
+             Otherwise, tuple(first byte position, last byte position) of a single range.
+             Multiple ranges are not supported, so the whole content is sent for them.
+    :raises: `RangeNotSatisfiable` if the range is out of the content
+    """
+    range_header = request.headers.get('range')
+    if not range_header or not range_header.startswith('bytes=') or ',' in range_header:
+        return None
+    if_range = request.headers.get('if-range')
+    if if_range and if_range.strip() != etag:
+        return None
+
+    start, _, end = range_header[len('bytes='):].strip().partition('-')
+    try:
+        if start == '':
+            # suffix range: the last `end` bytes
+            first, last = max(0, size - int(end)), size - 1
+        else:
+            first, last = int(start), min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if first > last or first >= size:
+        raise RangeNotSatisfiable()
+    return first, last
+
+
+def _cache_headers(etag: str, cache_control: str) -> dict:
+    return {'etag': etag, 'cache-control': cache_control, 'accept-ranges': 'bytes'}
+
+
+def _range_not_satisfiable(size: int) -> Response:
+    return Response(status_code=416, headers={'content-range': f'bytes */{size}'})
+
+
+async def file_response(request: Request, path: str, etag: str, media_type: Optional[str] = None,
+                        cache_control: str = IMMUTABLE) -> Response:
+    """
+    Send a file with validators for caching. It supports `If-None-Match` and a single range of `Range`.
+    """
+    headers = _cache_headers(etag, cache_control)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        raise ParameterNotFoundError(os.path.basename(path))
+    size = stat_result.st_size
+    try:
+        byte_range = parse_range(request, etag, size)
+    except RangeNotSatisfiable:
+        return _range_not_satisfiable(size)
+    if byte_range is None:
+        return FileResponse(path=path, media_type=media_type, headers=headers, stat_result=stat_result)
+
+    first, last = byte_range
+
+    async def read_range():
+        async with aiofiles.open(path, 'rb') as f:
+            await f.seek(first)
+            remaining = last - first + 1
+            while remaining > 0:
+                chunk = await f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+
+    headers.update({'content-range': f'bytes {first}-{last}/{size}', 'content-length': str(last - first + 1)})
+    return StreamingResponse(read_range(), status_code=206, media_type=media_type, headers=headers)
+
+
+async def location_response(request: Request, location: Location, etag: str, media_type: str = 'image/jpeg',
+                            cache_control: str = IMMUTABLE) -> Response:
+    """
+    Send an image of the image storage whether it is a whole file or a part of a segment file
+    """
+    if isinstance(location, str):
+        return await file_response(request, location, etag, media_type, cache_control)
+    if etag_matches(request, etag):
+        return content_response(request, b'', etag, media_type, cache_control)
+    return content_response(request, read_location(location), etag, media_type, cache_control)
+
+
+def content_response(request: Request, content: bytes, etag: str, media_type: str,
+                     cache_control: str = IMMUTABLE) -> Response:
+    headers = _cache_headers(etag, cache_control)
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    try:
+        byte_range = parse_range(request, etag, len(content))
+    except RangeNotSatisfiable:
+        return _range_not_satisfiable(len(content))
+    if byte_range is None:
+        return Response(content=content, media_type=media_type, headers=headers)
+
+    first, last = byte_range
+    headers['content-range'] = f'bytes {first}-{last}/{len(content)}'
+    return Response(content=content[first:last + 1], status_code=206, media_type=media_type, headers=headers)
+
+
+def multipart_response(request: Request, parts: List[Tuple[str, str, str, bytes]], etag: str,
+                       cache_control: str = IMMUTABLE) -> Response:
+    """
+    Send many files in a single multipart/form-data response, which browsers can read with `Response.formData()`
+    :param parts: list of tuple(name, filename, media type, content)
+    """
+    headers = {'etag': etag, 'cache-control': cache_control}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+
+    boundary = uuid.uuid4().hex
+    body = bytearray()
+    for name, filename, media_type, content in parts:
+        body += (f'--{boundary}\r\n'
+                 f'Content-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                 f'Content-Type: {media_type}\r\n\r\n').encode()
+        body += content
+        body += b'\r\n'
+    body += f'--{boundary}--\r\n'.encode()
+    return Response(content=bytes(body), media_type=f'multipart/form-data; boundary={boundary}', headers=headers)
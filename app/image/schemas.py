@@ -1,3 +1,6 @@
+from datetime import datetime
+from typing import Optional
+
 from pydantic import BaseModel
 
 
@@ -6,6 +9,8 @@ class ImageBase(BaseModel):
     width: int
     height: int
     url: str
+    phash: Optional[int]
+    near_duplicate_of: Optional[int]
 
 
 class ImageCreate(ImageBase):
@@ -15,6 +20,32 @@ class ImageCreate(ImageBase):
 class ImageRead(ImageBase):
     id: int
     file_id: int
+    inferred_at: Optional[datetime]
+    inferred_model: Optional[str]
+    inferred_model_version: Optional[str]
 
     class Config:
         orm_mode = True
+
+
+class ImageGCReport(BaseModel):
+    dry_run: bool
+    started_at: float
+    finished_at: Optional[float]
+    scanned: int = 0
+    orphans: int = 0
+    skipped: int = 0
+    reclaimed_bytes: int = 0
+
+
+class ImageGCStatistics(BaseModel):
+    running: bool
+    reclaimed_bytes: int
+    deleted_files: int
+    last_report: Optional[ImageGCReport]
+
+
+class ImageStorageCompactionReport(BaseModel):
+    compacted_segments: int = 0
+    moved_images: int = 0
+    reclaimed_bytes: int = 0
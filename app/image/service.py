@@ -1,18 +1,89 @@
-from typing import List, Optional
+from datetime import datetime
+from typing import Dict, List, Optional, Iterable, Tuple
 
-from sqlalchemy import select
+from sqlalchemy import select, update, func, or_
 from sqlalchemy.ext.asyncio import AsyncSession
 
+from config import CONFIG
 from common.exceptions import ParameterNotFoundError
+from common.lrucache import LRUCache
 
 from .models import Image
+from .phash import NEAR_DUPLICATES, NearDuplicateIndex
 from .schemas import ImageBase
 
+# ids of images are never reused and hashes never change, so cached hashes don't go stale
+_image_hashes = LRUCache(maxsize=int(CONFIG.get('image_hash_cache_size') or 100000))
+
 
 async def get_all(session: AsyncSession, file_id: int) -> List[Image]:
     return [o for o in (await session.scalars(select(Image).where(Image.file_id == file_id)))]
 
 
+async def count(session: AsyncSession, file_id: int) -> int:
+    return await session.scalar(select(func.count(Image.id)).where(Image.file_id == file_id))
+
+
+async def count_uninferred(session: AsyncSession, file_id: int) -> int:
+    return await session.scalar(
+        select(func.count(Image.id)).where(Image.file_id == file_id, Image.inferred_at.is_(None)))
+
+
+async def get_uninferred(session: AsyncSession, file_id: int, after_id: int = 0, limit: int = 100) -> List[Image]:
+    """
+    Page through images of a file which are not inferred yet in the order of ids
+    :param after_id: id of the last image of the previous page
+    """
+    return list(await session.scalars(
+        select(Image).where(Image.file_id == file_id, Image.id > after_id, Image.inferred_at.is_(None))
+        .order_by(Image.id).limit(limit)))
+
+
+async def count_failed(session: AsyncSession, file_id: int) -> int:
+    return await session.scalar(
+        select(func.count(Image.id)).where(Image.file_id == file_id, Image.inference_error.is_not(None)))
+
+
+async def mark_failed(session: AsyncSession, failures: Dict[int, str], commit: bool = True):
+    """
+    Record why images failed to be inferred. They are left not inferred, so they are inferred again
+    when their file is resumed or re-inferred
+    :param failures: reasons by image id
+    """
+    if failures:
+        await session.execute(update(Image), [{'id': k, 'inference_error': v[:255]} for k, v in failures.items()])
+    if commit:
+        await session.commit()
+
+
+async def mark_inferred(session: AsyncSession, image_ids: List[int], model: Optional[Tuple[str, str]] = None,
+                        commit: bool = True):
+    """
+    :param model: tuple(name, version) of the model which inferred the images
+    """
+    model_name, model_version = model or (None, None)
+    if image_ids:
+        await session.execute(update(Image).where(Image.id.in_(image_ids)).values(
+            inferred_at=datetime.utcnow(), inferred_model=model_name, inferred_model_version=model_version,
+            inference_error=None))
+    if commit:
+        await session.commit()
+
+
+async def reset_inferred(session: AsyncSession, file_id: int, model: Tuple[str, str]) -> int:
+    """
+    Mark images of a file which were inferred by other models than `model` as not inferred
+    :return: number of images to be inferred again
+    """
+    r = await session.execute(
+        update(Image).where(Image.file_id == file_id, Image.inferred_at.is_not(None),
+                            or_(Image.inferred_model.is_(None), Image.inferred_model != model[0],
+                                Image.inferred_model_version.is_(None), Image.inferred_model_version != model[1]))
+        .values(inferred_at=None).execution_options(synchronize_session=False))
+    await session.commit()
+    return r.rowcount
+
+
 async def get_one(session: AsyncSession, image_id: int, silent=False) -> Optional[Image]:
     r = await session.get(Image, image_id)
     if r is None and not silent:
@@ -20,17 +91,77 @@ async def get_one(session: AsyncSession, image_id: int, silent=False) -> Optiona
     return r
 
 
-async def insert(session: AsyncSession, images: List[ImageBase], file_id: int) -> List[Image]:
+async def get_hash(session: AsyncSession, image_id: int) -> str:
+    """
+    Find the hash of an image without a DB round trip if it is cached
+    """
+    image_hash = _image_hashes.get(image_id)
+    if image_hash is None:
+        image_hash = await session.scalar(select(Image.hash).where(Image.id == image_id))
+        if image_hash is None:
+            raise ParameterNotFoundError(f'Image {image_id}')
+        _image_hashes.put(image_id, image_hash)
+    return image_hash
+
+
+def forget_hashes(image_ids: Iterable[int]):
+    """
+    Remove deleted images from in-memory indexes
+    """
+    image_ids = list(image_ids)
+    _image_hashes.pop(image_ids)
+    if NEAR_DUPLICATES is not None:
+        NEAR_DUPLICATES.remove(image_ids)
+
+
+async def insert(session: AsyncSession, images: List[ImageBase],
+                 file_id: int) -> Tuple[List[Image], Dict[str, int]]:
+    """
+    Images of which hashes already exist are not inserted.
+    If detection of near-duplicates is enabled, near-duplicates are flagged by `near_duplicate_of`,
+    or they are not inserted when the action is "skip".
+    :return: tuple(inserted images, ids of images which near-duplicates are similar to by their hashes)
+    """
+    hashes = set(await session.scalars(select(Image.hash).where(Image.hash.in_([o.hash for o in images]))))
     result = []
-    cnt_dup = 0
+    matches = {}
+    # images of the batch have no ids until they are flushed, so they are indexed by their positions in `result`
+    batch = None if NEAR_DUPLICATES is None else NearDuplicateIndex(NEAR_DUPLICATES.distance)
+    matches_in_batch = {}
     for image in images:
-        db_image = await session.scalar(select(Image).where(Image.hash == image.hash))
-        if db_image is None:
-            db_image = Image(hash=image.hash, width=image.width, height=image.height, url=image.url,
-                             file_id=file_id)
-            result.append(db_image)
-            session.add(db_image)
-        else:
-            cnt_dup += 1
-    await session.commit()
-    return result
+        if image.hash in hashes:
+            continue
+        hashes.add(image.hash)
+        near_duplicate_of = None
+        if batch is not None and image.phash is not None:
+            near_duplicate_of = NEAR_DUPLICATES.find(image.phash)
+            if near_duplicate_of is not None:
+                matches[image.hash] = near_duplicate_of
+            elif (position := batch.find(image.phash)) is not None:
+                matches_in_batch[image.hash] = position
+            if NEAR_DUPLICATES.action == 'skip' and (image.hash in matches or image.hash in matches_in_batch):
+                continue
+            batch.add(len(result), image.phash)
+        result.append(Image(hash=image.hash, width=image.width, height=image.height, url=image.url,
+                            phash=image.phash, near_duplicate_of=near_duplicate_of, file_id=file_id))
+    session.add_all(result)
+    if batch is None:
+        await session.commit()
+        return result, matches
+
+    await session.flush()
+    for image_hash, position in matches_in_batch.items():
+        matches[image_hash] = result[position].id
+    indexed = []
+    for db_image in result:
+        if db_image.hash in matches_in_batch:
+            db_image.near_duplicate_of = matches[db_image.hash]
+        if db_image.phash is not None:
+            indexed.append(db_image.id)
+            NEAR_DUPLICATES.add(db_image.id, db_image.phash)
+    try:
+        await session.commit()
+    except Exception:
+        NEAR_DUPLICATES.remove(indexed)
+        raise
+    return result, matches
@@ -0,0 +1,532 @@
+import asyncio
+import fcntl
+import io
+import mmap
+import os
+import re
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import BinaryIO, Iterator, List, Optional, Tuple, Union
+
+import aiofiles
+
+from config import CONFIG
+from common.exceptions import ParameterNotFoundError, ParameterValueError, OperationError
+from .schemas import ImageStorageCompactionReport
+from .utils import get_image_dirpath
+
+STORAGE_BACKENDS = ['sharded', 'packed']
+DEFAULT_SEGMENT_SIZE = 1024 ** 3
+DEFAULT_GARBAGE_RATIO = 0.5
+SCAN_BATCH_SIZE = 1000
+MOVE_BATCH_SIZE = 100
+GENERATION_FILE = 'generation'
+GENERATION_CHECK_INTERVAL = 1.0
+# seconds compacted segments are kept before they are removed, so that reads of their images can finish
+RETIRED_SEGMENT_GRACE = 10.0
+
+# path of an image file, or tuple(path of a segment file, offset, length) of an image packed in a segment file.
+# It is picklable, so it can be passed to worker processes of `cpu_pool`.
+Location = Union[str, Tuple[str, int, int]]
+
+_KEY_PATTERN = re.compile('([0-9a-fA-F]+)(?:_([0-9]+))?')
+
+
+def variant_key(image_hash: str, size: int) -> str:
+    return f'{image_hash}_{size}'
+
+
+def parse_key(key: str) -> Tuple[str, int]:
+    """
+    :param key: "<hash>" for an original image or "<hash>_<size>" for a downscaled variant
+    :return: tuple(hash, long edge size of the variant). The size is 0 for an original image.
+    """
+    matched = _KEY_PATTERN.fullmatch(key)
+    if not matched:
+        raise ParameterValueError(key='hash', value=key, should='hex string')
+    return matched.group(1), int(matched.group(2) or 0)
+
+
+_segments = {}
+# directory of segments -> tuple(when its generation was read, generation)
+_generations = {}
+
+
+def _read_generation(dirpath: str) -> int:
+    try:
+        with open(os.path.join(dirpath, GENERATION_FILE)) as f:
+            return int(f.read() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def _check_generation(dirpath: str):
+    # compaction bumps the generation of a directory before removing segments in it.
+    # Every process including workers of `cpu_pool` drops its mappings then, which would keep the disk space.
+    now = time.monotonic()
+    checked_at, generation = _generations.get(dirpath, (None, None))
+    if checked_at is not None and now - checked_at < GENERATION_CHECK_INTERVAL:
+        return
+    current = _read_generation(dirpath)
+    if generation is not None and current != generation:
+        for path in [o for o in _segments if os.path.dirname(o) == dirpath]:
+            _unmap_segment(path)
+    _generations[dirpath] = (now, current)
+
+
+def _map_segment(path: str, end: int) -> mmap.mmap:
+    _check_generation(os.path.dirname(path))
+    # segment files only grow, so remap it if the image is beyond the mapped length
+    mm = _segments.get(path)
+    if mm is None or len(mm) < end:
+        if mm is not None:
+            mm.close()
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _segments[path] = mm
+    return mm
+
+
+def _unmap_segment(path: str):
+    mm = _segments.pop(path, None)
+    if mm is not None:
+        mm.close()
+
+
+def read_location(location: Location) -> bytes:
+    if isinstance(location, str):
+        with open(location, 'rb') as f:
+            return f.read()
+    path, offset, length = location
+    return _map_segment(path, offset + length)[offset:offset + length]
+
+
+def location_reference(location: Location) -> str:
+    """
+    Reference of an image for a server which mounts the same data directory, instead of its bytes.
+    It is the path relative to the data directory, followed by "@<offset>:<length>" for an image in a segment file.
+    e.g. "images/6d/6dc98...e32.jpg", "packs/00000001.pack@1024:52013"
+    """
+    if isinstance(location, str):
+        return os.path.relpath(location, CONFIG['path']['data'])
+    path, offset, length = location
+    return f"{os.path.relpath(path, CONFIG['path']['data'])}@{offset}:{length}"
+
+
+async def async_read_location(location: Location) -> bytes:
+    if isinstance(location, str):
+        async with aiofiles.open(location, 'rb') as f:
+            return await f.read()
+    return read_location(location)
+
+
+def open_location(location: Location) -> BinaryIO:
+    """
+    Open an image to decode it with PIL. It works in worker processes of `cpu_pool` as well.
+    """
+    if isinstance(location, str):
+        return open(location, 'rb')
+    return io.BytesIO(read_location(location))
+
+
+class ImageStorage(ABC):
+    """
+    Content-addressed store of image files.
+    Keys are "<hash>" for original images and "<hash>_<size>" for downscaled variants.
+    """
+    @abstractmethod
+    def locate(self, key: str, not_exist_ok=False) -> Optional[Location]:
+        """
+        :return: None if the image does not exist and `not_exist_ok` is true
+        :raises: `ParameterNotFoundError` if the image does not exist
+        """
+        pass
+
+    def exists(self, key: str) -> bool:
+        return self.locate(key, not_exist_ok=True) is not None
+
+    @abstractmethod
+    async def write(self, key: str, data: bytes):
+        """
+        Store an image. It does nothing if the image already exists, because keys are hashes of contents.
+        """
+        pass
+
+    @abstractmethod
+    def delete(self, key: str) -> int:
+        """
+        :return: bytes of the deleted image. 0 if it does not exist.
+        """
+        pass
+
+    @abstractmethod
+    def stat(self, key: str) -> Optional[Tuple[int, float]]:
+        """
+        :return: tuple(bytes, modification time) of an image. None if it does not exist.
+        """
+        pass
+
+    @abstractmethod
+    def keys(self) -> Iterator[str]:
+        pass
+
+    async def compact(self) -> ImageStorageCompactionReport:
+        return ImageStorageCompactionReport()
+
+    def close(self):
+        pass
+
+
+class ShardedStorage(ImageStorage):
+    """
+    One file per image under 256 directories named by the first two characters of hashes.
+    e.g. 6d/6dc98...e32.jpg and its variant 6d/6dc98...e32_512.jpg
+    """
+    @staticmethod
+    def path(key: str) -> str:
+        image_hash, _ = parse_key(key)
+        return os.path.join(get_image_dirpath(), image_hash[:2], f'{key}.jpg')
+
+    def locate(self, key: str, not_exist_ok=False) -> Optional[Location]:
+        path = self.path(key)
+        if not os.path.exists(path):
+            if not_exist_ok:
+                return None
+            raise ParameterNotFoundError(key)
+        return path
+
+    async def write(self, key: str, data: bytes):
+        path = self.path(key)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        async with aiofiles.open(path, 'wb') as f:
+            await f.write(data)
+
+    def delete(self, key: str) -> int:
+        path = self.path(key)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return 0
+        return size
+
+    def stat(self, key: str) -> Optional[Tuple[int, float]]:
+        try:
+            stat = os.stat(self.path(key))
+        except FileNotFoundError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def keys(self) -> Iterator[str]:
+        image_dir = get_image_dirpath()
+        if not os.path.exists(image_dir):
+            return
+        for shard in sorted(os.listdir(image_dir)):
+            shard_dir = os.path.join(image_dir, shard)
+            if not os.path.isdir(shard_dir):
+                continue
+            with os.scandir(shard_dir) as it:
+                for entry in it:
+                    key, ext = os.path.splitext(entry.name)
+                    if ext == '.jpg' and _KEY_PATTERN.fullmatch(key) and entry.is_file(follow_symlinks=False):
+                        yield key
+
+
+class PackedStorage(ImageStorage):
+    """
+    Images are appended to segment files of about `segment_size` bytes,
+    and an index maps each image to (segment, offset, length).
+    The index is a sqlite database keyed by binary hashes, so it doesn't need to be loaded into memory.
+
+    Deleted images remain in segment files as garbage
+    until `compact` rewrites segments whose ratio of garbage is at least `garbage_ratio`.
+    The segment which images are being appended to is never compacted.
+
+    Appending and indexing run in a thread, and writes made while a batch is being written are written together
+    as the next batch with one fsync and one commit. A lock file serializes appending across processes,
+    e.g. the server and the command line of this module.
+    """
+    def __init__(self, dirpath: str, segment_size: int = DEFAULT_SEGMENT_SIZE,
+                 garbage_ratio: float = DEFAULT_GARBAGE_RATIO):
+        self._dirpath = dirpath
+        self._segment_size = segment_size
+        self._garbage_ratio = garbage_ratio
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+        self._pending: List[Tuple[str, bytes, asyncio.Future]] = []
+        self._flusher: Optional[asyncio.Task] = None
+
+    @property
+    def db(self) -> sqlite3.Connection:
+        with self._lock:
+            if self._db is None:
+                os.makedirs(self._dirpath, exist_ok=True)
+                # it is shared with the thread writing batches, and writes are serialized by `_lock`
+                self._db = sqlite3.connect(os.path.join(self._dirpath, 'index.sqlite3'), check_same_thread=False)
+                self._db.execute('PRAGMA journal_mode=WAL')
+                self._db.execute('CREATE TABLE IF NOT EXISTS blobs ('
+                                 'hash BLOB NOT NULL, variant INTEGER NOT NULL, '
+                                 'segment INTEGER NOT NULL, offset INTEGER NOT NULL, length INTEGER NOT NULL, '
+                                 'mtime REAL NOT NULL, '
+                                 'PRIMARY KEY (hash, variant)) WITHOUT ROWID')
+                self._db.execute('CREATE INDEX IF NOT EXISTS blobs_segment ON blobs (segment)')
+                self._db.commit()
+            return self._db
+
+    @contextmanager
+    def _locked(self):
+        """
+        Hold the lock of the directory against other threads and processes
+        """
+        with self._lock:
+            os.makedirs(self._dirpath, exist_ok=True)
+            with open(os.path.join(self._dirpath, 'lock'), 'a') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                yield
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self._dirpath, f'{segment:08d}.pack')
+
+    def segments(self):
+        if not os.path.exists(self._dirpath):
+            return []
+        return sorted(int(o[:-len('.pack')]) for o in os.listdir(self._dirpath) if o.endswith('.pack'))
+
+    @staticmethod
+    def _index_key(key: str) -> Tuple[bytes, int]:
+        image_hash, size = parse_key(key)
+        try:
+            return bytes.fromhex(image_hash), size
+        except ValueError:
+            raise ParameterValueError(key='hash', value=key, should='hex string of even length')
+
+    def locate(self, key: str, not_exist_ok=False) -> Optional[Location]:
+        row = self.db.execute('SELECT segment, offset, length FROM blobs WHERE hash = ? AND variant = ?',
+                              self._index_key(key)).fetchone()
+        if row is None:
+            if not_exist_ok:
+                return None
+            raise ParameterNotFoundError(key)
+        return self.segment_path(row[0]), row[1], row[2]
+
+    async def write(self, key: str, data: bytes):
+        if self.exists(key):
+            return
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((key, data, future))
+        if self._flusher is None or self._flusher.done() or self._flusher.get_loop() is not loop:
+            self._flusher = loop.create_task(self._flush())
+        await future
+
+    async def _flush(self):
+        while self._pending:
+            batch, self._pending = self._pending, []
+            try:
+                await asyncio.to_thread(self._write_batch, [(key, data) for key, data, _ in batch])
+            except Exception as e:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                for *_, future in batch:
+                    if not future.done():
+                        future.set_result(None)
+
+    def _write_batch(self, images: List[Tuple[str, bytes]]):
+        with self._locked():
+            # the same image may be written twice in a batch, or by another process
+            images = {key: data for key, data in images if not self.exists(key)}
+            locations = self._append(list(images.values()))
+            now = time.time()
+            self.db.executemany('INSERT OR IGNORE INTO blobs VALUES (?, ?, ?, ?, ?, ?)',
+                                [(*self._index_key(key), segment, offset, len(data), now)
+                                 for (key, data), (segment, offset) in zip(images.items(), locations)])
+            self.db.commit()
+
+    def _append(self, blobs: List[bytes]) -> List[Tuple[int, int]]:
+        """
+        Append images to the last segment, and start a new one whenever it is full. Call it holding `_locked`.
+        :return: list of tuple(segment, offset)
+        """
+        if not blobs:
+            return []
+        segment = max(self.segments(), default=1)
+        locations = []
+        f = open(self.segment_path(segment), 'ab')
+        try:
+            for data in blobs:
+                if f.tell() >= self._segment_size:
+                    f.flush()
+                    os.fsync(f.fileno())
+                    f.close()
+                    segment += 1
+                    f = open(self.segment_path(segment), 'ab')
+                locations.append((segment, f.tell()))
+                f.write(data)
+            f.flush()
+            # the index must never point to bytes which are not on the disk
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        return locations
+
+    def delete(self, key: str) -> int:
+        with self._lock:
+            row = self.db.execute('SELECT length FROM blobs WHERE hash = ? AND variant = ?',
+                                  self._index_key(key)).fetchone()
+            if row is None:
+                return 0
+            self.db.execute('DELETE FROM blobs WHERE hash = ? AND variant = ?', self._index_key(key))
+            self.db.commit()
+            return row[0]
+
+    def stat(self, key: str) -> Optional[Tuple[int, float]]:
+        row = self.db.execute('SELECT length, mtime FROM blobs WHERE hash = ? AND variant = ?',
+                              self._index_key(key)).fetchone()
+        return None if row is None else (row[0], row[1])
+
+    def keys(self) -> Iterator[str]:
+        # fetch in batches, so that images can be deleted while iterating
+        last = (b'', -1)
+        while True:
+            rows = self.db.execute('SELECT hash, variant FROM blobs WHERE (hash, variant) > (?, ?) '
+                                   'ORDER BY hash, variant LIMIT ?', (*last, SCAN_BATCH_SIZE)).fetchall()
+            if not rows:
+                return
+            for image_hash, size in rows:
+                yield image_hash.hex() if size == 0 else variant_key(image_hash.hex(), size)
+            last = rows[-1]
+
+    def _move(self, segment: int, rows: List[tuple]):
+        path = self.segment_path(segment)
+        with self._locked():
+            locations = self._append([read_location((path, offset, length)) for _, _, offset, length in rows])
+            self.db.executemany('UPDATE blobs SET segment = ?, offset = ? '
+                                'WHERE hash = ? AND variant = ? AND segment = ?',
+                                [(new_segment, new_offset, image_hash, size, segment)
+                                 for (image_hash, size, _, _), (new_segment, new_offset) in zip(rows, locations)])
+            self.db.commit()
+
+    def _bump_generation(self):
+        path = os.path.join(self._dirpath, GENERATION_FILE)
+        with self._locked():
+            with open(f'{path}.tmp', 'w') as f:
+                f.write(str(_read_generation(self._dirpath) + 1))
+            os.replace(f'{path}.tmp', path)
+
+    async def compact(self) -> ImageStorageCompactionReport:
+        os.makedirs(self._dirpath, exist_ok=True)
+        # only one compaction runs at a time among processes
+        with open(os.path.join(self._dirpath, 'compact.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise OperationError('Compaction of image storage is already running')
+            report = ImageStorageCompactionReport()
+            live_bytes = dict(self.db.execute('SELECT segment, SUM(length) FROM blobs GROUP BY segment'))
+            # images are moved to the active segment, so only segments before it are compacted
+            sealed = [o for o in self.segments() if o < max(self.segments(), default=1)]
+            retired = []
+            for segment in sealed:
+                path = self.segment_path(segment)
+                size = os.path.getsize(path)
+                garbage = size - live_bytes.get(segment, 0)
+                if size > 0 and garbage / size < self._garbage_ratio:
+                    continue
+                rows = self.db.execute('SELECT hash, variant, offset, length FROM blobs WHERE segment = ?',
+                                       (segment,)).fetchall()
+                for i in range(0, len(rows), MOVE_BATCH_SIZE):
+                    await asyncio.to_thread(self._move, segment, rows[i:i + MOVE_BATCH_SIZE])
+                    report.moved_images += len(rows[i:i + MOVE_BATCH_SIZE])
+                retired.append(segment)
+                report.compacted_segments += 1
+                report.reclaimed_bytes += garbage
+            if retired:
+                # processes drop their mappings of segments when they see the new generation,
+                # and locations resolved before the compaction remain readable until the segments are removed
+                self._bump_generation()
+                await asyncio.sleep(RETIRED_SEGMENT_GRACE)
+                for segment in retired:
+                    _unmap_segment(self.segment_path(segment))
+                    os.remove(self.segment_path(segment))
+            return report
+
+    def close(self):
+        for path in [o for o in _segments if os.path.dirname(o) == self._dirpath]:
+            _unmap_segment(path)
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def create_image_storage(config: Optional[dict] = None) -> ImageStorage:
+    config = config or {}
+    backend = config.get('backend') or 'sharded'
+    if backend == 'sharded':
+        return ShardedStorage()
+    elif backend == 'packed':
+        return PackedStorage(os.path.join(CONFIG['path']['data'], 'packs'),
+                             segment_size=int(config.get('segment_size') or DEFAULT_SEGMENT_SIZE),
+                             garbage_ratio=float(config.get('garbage_ratio') or DEFAULT_GARBAGE_RATIO))
+    raise ParameterValueError(key='image_storage.backend', value=backend, choice=STORAGE_BACKENDS)
+
+
+async def migrate(source: ImageStorage, target: ImageStorage, delete_source: bool = False) -> int:
+    """
+    Copy all images including variants from `source` to `target`
+    :return: number of copied images. Images that already exist in `target` are not counted.
+    :raises: `OperationError` if `delete_source` is true and exports link images of `source`
+    """
+    if delete_source:
+        # imported here, because exports read images from this module
+        from app.export.utils import hashes_referenced_by_exports
+        linked = [o for o in hashes_referenced_by_exports() if source.exists(o)]
+        if linked:
+            raise OperationError(f'{len(linked)} images of the source are linked by exports. '
+                                 f'Delete the exports before deleting the source')
+    cnt = 0
+    for key in source.keys():
+        location = source.locate(key, not_exist_ok=True)
+        if location is None:
+            continue
+        if not target.exists(key):
+            await target.write(key, await async_read_location(location))
+            cnt += 1
+        if delete_source:
+            source.delete(key)
+    return cnt
+
+
+IMAGE_STORAGE = create_image_storage(CONFIG.get('image_storage'))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Manage the image storage')
+    commands = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = commands.add_parser('migrate', help='copy images from a storage backend to another')
+    migrate_parser.add_argument('source', choices=STORAGE_BACKENDS)
+    migrate_parser.add_argument('target', choices=STORAGE_BACKENDS)
+    migrate_parser.add_argument('--delete', action='store_true', help='delete images from the source after copying')
+    commands.add_parser('compact', help='rewrite segment files of the packed backend to reclaim deleted images')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        storage_config = CONFIG.get('image_storage') or {}
+        source_storage = create_image_storage({**storage_config, 'backend': args.source})
+        target_storage = create_image_storage({**storage_config, 'backend': args.target})
+        try:
+            migrated = asyncio.run(migrate(source_storage, target_storage, delete_source=args.delete))
+        except OperationError as e:
+            parser.exit(1, f'{e}\n')
+        print(f'{migrated} images are copied from {args.source} to {args.target}. '
+              f'Set "image_storage.backend" to "{args.target}" to use them.')
+    else:
+        print(asyncio.run(IMAGE_STORAGE.compact()))
@@ -1,5 +1,7 @@
-import string
+import re
 import os
+from collections import Counter
+from typing import Iterable
 
 from config import CONFIG
 from common.exceptions import ParameterValueError, ParameterNotFoundError
@@ -9,8 +11,11 @@ def get_image_dirpath() -> str:
     return os.path.join(CONFIG['path']['data'], 'images')
 
 
+_HEX_PATTERN = re.compile('[0-9a-fA-F]+')
+
+
 def get_image_file_path(image_hash: str, not_exist_ok=False, return_relative=False) -> str:
-    if not all(c in string.hexdigits for c in image_hash):
+    if not _HEX_PATTERN.fullmatch(image_hash):
         raise ParameterValueError(key='hash', value=image_hash, should='hex string')
 
     relative_path = os.path.join(image_hash[:2], f'{image_hash}.jpg')
@@ -22,3 +27,25 @@ def get_image_file_path(image_hash: str, not_exist_ok=False, return_relative=Fal
         return relative_path
     else:
         return full_path
+
+
+_pinned_hashes = Counter()
+
+
+def pin_image_hashes(hashes: Iterable[str]):
+    """
+    Protect image files from garbage collection
+    while they are written but the rows of `Image` are not inserted yet
+    """
+    _pinned_hashes.update(hashes)
+
+
+def unpin_image_hashes(hashes: Iterable[str]):
+    _pinned_hashes.subtract(hashes)
+    for k in [k for k, v in _pinned_hashes.items() if v <= 0]:
+        del _pinned_hashes[k]
+
+
+def is_image_hash_pinned(image_hash: str) -> bool:
+    return _pinned_hashes[image_hash] > 0
+
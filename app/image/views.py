@@ -1,13 +1,19 @@
-from typing import List
+import logging
+from typing import List, Optional
 
-from fastapi import APIRouter, Depends
-from fastapi.responses import FileResponse
+from fastapi import APIRouter, Depends, Request, Response
 
+from common.exceptions import OperationError
 from database.core import get_session
+from app.utils import run_in_background
 
-from .schemas import ImageRead
-from .service import get_all, get_one
-from .utils import get_image_file_path
+from .crop import crop_response
+from .gc import IMAGE_GC
+from .pyramid import PYRAMID_BACKFILL, locate_nearest_image, nearest_image_key
+from .responses import IMMUTABLE, REVALIDATE, make_etag, location_response
+from .schemas import ImageRead, ImageGCReport, ImageGCStatistics
+from .storage import IMAGE_STORAGE
+from .service import get_all, get_hash
 
 router = APIRouter()
 
@@ -17,8 +23,100 @@ async def get_images(file_id: int, session=Depends(get_session)):
     return await get_all(session, file_id)
 
 
+@router.get('/gc', response_model=ImageGCStatistics)
+async def get_gc_statistics():
+    return IMAGE_GC.statistics()
+
+
+@router.post('/gc', response_model=ImageGCReport)
+async def collect_garbage(dry_run: bool = True, session=Depends(get_session)):
+    """
+    Find image files referenced by neither images nor exports.
+    With `dry_run=false`, they are deleted in the background.
+    """
+    if dry_run:
+        return await IMAGE_GC.run(session, dry_run=True)
+    if IMAGE_GC.statistics().running:
+        raise OperationError('Garbage collection of image files is already running')
+    run_in_background(_collect_garbage())
+    return Response(status_code=202)
+
+
+async def _collect_garbage():
+    async for session in get_session():
+        try:
+            await IMAGE_GC.run(session, dry_run=False)
+        except Exception as e:
+            logging.critical(f'Failed to collect garbage of image files. reason: {e}')
+
+
+@router.get('/pyramid/backfill')
+async def get_pyramid_backfill_status():
+    return PYRAMID_BACKFILL.status()
+
+
+@router.post('/pyramid/backfill')
+async def backfill_pyramid():
+    """
+    Create downscaled variants of existing images in the background
+    """
+    run_in_background(PYRAMID_BACKFILL.run())
+    return Response(status_code=202)
+
+
+@router.post('/storage/compact')
+async def compact_storage():
+    """
+    Reclaim space of deleted images in segment files in the background.
+    It does nothing unless the storage backend is "packed".
+    """
+    run_in_background(_compact_storage())
+    return Response(status_code=202)
+
+
+async def _compact_storage():
+    try:
+        report = await IMAGE_STORAGE.compact()
+        logging.info(f'Compaction of image storage is done. {report}')
+    except Exception as e:
+        logging.critical(f'Failed to compact image storage. reason: {e}')
+
+
+@router.get('/by-hash/{image_hash}')
+async def get_image_by_hash(request: Request, image_hash: str, size: Optional[int] = None):
+    """
+    Get an image file directly from the image store without querying the database
+    """
+    return await _image_response(request, image_hash, size)
+
+
 @router.get('/{image_id}')
-async def get_image(image_id: int, session=Depends(get_session)):
-    db_image = await get_one(session, image_id)
-    image_path = get_image_file_path(db_image.hash)
-    return FileResponse(path=image_path)
+async def get_image(request: Request, image_id: int, size: Optional[int] = None, session=Depends(get_session)):
+    """
+    Image files never change because they are addressed by their hash,
+    so they can be cached by clients without revalidation.
+    :param size: If given, the smallest downscaled variant whose long edge is at least `size` is returned
+                 when it exists. Otherwise, the original image is returned.
+    """
+    image_hash = await get_hash(session, image_id)
+    return await _image_response(request, image_hash, size)
+
+
+async def _image_response(request: Request, image_hash: str, size: Optional[int] = None) -> Response:
+    # key is "<hash>" for the original image and "<hash>_<size>" for a variant
+    key, location = locate_nearest_image(image_hash, size)
+    # the original image served in place of a variant not rendered yet must not be cached as the variant for good
+    cache_control = IMMUTABLE if key == nearest_image_key(image_hash, size) else REVALIDATE
+    return await location_response(request, location, make_etag(key), cache_control=cache_control)
+
+
+@router.get('/{image_id}/crop')
+async def get_image_crop(request: Request, image_id: int,
+                         rx1: float = 0, ry1: float = 0, rx2: float = 1, ry2: float = 1,
+                         size: int = 256, format: str = 'jpeg', session=Depends(get_session)):
+    """
+    Get a region of an image given as relative coordinates, shrunk to fit in `size` x `size`.
+    Without coordinates, it returns a thumbnail of the whole image.
+    """
+    image_hash = await get_hash(session, image_id)
+    return await crop_response(request, image_hash, (rx1, ry1, rx2, ry2), size, format)
@@ -28,6 +28,10 @@ class Label(Base):
     updated_at = sa.Column(sa.DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
     reviewed = sa.Column(sa.BOOLEAN, nullable=False, default=False, server_default=sa.false(),
                          comment='Whether review is done')
+    version = sa.Column(sa.Integer, nullable=False, default=1, server_default='1',
+                        comment='Incremented on every update to detect concurrent modifications')
+    model = sa.Column(sa.String(255), nullable=True, comment='Name of the model which predicted the label')
+    model_version = sa.Column(sa.String(255), nullable=True, comment='Version of the model which predicted the label')
     bbox = orm.relationship("BBox", back_populates="label", lazy="noload")
 
     # required in order to access columns with server defaults
@@ -35,6 +39,4 @@ class Label(Base):
     # triggering an expired load
     __mapper_args__ = {"eager_defaults": True}
 
-    @property
-    def _columns_exclude_updating(self):
-        return ['id', 'bbox_id']
+    _columns_exclude_updating = ['id', 'bbox_id', 'version', 'model', 'model_version']
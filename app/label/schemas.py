@@ -27,6 +27,9 @@ class LabelRead(LabelBase):
     bbox_id: int
     unused: bool
     reviewed: bool
+    version: int
+    model: Optional[str]
+    model_version: Optional[str]
 
     class Config:
         orm_mode = True
@@ -37,6 +40,7 @@ class LabelUpdate(LabelBase):
     region: Optional[str]
     unused: Optional[bool]
     reviewed: Optional[bool]
+    version: Optional[int]
 
 
 class LabelFilter(BaseModel):
@@ -5,7 +5,7 @@ from sqlalchemy.sql import selectable
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from common.exceptions import ParameterNotFoundError
-from database.service import get_one as _get_one
+from database.service import get_one as _get_one, update_one as _update_one
 from app.bbox.models import BBox
 from app.image.models import Image
 from app.file.models import File
@@ -14,14 +14,20 @@ from .schemas import LabelBase, LabelUpdate, LabelFilter
 
 
 async def insert(session: AsyncSession,
-                 pairs: List[Tuple[int, LabelBase]]) -> List[Optional[Label]]:
+                 pairs: List[Tuple[int, LabelBase]],
+                 model: Optional[Tuple[str, str]] = None) -> List[Optional[Label]]:
+    """
+    :param model: tuple(name, version) of the model which predicted the labels
+    """
+    model_name, model_version = model or (None, None)
     result = []
     for bbox_id, label in pairs:
         query = select(Label).where(Label.bbox_id == bbox_id)
         db_label = await session.scalar(query)
 
         if db_label is None:
-            db_label = Label(bbox_id=bbox_id, **label.dict(exclude_unset=True))
+            db_label = Label(bbox_id=bbox_id, model=model_name, model_version=model_version,
+                             **label.dict(exclude_unset=True))
             session.add(db_label)
             result.append(db_label)
         else:
@@ -35,11 +41,7 @@ async def get_one(session: AsyncSession, label_id: int, silent: bool = False) ->
 
 
 async def update(session: AsyncSession, label: LabelUpdate) -> Label:
-    db_label = await get_one(session, label.id)
-    db_label.update(**label.dict(exclude_unset=True))
-    session.add(db_label)
-    await session.commit()
-    return db_label
+    return await _update_one(session, Label, label.id, label.dict(exclude_unset=True), version=label.version)
 
 
 async def get_all(session: AsyncSession, file_id: Optional[int] = None,
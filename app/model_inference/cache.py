@@ -0,0 +1,81 @@
+import json
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select, delete, or_
+from sqlalchemy.exc import IntegrityError
+
+from config import CONFIG
+from database.core import get_session
+from app.model_serving.state import get_served_model
+from .models import CachedPrediction
+
+# number of hashes in an IN clause
+QUERY_BATCH_SIZE = 500
+
+
+class PredictionCache:
+    """
+    Raw predictions of images persisted in DB and keyed by (image hash, model name, model version),
+    so that an image which was inferred by the served model is not sent to the inference server again.
+    Predictions of other models are dropped by `invalidate` when another model is served.
+    The cache is not used until a model is served, because predictions can't be keyed without its version.
+    """
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+
+    def model(self) -> Optional[Tuple[str, str]]:
+        """
+        :return: tuple(name, version) of the served model. None if it is unknown or the cache is disabled
+        """
+        return get_served_model() if self.enabled else None
+
+    async def invalidate(self, model: str, version: str):
+        """
+        Drop predictions of models other than the given one
+        """
+        async for session in get_session():
+            await session.execute(delete(CachedPrediction).where(
+                or_(CachedPrediction.model != model, CachedPrediction.version != version)))
+            await session.commit()
+
+    async def get(self, hashes: List[str]) -> Dict[str, List[dict]]:
+        """
+        :return: cached predictions of the served model by image hash. Images which are not cached are omitted
+        """
+        served = self.model()
+        if served is None or not hashes:
+            return {}
+        result = {}
+        async for session in get_session():
+            for i in range(0, len(hashes), QUERY_BATCH_SIZE):
+                rows = await session.execute(
+                    select(CachedPrediction.hash, CachedPrediction.prediction).where(
+                        CachedPrediction.model == served[0], CachedPrediction.version == served[1],
+                        CachedPrediction.hash.in_(hashes[i:i + QUERY_BATCH_SIZE])))
+                result.update((image_hash, json.loads(prediction)) for image_hash, prediction in rows)
+        return result
+
+    async def put(self, predictions: Dict[str, List[dict]]):
+        """
+        :param predictions: predictions of the served model by image hash
+        """
+        served = self.model()
+        if served is None or not predictions:
+            return
+        async for session in get_session():
+            existing = set(await session.scalars(
+                select(CachedPrediction.hash).where(CachedPrediction.model == served[0],
+                                                    CachedPrediction.version == served[1],
+                                                    CachedPrediction.hash.in_(list(predictions.keys())))))
+            session.add_all([CachedPrediction(hash=image_hash, model=served[0], version=served[1],
+                                              prediction=json.dumps(prediction))
+                             for image_hash, prediction in predictions.items() if image_hash not in existing])
+            try:
+                await session.commit()
+            except IntegrityError:
+                # the same image was cached by another file at the same time
+                await session.rollback()
+
+
+PREDICTION_CACHE = PredictionCache(
+    enabled=(CONFIG.get('inference_server') or {}).get('prediction_cache') not in (False, 'false', 'False'))
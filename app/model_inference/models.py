@@ -0,0 +1,14 @@
+import sqlalchemy as sa
+
+from database.core import Base
+
+
+class CachedPrediction(Base):
+    __tablename__ = 'prediction_cache'
+    hash = sa.Column(sa.String(64), primary_key=True, comment='Hash of the inferred image')
+    model = sa.Column(sa.String(255), primary_key=True)
+    version = sa.Column(sa.String(255), primary_key=True)
+    prediction = sa.Column(sa.Text, nullable=False, comment='JSON of regions returned by the inference server')
+
+    def __repr__(self):
+        return f'CachedPrediction(hash={self.hash!r}, model={self.model!r}, version={self.version!r})'
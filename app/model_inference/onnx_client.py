@@ -0,0 +1,218 @@
+import ast
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterable, AsyncIterator, Dict, List, Optional, Tuple
+
+import PIL.Image
+
+from common.aiopool import ordered_map, as_completed_map
+from common.exceptions import OperationError
+from app.image.schemas import ImageRead
+from app.image.storage import Location, open_location
+from app.bbox.schemas import BBoxBase
+from app.label.schemas import LabelBase
+from .cache import PredictionCache
+from .utils import DEFAULT_BATCH_MAX_WAIT, InferenceClient, PredictionBatcher
+
+try:
+    import numpy as np
+    import onnxruntime
+except ImportError:
+    # optional dependencies, which are needed only by the onnx backend
+    np = None
+    onnxruntime = None
+
+DEFAULT_INTRA_OP_THREADS = 1
+DEFAULT_WORKERS = 2
+DEFAULT_CONFIDENCE = 0.25
+DEFAULT_IOU = 0.7
+MAX_DETECTIONS = 300
+# boxes of different classes are shifted by this to suppress them separately in a single pass
+_CLASS_OFFSET = 7680
+_PAD_COLOR = 114
+
+
+def letterbox(location: Location, size: int) -> Tuple['np.ndarray', float, Tuple[int, int]]:
+    """
+    Resize an image to fit in a square of `size` keeping its aspect ratio and pad the rest, like YOLOv8 does
+    :return: tuple(CHW uint8 array, scale of the image, (left, top) padding)
+    """
+    with open_location(location) as f, PIL.Image.open(f) as im:
+        width, height = im.size
+        scale = min(size / width, size / height)
+        resized_width, resized_height = max(1, round(width * scale)), max(1, round(height * scale))
+        im.draft('RGB', (resized_width, resized_height))
+        resized = im.convert('RGB').resize((resized_width, resized_height), PIL.Image.Resampling.BILINEAR)
+    canvas = np.full((size, size, 3), _PAD_COLOR, dtype=np.uint8)
+    left, top = (size - resized_width) // 2, (size - resized_height) // 2
+    canvas[top:top + resized_height, left:left + resized_width] = np.asarray(resized)
+    return canvas.transpose((2, 0, 1)), scale, (left, top)
+
+
+def non_max_suppression(boxes: 'np.ndarray', scores: 'np.ndarray', iou: float) -> 'np.ndarray':
+    """
+    :param boxes: (n, 4) array of x1, y1, x2, y2
+    :return: indices of kept boxes in descending order of scores
+    """
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1) * (y2 - y1)
+    order = scores.argsort()[::-1]
+    keep = []
+    while order.size:
+        i, rest = order[0], order[1:]
+        keep.append(i)
+        inter = (np.clip(np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest]), 0, None) *
+                 np.clip(np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest]), 0, None))
+        order = rest[inter / (areas[i] + areas[rest] - inter + 1e-9) <= iou]
+    return np.array(keep, dtype=np.int64)
+
+
+def detect(output: 'np.ndarray', confidence: float, iou: float) -> Tuple['np.ndarray', 'np.ndarray', 'np.ndarray']:
+    """
+    Decode an output of a YOLOv8 detection model for an image
+    :param output: (4 + number of classes, number of anchors) array of cx, cy, w, h and scores of classes
+    :return: tuple(boxes of x1, y1, x2, y2, scores, classes) of detections
+    """
+    predictions = output.T
+    classes = predictions[:, 4:].argmax(axis=1)
+    scores = predictions[np.arange(len(predictions)), 4 + classes]
+    mask = scores > confidence
+    xywh, scores, classes = predictions[mask, :4], scores[mask], classes[mask]
+    boxes = np.concatenate([xywh[:, :2] - xywh[:, 2:] / 2, xywh[:, :2] + xywh[:, 2:] / 2], axis=1)
+    keep = non_max_suppression(boxes + classes[:, None] * _CLASS_OFFSET, scores, iou)[:MAX_DETECTIONS]
+    return boxes[keep], scores[keep], classes[keep]
+
+
+class OnnxModel:
+    """
+    An ONNX model exported from YOLOv8 and threads to run it, which are shared by clients in the process
+    """
+    def __init__(self, path: str, intra_op_threads: int, workers: int):
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(path, sess_options=options,
+                                                    providers=['CPUExecutionProvider'])
+        model_input = self.session.get_inputs()[0]
+        self.input_name = model_input.name
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.names: Dict[int, str] = ast.literal_eval(metadata['names']) if 'names' in metadata else {}
+        batch, _, height, _ = model_input.shape
+        self.imgsz = height if isinstance(height, int) else ast.literal_eval(metadata.get('imgsz', '[640]'))[0]
+        # None if the model was exported with dynamic batch size
+        self.batch_size = batch if isinstance(batch, int) else None
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='onnx')
+
+
+_MODELS: Dict[tuple, OnnxModel] = {}
+
+
+async def get_onnx_model(path: str, intra_op_threads: int, workers: int) -> OnnxModel:
+    key = (path, intra_op_threads, workers)
+    if key not in _MODELS:
+        _MODELS[key] = await asyncio.to_thread(OnnxModel, path, intra_op_threads, workers)
+    return _MODELS[key]
+
+
+class OnnxClient(InferenceClient):
+    """
+    Infer images in this process on CPU by an ONNX model exported from YOLOv8, without an inference server.
+    Images are batched and run in a thread pool, and each run uses `intra_op_threads` threads.
+    It needs `numpy` and `onnxruntime` to be installed.
+    """
+    def __init__(self, config: dict, cache: Optional[PredictionCache] = None):
+        super().__init__(config, cache)
+        if onnxruntime is None:
+            raise OperationError('onnxruntime and numpy should be installed to use the onnx inference backend')
+        if not self.model_path or not os.path.exists(self.model_path):
+            raise OperationError(f'ONNX model {self.model_path} does not exist')
+
+    @property
+    def required_configs(self):
+        return ['onnx']
+
+    @property
+    def _onnx_config(self) -> dict:
+        return self._config.get('onnx') or {}
+
+    @property
+    def model_path(self) -> Optional[str]:
+        return self._onnx_config.get('model_path')
+
+    @property
+    def intra_op_threads(self) -> int:
+        return int(self._onnx_config.get('intra_op_threads') or DEFAULT_INTRA_OP_THREADS)
+
+    @property
+    def workers(self) -> int:
+        """
+        Number of batches run at once
+        """
+        return int(self._onnx_config.get('workers') or DEFAULT_WORKERS)
+
+    @property
+    def confidence(self) -> float:
+        confidence = self._onnx_config.get('confidence')
+        return DEFAULT_CONFIDENCE if confidence in (None, '') else float(confidence)
+
+    @property
+    def iou(self) -> float:
+        iou = self._onnx_config.get('iou')
+        return DEFAULT_IOU if iou in (None, '') else float(iou)
+
+    def _run(self, model: OnnxModel, items: List[Tuple[ImageRead, Location]]) -> List[List[dict]]:
+        """
+        Predict a batch of images in the way of the YOLOv8 handler. It blocks, so run it in the thread pool of the model
+        :return: list of regions per image whose boxes are in pixels of the original image
+        """
+        inputs = [letterbox(location, model.imgsz) for _, location in items]
+        batch = np.stack([o[0] for o in inputs]).astype(np.float32) / 255
+        if model.batch_size is not None and len(items) < model.batch_size:
+            # a model exported with a fixed batch size only runs full batches, so pad a partial one with blank images
+            padding = np.full((model.batch_size - len(items), *batch.shape[1:]), _PAD_COLOR / 255, dtype=np.float32)
+            batch = np.concatenate([batch, padding])
+        # outputs of the padding are dropped
+        outputs = model.session.run(None, {model.input_name: batch})[0][:len(items)]
+
+        predictions = []
+        for (image, _), (_, scale, (left, top)), output in zip(items, inputs, outputs):
+            boxes, scores, classes = detect(output, self.confidence, self.iou)
+            boxes = (boxes - [left, top, left, top]) / scale
+            boxes = np.clip(boxes, 0, [image.width, image.height, image.width, image.height])
+            predictions.append([{'name': model.names.get(int(c), str(int(c))), 'class': int(c),
+                                 'confidence': float(s),
+                                 'box': {'x1': float(b[0]), 'y1': float(b[1]), 'x2': float(b[2]), 'y2': float(b[3])}}
+                                for b, s, c in zip(boxes, scores, classes)])
+        return predictions
+
+    async def _predictor(self):
+        model = await get_onnx_model(self.model_path, self.intra_op_threads, self.workers)
+        batch_size = model.batch_size or max(1, int(self._config.get('batch_size') or 1))
+        max_wait = self._config.get('batch_max_wait')
+        max_wait = DEFAULT_BATCH_MAX_WAIT if max_wait in (None, '') else float(max_wait)
+        loop = asyncio.get_running_loop()
+
+        async def send(items: List[Tuple[ImageRead, Location]]) -> List[List[dict]]:
+            return await loop.run_in_executor(model.executor, self._run, model, items)
+
+        batcher = PredictionBatcher(send, batch_size, max_wait, split=lambda e: True)
+
+        async def predict(item: Tuple[ImageRead, Location]):
+            image, location = item
+            return self._parse_response(image, await batcher.predict(image, location))
+
+        return self._isolate(predict), self.workers * batch_size
+
+    async def infer(self, images: List[Tuple[ImageRead, Location]]) -> \
+            List[Tuple[int, BBoxBase, Optional[LabelBase]]]:
+        predict, concurrency = await self._predictor()
+        predictions = await ordered_map(predict, images, tasks=concurrency)
+        return [o for prediction in predictions if prediction is not None for o in prediction]
+
+    async def infer_stream(self, images: AsyncIterable[Tuple[ImageRead, Location]]) -> \
+            AsyncIterator[Tuple[Tuple[ImageRead, Location], List[Tuple[int, BBoxBase, Optional[LabelBase]]]]]:
+        predict, concurrency = await self._predictor()
+        async for item, prediction in as_completed_map(predict, images, tasks=concurrency):
+            if prediction is not None:
+                yield item, prediction
@@ -1,57 +1,200 @@
 import logging
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from config import CONFIG
-from common.exceptions import ParameterError
+from common.circuitbreaker import CircuitOpenError
+from common.exceptions import ParameterError, ParameterValueError, OperationError
 from database.core import get_session
+from app.file.models import File
+from app.file.progress import PROGRESS
 from app.file.schemas import FileRead, FileUpdate
 from app.file.service import update as update_file
-from app.image.service import get_all as get_images
+from app.image.service import count as count_images, count_uninferred, count_failed, get_uninferred, mark_failed, \
+    mark_inferred, reset_inferred
 from app.image.schemas import ImageRead
-from app.image.utils import get_image_file_path
-from app.bbox.service import insert as insert_bboxes
+from app.image.storage import IMAGE_STORAGE
+from app.bbox.schemas import BBoxBase
+from app.bbox.service import insert as insert_bboxes, count as count_bboxes, get_reviewed, delete_unreviewed
+from app.bbox.utils import iou
+from app.label.schemas import LabelBase
 from app.label.service import insert as insert_labels
-from .utils import TorchServeClient
+from app.model_serving.state import get_served_model
+from .cache import PREDICTION_CACHE, PredictionCache
+from .onnx_client import OnnxClient
+from .utils import InferenceClient, TorchServeClient
+
+DEFAULT_CHUNK_SIZE = 256
+INFERENCE_BACKENDS = {'torchserve': TorchServeClient, 'onnx': OnnxClient}
+# a prediction overlapping a reviewed bbox this much is regarded as the same object
+REVIEWED_IOU_THRESHOLD = 0.5
+
+
+def chunk_size() -> int:
+    """
+    Number of images inferred and saved at once, which bounds memory used by inference of a file
+    """
+    return int((CONFIG.get('inference_server') or {}).get('chunk_size') or DEFAULT_CHUNK_SIZE)
+
+
+def create_inference_client(config: Optional[dict] = None,
+                            cache: Optional[PredictionCache] = None) -> InferenceClient:
+    """
+    :param config: `inference_server` of the config by default
+    :param cache: cache of predictions, e.g. `PREDICTION_CACHE`. Predictions are not cached by default
+    :return: client of the backend chosen by `backend` of the config, which is `torchserve` by default
+    """
+    config = config or CONFIG['inference_server']
+    backend = config.get('backend') or 'torchserve'
+    if backend not in INFERENCE_BACKENDS:
+        raise ParameterValueError(key='inference_server.backend', value=backend, choice=list(INFERENCE_BACKENDS))
+    return INFERENCE_BACKENDS[backend](config=config, cache=cache)
 
 
-async def infer(file: FileRead):
-    inference_images = []
+def inference_error(e: Exception) -> str:
+    """
+    :return: error of a file whose inference stopped by `e`
+    """
+    if isinstance(e, CircuitOpenError):
+        return 'Inference server is unavailable'
+    return 'Failed to get inference result'
 
+
+async def infer(file: FileRead, replace: bool = False):
+    """
+    Infer images of a file which are not inferred yet, chunk by chunk.
+    Predictions of a chunk are saved before the next chunk is inferred,
+    so a failure or a restart loses at most a chunk and inference resumes at the next uninferred image.
+    Images which failed to be inferred are marked with the reason and left not inferred
+    so that `reinfer_failed` infers them again, while the other images go on.
+    Inferred and persisted images are counted by chunk in `app.file.progress`.
+    :param replace: whether to replace unreviewed bboxes of the images with new predictions
+    """
+    model = get_served_model()
     async for session in get_session():
-        db_images = await get_images(session, file.id)
-        for db_image in db_images:
-            image_ = ImageRead.from_orm(db_image)
-            db_image_path = get_image_file_path(image_.hash)
-            inference_images.append((image_, db_image_path))
-
-        if not inference_images:
-            file.cnt_bbox = 0
-        else:
-            try:
-                inference_client = TorchServeClient(config=CONFIG['inference_server'])
+        last_image_id = 0
+        inference_client = None
+        progress = PROGRESS.start(file.id)
+        try:
+            progress.total = await count_uninferred(session, file.id)
+            inference_client = create_inference_client(cache=PREDICTION_CACHE)
+            while True:
+                db_images = await get_uninferred(session, file.id, after_id=last_image_id, limit=chunk_size())
+                if not db_images:
+                    break
+                last_image_id = db_images[-1].id
+                inference_images = []
+                for db_image in db_images:
+                    image_ = ImageRead.from_orm(db_image)
+                    inference_images.append((image_, IMAGE_STORAGE.locate(image_.hash)))
                 result = await inference_client.infer(inference_images)
-            except Exception as e:
-                file.cnt_bbox = -1
-                file.error = f'Failed to get inference result'
-                logging.critical(f'Failed to get inference result. reason: {e}')
-            else:
+                failures = inference_client.take_failures()
+                inferred_ids = [o.id for o, _ in inference_images if o.id not in failures]
+                progress.add('inferred', len(inferred_ids))
+                progress.skip(len(failures))
+                await persist(session, result, image_ids=inferred_ids, model=model, replace=replace)
+                await mark_failed(session, failures)
+                progress.add('persisted', len(inferred_ids))
+        except Exception as e:
+            await session.rollback()
+            file.cnt_bbox = -1
+            file.error = inference_error(e)
+            logging.critical(f'Failed to get inference result of file {file.id}. reason: {e}')
+            # images which failed before inference stopped, e.g. when the circuit opened in the middle of a chunk
+            if inference_client is not None:
                 try:
-                    db_bboxes = await insert_bboxes(session=session, pairs=[(o[0], o[1]) for o in result])
-                    file.cnt_bbox = len(db_bboxes)
-                except Exception as e:
-                    file.cnt_bbox = -1
-                    file.error = 'Failed to insert bboxes'
-                    logging.critical(f'Failed to insert bboxes of file {file.id}. reason: {e}')
-                else:
-                    try:
-                        await insert_labels(session=session,
-                                            pairs=[(db_bboxes[i].id, result[i][2]) for i in range(len(result))
-                                                   if db_bboxes[i] and result[i][2]])
-                    except Exception as e:
-                        file.error = 'Failed to insert labels'
-                        logging.critical(f'Failed to insert labels of file {file.id}. reason: {e}')
+                    await mark_failed(session, inference_client.take_failures())
+                except Exception as mark_error:
+                    await session.rollback()
+                    logging.critical(f'Failed to record images which failed to be inferred. reason: {mark_error}')
+        else:
+            # bboxes saved before a restart are counted as well
+            file.cnt_bbox = await count_bboxes(session, file.id)
+        file.cnt_inference_failure = await count_failed(session, file.id)
 
+        if inference_client is not None:
+            file.cnt_cached_prediction = (file.cnt_cached_prediction or 0) + inference_client.cache_hits
+        if file.cnt_image is None:
+            file.cnt_image = await count_images(session, file.id)
+        PROGRESS.finish(file.id, error=file.error)
         try:
             await update_file(session, FileUpdate(**file.dict()))
         except ParameterError as e:
             logging.critical(f'Failed to update file {file.id}. reason: {e}')
             return
+
+
+async def reinfer(file: FileRead):
+    """
+    Infer a file again with the served model. Images which were inferred by the served model are skipped,
+    and unreviewed bboxes of the others are replaced with new predictions while reviewed bboxes are kept.
+    """
+    model = get_served_model()
+    if model is None:
+        raise OperationError('No model is served by the inference server')
+    async for session in get_session():
+        cnt_image = await reset_inferred(session, file.id, model)
+        logging.info(f'Re-infer {cnt_image} images of file {file.id} with model {model[0]} {model[1]}')
+        file.cnt_bbox = None
+        file.error = None
+        await update_file(session, FileUpdate(**file.dict()))
+    await infer(file, replace=True)
+
+
+async def reinfer_failed(file: FileRead):
+    """
+    Infer images of a file again which failed to be inferred, e.g. after the inference server recovers.
+    Images which were inferred are not sent again.
+    """
+    async for session in get_session():
+        cnt_image = await count_uninferred(session, file.id)
+        logging.info(f'Re-infer {cnt_image} images of file {file.id} which failed to be inferred')
+        file.cnt_bbox = None
+        file.error = None
+        await update_file(session, FileUpdate(**file.dict()))
+    await infer(file, replace=True)
+
+
+async def resume():
+    """
+    Resume inference of files which were being processed when the server stopped
+    """
+    async for session in get_session():
+        files = list(await session.scalars(
+            select(File).where(File.deleted_at.is_(None), File.cnt_bbox.is_(None), File.cnt_url > 0)))
+    for file in files:
+        logging.info(f'Resume inference of file {file.id}')
+        await infer(file)
+
+
+async def persist(session: AsyncSession, result: List[Tuple[int, BBoxBase, Optional[LabelBase]]],
+                  image_ids: Optional[List[int]] = None, model: Optional[Tuple[str, str]] = None,
+                  replace: bool = False) -> int:
+    """
+    Insert predicted bboxes and their labels, and mark images as inferred.
+    Bboxes are deduplicated by their coordinates, so saving predictions of an image again is harmless.
+    :param image_ids: ids of the inferred images including ones without any prediction
+    :param model: tuple(name, version) of the model which predicted them
+    :param replace: whether to delete unreviewed bboxes of the images first.
+                    Predictions overlapping reviewed bboxes are dropped not to duplicate them.
+    :return: number of inserted bboxes
+    """
+    image_ids = image_ids or []
+    if replace and image_ids:
+        await delete_unreviewed(session, image_ids, commit=False)
+        reviewed = {}
+        for db_bbox in await get_reviewed(session, image_ids):
+            reviewed.setdefault(db_bbox.image_id, []).append(
+                BBoxBase(rx1=db_bbox.rx1, ry1=db_bbox.ry1, rx2=db_bbox.rx2, ry2=db_bbox.ry2))
+        result = [o for o in result
+                  if all(iou(o[1], bbox) < REVIEWED_IOU_THRESHOLD for bbox in reviewed.get(o[0], []))]
+
+    db_bboxes = await insert_bboxes(session=session, pairs=[(o[0], o[1]) for o in result], model=model)
+    await insert_labels(session=session,
+                        pairs=[(db_bboxes[i].id, result[i][2]) for i in range(len(result))
+                               if db_bboxes[i] and result[i][2]],
+                        model=model)
+    await mark_inferred(session, image_ids, model=model)
+    return sum(o is not None for o in db_bboxes)
@@ -1,35 +1,214 @@
-import aiofiles
-import grpc
+import asyncio
 import json
+import logging
+import random
 
 from abc import ABC, abstractmethod
-from typing import List, Tuple, Optional
+from typing import Dict, List, Tuple, Optional, Callable, Awaitable, AsyncIterable, AsyncIterator
+import grpc
 from google.protobuf import empty_pb2
 
+from common.aiopool import ordered_map, as_completed_map
+from common.circuitbreaker import CircuitBreaker, CircuitOpenError, get_circuit_breaker, \
+    DEFAULT_FAILURE_THRESHOLD, DEFAULT_COOLDOWN
+from common.grpcpool import ChannelPool, get_channel_pool, DEFAULT_SUB_CHANNELS, DEFAULT_HEALTH_CHECK_INTERVAL
 from common.exceptions import OperationError
+from app.utils import cpu_pool
 from app.image.schemas import ImageRead
+from app.image.pyramid import read_image_size, render_variants
+from app.image.storage import IMAGE_STORAGE, Location, async_read_location, location_reference, variant_key
 from app.bbox.schemas import BBoxBase
 from app.label.schemas import LabelBase
 from app.model_inference import inference_pb2
+from app.model_inference.cache import PredictionCache
 from app.model_inference.inference_pb2_grpc import InferenceAPIsServiceStub
+from app.model_serving.state import get_served_model
+
+DEFAULT_MAX_IN_FLIGHT = 8
+DEFAULT_BATCH_MAX_WAIT = 0.05
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_BACKOFF = 0.5
+MAX_RETRY_BACKOFF = 10.0
+# errors of the server or the network rather than of images, which may pass if requests are sent again
+TRANSIENT_CODES = {grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED,
+                   grpc.StatusCode.RESOURCE_EXHAUSTED, grpc.StatusCode.ABORTED}
+# input of a request to ask the handler for its optional features instead of predictions
+CAPABILITIES_INPUT_KEY = 'capabilities'
+REFERENCE_CAPABILITY = 'reference'
+# whether handlers read images by reference, by tuple(address, model, served model)
+_REFERENCE_CAPABLE: Dict[tuple, bool] = {}
+
+
+def batch_input_key(index: int, prefix: str = 'data') -> str:
+    """
+    Key of the `index`-th image in the input of a multi-image `PredictionsRequest`.
+    `prefix` is "ref" for references of images instead of their bytes
+    """
+    return f'{prefix}_{index}'
+
+
+def is_transient(e: Exception) -> bool:
+    return isinstance(e, grpc.aio.AioRpcError) and e.code() in TRANSIENT_CODES
+
+
+def error_reason(e: Exception) -> str:
+    """
+    :return: a line about why a request failed, while errors of gRPC are printed in many lines
+    """
+    if isinstance(e, grpc.aio.AioRpcError):
+        return f'{e.code().name}: {e.details()}'
+    return str(e) or repr(e)
+
+
+class PredictionBatcher:
+    """
+    Pack images submitted one by one into multi-image requests.
+    A batch is sent when it has `batch_size` images or `max_wait` seconds have passed since its first image,
+    and its predictions are handed back to each waiting image.
+    """
+    def __init__(self, send: Callable[[List[Tuple[ImageRead, Location]]], Awaitable[List[List[dict]]]],
+                 batch_size: int, max_wait: float, split: Optional[Callable[[Exception], bool]] = None):
+        """
+        :param send: coroutine function to send a batch, which returns a prediction per image in the order of the batch
+        :param split: function which tells whether images of a batch failed by an error should be sent one by one,
+                      so that only images causing the error fail instead of the whole batch
+        """
+        if batch_size < 1:
+            raise ValueError("Batch size must be at least 1")
+        self._send = send
+        self._batch_size = batch_size
+        self._max_wait = max_wait
+        self._split = split
+        self._pending: List[Tuple[Tuple[ImageRead, Location], asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._sending = set()
+
+    async def predict(self, image: ImageRead, location: Location) -> List[dict]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append(((image, location), future))
+        if len(self._pending) >= self._batch_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self._max_wait, self.flush)
+        return await future
+
+    def flush(self):
+        """
+        Send pending images now even if the batch is not full
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._send_batch(batch))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send_batch(self, batch: List[Tuple[Tuple[ImageRead, Location], asyncio.Future]]):
+        try:
+            predictions = await self._send([item for item, _ in batch])
+            if len(predictions) != len(batch):
+                raise OperationError(f"{len(predictions)} predictions are returned for {len(batch)} images")
+        except Exception as e:
+            if len(batch) > 1 and self._split is not None and self._split(e):
+                logging.warning(f'Failed to infer a batch of {len(batch)} images. '
+                                f'They are inferred one by one. reason: {error_reason(e)}')
+                await asyncio.gather(*(self._send_batch([o]) for o in batch))
+                return
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        else:
+            for (_, future), prediction in zip(batch, predictions):
+                if not future.done():
+                    future.set_result(prediction)
 
 
 class InferenceClient(ABC):
-    def __init__(self, config: dict):
+    def __init__(self, config: dict, cache: Optional[PredictionCache] = None):
+        """
+        :param cache: cache of predictions which images are looked up in before they are inferred. None not to cache
+        """
         missing_configs = set(self.required_configs) - set(config.keys())
         if missing_configs:
             raise KeyError(f'Missing required configuration parameters: {missing_configs}')
         self._config = config
+        self._cache = cache
+        # number of images of which predictions came from the cache instead of the inference server
+        self.cache_hits = 0
+        # reasons why images failed to be inferred by image id. They are left out of results instead of failing the rest
+        self.failures: Dict[int, str] = {}
 
     @property
     def required_configs(self):
         return []
 
     @abstractmethod
-    async def infer(self, images: List[Tuple[ImageRead, str]]) -> \
+    async def infer(self, images: List[Tuple[ImageRead, Location]]) -> \
             List[Tuple[int, BBoxBase, Optional[LabelBase]]]:
+        """
+        Images which failed are left out of the result, and they are recorded in `failures`
+        :return: list of tuple(image id, bbox, label) of the inferred images
+        """
         pass
 
+    async def infer_stream(self, images: AsyncIterable[Tuple[ImageRead, Location]]) -> \
+            AsyncIterator[Tuple[Tuple[ImageRead, Location], List[Tuple[int, BBoxBase, Optional[LabelBase]]]]]:
+        """
+        Infer images as they arrive, which may be before all images are known.
+        Images which failed are left out, and they are recorded in `failures`.
+        :return: tuple(item of images, its predictions) as soon as each image is inferred,
+                 which may be out of the order of images
+        """
+        async for item in images:
+            predictions = await self.infer([item])
+            if item[0].id not in self.failures:
+                yield item, predictions
+
+    def take_failures(self) -> Dict[int, str]:
+        """
+        :return: failures recorded since the previous call
+        """
+        failures, self.failures = self.failures, {}
+        return failures
+
+    def _isolate(self, predict: Callable[[Tuple[ImageRead, Location]], Awaitable[list]]) -> \
+            Callable[[Tuple[ImageRead, Location]], Awaitable[Optional[list]]]:
+        """
+        Make a failure of an image affect only the image. It is recorded in `failures` and its result is None.
+        Images still fail together when the circuit to the inference server is open,
+        because the rest of them would fail as well.
+        """
+        async def isolated(item: Tuple[ImageRead, Location]) -> Optional[list]:
+            try:
+                return await predict(item)
+            except CircuitOpenError:
+                raise
+            except Exception as e:
+                image, _ = item
+                self.failures[image.id] = error_reason(e)[:255]
+                logging.warning(f'Failed to infer image {image.id}. reason: {self.failures[image.id]}')
+                return None
+
+        return isolated
+
+    @staticmethod
+    def _parse_response(image: ImageRead, response: List[dict]) -> List[Tuple[int, BBoxBase, Optional[LabelBase]]]:
+        """
+        :param response: regions of an image in the format of the YOLOv8 handler, whose boxes are in pixels
+        """
+        result = []
+        for region in response:
+            base_bbox = BBoxBase(rx1=region['box']['x1'] / image.width,
+                                 ry1=region['box']['y1'] / image.height,
+                                 rx2=region['box']['x2'] / image.width,
+                                 ry2=region['box']['y2'] / image.height)
+
+            result.append((image.id, base_bbox, LabelBase(region=region['name'])))
+        return result
+
 
 class TorchServeClient(InferenceClient):
     @property
@@ -44,23 +223,256 @@ class TorchServeClient(InferenceClient):
     def management_addr(self):
         return f"{self._config['host']}:{self._config['grpc_management_port']}"
 
-    async def infer(self, images: List[Tuple[ImageRead, str]]) -> \
-            List[Tuple[int, BBoxBase, Optional[LabelBase]]]:
-        async with grpc.aio.insecure_channel(
+    @property
+    def max_in_flight(self) -> int:
+        """
+        Maximum number of requests sent concurrently over the channel
+        """
+        return int(self._config.get('max_in_flight') or DEFAULT_MAX_IN_FLIGHT)
+
+    @property
+    def batch_size(self) -> int:
+        """
+        Number of images packed into a request. Batching of TorchServe should be enabled with the same size
+        """
+        return max(1, int(self._config.get('batch_size') or 1))
+
+    @property
+    def batch_max_wait(self) -> float:
+        """
+        Seconds to wait for a batch to be filled before it is sent anyway
+        """
+        max_wait = self._config.get('batch_max_wait')
+        return DEFAULT_BATCH_MAX_WAIT if max_wait in (None, '') else float(max_wait)
+
+    @property
+    def input_size(self) -> Optional[int]:
+        """
+        Long edge size which images are downsized to before they are sent, e.g. `imgsz` of the model.
+        None to send original images
+        """
+        size = self._config.get('input_size')
+        return int(size) if size else None
+
+    @property
+    def read_by_reference(self) -> bool:
+        """
+        Whether to send references of images instead of their bytes when the handler supports it,
+        which needs the inference server to mount the data directory and set LAP_PATH_DATA of the handler to it
+        """
+        return bool(self._config.get('read_by_reference'))
+
+    @property
+    def retries(self) -> int:
+        """
+        Times to send a request again after it fails by a transient error
+        """
+        retries = self._config.get('retries')
+        return DEFAULT_RETRIES if retries in (None, '') else int(retries)
+
+    @property
+    def retry_backoff(self) -> float:
+        """
+        Seconds to wait before the first retry, which is doubled for each next retry
+        """
+        backoff = self._config.get('retry_backoff')
+        return DEFAULT_RETRY_BACKOFF if backoff in (None, '') else float(backoff)
+
+    @property
+    def circuit_breaker(self) -> CircuitBreaker:
+        """
+        Circuit breaker of the inference server shared by all clients in the process
+        """
+        return get_circuit_breaker(
             self.inference_addr,
-            options=[('grpc.max_send_message_length', 100 * 1024 * 1024),
-                     ('grpc.max_receive_message_length', 100 * 1024 * 1024)]
-        ) as channel:
-            client = InferenceAPIsServiceStub(channel)
+            failure_threshold=int(self._config.get('circuit_breaker_threshold') or DEFAULT_FAILURE_THRESHOLD),
+            cooldown=float(self._config.get('circuit_breaker_cooldown') or DEFAULT_COOLDOWN))
+
+    @property
+    def channel_pool(self) -> ChannelPool:
+        """
+        Channels to the inference server shared by all clients in the process
+        """
+        return get_channel_pool(
+            self.inference_addr,
+            size=int(self._config.get('channels') or DEFAULT_SUB_CHANNELS),
+            health_check=lambda channel: self._ping(InferenceAPIsServiceStub(channel)),
+            health_check_interval=float(self._config.get('health_check_interval') or DEFAULT_HEALTH_CHECK_INTERVAL))
+
+    @property
+    def concurrency(self) -> int:
+        """
+        Number of images submitted at once to fill all requests in flight
+        """
+        return self.max_in_flight * self.batch_size
+
+    async def _predictor(self) -> \
+            Callable[[Tuple[ImageRead, Location]], Awaitable[List[Tuple[int, BBoxBase, Optional[LabelBase]]]]]:
+        """
+        :return: coroutine function to infer an image, which packs images awaited together into batched requests
+        """
+        pool = self.channel_pool
+        breaker = self.circuit_breaker
+        # health is checked in the background once the pool is in use, so check here only if it is not known healthy
+        if not pool.healthy and not await pool.check():
+            raise OperationError(f"Inference server {self.inference_addr} is not healthy")
+
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        cache = self._cache if self._cache is not None and self._cache.model() is not None else None
+        by_reference = self.read_by_reference and await self._reference_capable(pool)
+
+        async def send(items: List[Tuple[ImageRead, Location]]) -> List[List[dict]]:
+            predictions = await self._get_cached(cache, items)
+            misses = [o for o in items if o[0].hash not in predictions]
+            if misses:
+                inputs = await asyncio.gather(*(self._prepare_input(image, location) for image, location in misses))
+                new_predictions = await self._send_with_retry(
+                    pool, breaker, in_flight, [(image, location) for (image, _), (location, _) in zip(misses, inputs)],
+                    by_reference=by_reference)
+                if len(new_predictions) != len(misses):
+                    raise OperationError(f"{len(new_predictions)} predictions are returned for {len(misses)} images")
+                # cached predictions are in coordinates of original images whatever size they were predicted in
+                new_predictions = {image.hash: self._scale_response(image, o, size)
+                                   for (image, _), o, (_, size) in zip(misses, new_predictions, inputs)}
+                await self._put_cached(cache, new_predictions)
+                predictions.update(new_predictions)
+            self.cache_hits += len(items) - len(misses)
+            return [predictions[image.hash] for image, _ in items]
+
+        # errors of the server fail the images of a batch anyway, so only errors of images are worth splitting batches
+        batcher = PredictionBatcher(send, self.batch_size, self.batch_max_wait,
+                                    split=lambda e: not is_transient(e) and not isinstance(e, CircuitOpenError))
+
+        async def predict(item: Tuple[ImageRead, Location]):
+            image, location = item
+            prediction = await batcher.predict(image, location)
+            return self._parse_response(image, prediction)
+
+        return self._isolate(predict)
+
+    async def _send_with_retry(self, pool: ChannelPool, breaker: CircuitBreaker, in_flight: asyncio.Semaphore,
+                               items: List[Tuple[ImageRead, Location]], by_reference: bool) -> List[List[dict]]:
+        """
+        Send a request, and send it again with exponential backoff as long as it fails by a transient error.
+        Transient errors count toward opening the circuit, and the request fails fast while it is open.
+        """
+        for attempt in range(self.retries + 1):
+            await breaker.wait()
+            try:
+                async with in_flight:
+                    client = InferenceAPIsServiceStub(pool.channel())
+                    predictions = await self._send_request(client, self._config['project'], items,
+                                                           by_reference=by_reference)
+            except Exception as e:
+                if not is_transient(e):
+                    # the server answered, so it is healthy even if the request failed
+                    breaker.success()
+                    raise
+                breaker.failure()
+                if attempt == self.retries:
+                    raise
+                delay = min(MAX_RETRY_BACKOFF, self.retry_backoff * 2 ** attempt) * random.uniform(0.5, 1.5)
+                logging.info(f'Retry a request of {len(items)} images in {delay:.2f} seconds. reason: {e.code()}')
+                await asyncio.sleep(delay)
+            else:
+                breaker.success()
+                return predictions
+
+    async def infer(self, images: List[Tuple[ImageRead, Location]]) -> \
+            List[Tuple[int, BBoxBase, Optional[LabelBase]]]:
+        predict = await self._predictor()
+        # results are kept in the order of images
+        predictions = await ordered_map(predict, images, tasks=self.concurrency)
+        return [o for prediction in predictions if prediction is not None for o in prediction]
 
-            if not await self._ping(client):
-                raise OperationError(f"Inference server {self.inference_addr} is not healthy")
+    async def infer_stream(self, images: AsyncIterable[Tuple[ImageRead, Location]]) -> \
+            AsyncIterator[Tuple[Tuple[ImageRead, Location], List[Tuple[int, BBoxBase, Optional[LabelBase]]]]]:
+        predict = await self._predictor()
+        async for item, prediction in as_completed_map(predict, images, tasks=self.concurrency):
+            if prediction is not None:
+                yield item, prediction
 
-            result = []
-            for image, path in images:
-                _, prediction = await self._send_request(client, self._config['project'], image, path)
-                result.extend(self._parse_response(image, prediction))
-            return result
+    async def _prepare_input(self, image: ImageRead, location: Location) -> \
+            Tuple[Location, Optional[Tuple[int, int]]]:
+        """
+        Downsize an image to `input_size` keeping its aspect ratio, since the model resizes it to the size anyway.
+        The downsized image is stored as a variant of the image, so it is rendered once per image.
+        :return: tuple(location of the image to send, its size(width, height)). The size is None for an original image
+        """
+        size = self.input_size
+        if size is None or max(image.width, image.height) <= size:
+            return location, None
+        key = variant_key(image.hash, size)
+        variant = IMAGE_STORAGE.locate(key, not_exist_ok=True)
+        if variant is None:
+            variants = await cpu_pool.run(render_variants, location, [size])
+            if not variants:
+                return location, None
+            await IMAGE_STORAGE.write(key, variants[0][1])
+            variant = IMAGE_STORAGE.locate(key)
+        return variant, await asyncio.to_thread(read_image_size, variant)
+
+    @staticmethod
+    def _scale_response(image: ImageRead, response: List[dict], size: Optional[Tuple[int, int]]) -> List[dict]:
+        """
+        Map boxes predicted in a downsized image of `size` back to coordinates of the original image
+        """
+        if size is None:
+            return response
+        sx, sy = image.width / size[0], image.height / size[1]
+        return [{**region, 'box': {'x1': region['box']['x1'] * sx, 'y1': region['box']['y1'] * sy,
+                                   'x2': region['box']['x2'] * sx, 'y2': region['box']['y2'] * sy}}
+                for region in response]
+
+    async def _reference_capable(self, pool: ChannelPool) -> bool:
+        """
+        Ask the handler whether it reads images by reference. It is asked once for each model served.
+        Handlers which don't know the question fail to answer it with INTERNAL, so they are regarded as not capable.
+        If it can't be asked for other reasons, e.g. the server is restarting, bytes are sent and it is asked again
+        next time.
+        """
+        key = (self.inference_addr, self._config['project'], get_served_model())
+        if key not in _REFERENCE_CAPABLE:
+            request = inference_pb2.PredictionsRequest(model_name=self._config['project'],
+                                                       input={CAPABILITIES_INPUT_KEY: b''})
+            try:
+                response = await InferenceAPIsServiceStub(pool.channel()).Predictions(request)
+            except Exception as e:
+                logging.info(f'Failed to get capabilities of model {self._config["project"]}. '
+                             f'reason: {error_reason(e)}')
+                if not isinstance(e, grpc.aio.AioRpcError) or e.code() != grpc.StatusCode.INTERNAL:
+                    return False
+                capabilities = []
+            else:
+                try:
+                    capabilities = json.loads(response.prediction.decode('utf-8')).get(CAPABILITIES_INPUT_KEY) or []
+                except (ValueError, AttributeError):
+                    # the handler predicted the question as an image
+                    capabilities = []
+            _REFERENCE_CAPABLE[key] = REFERENCE_CAPABILITY in capabilities
+            if not _REFERENCE_CAPABLE[key]:
+                logging.warning(f'Handler of model {self._config["project"]} does not read images by reference.'
+                                f' Bytes of images are sent instead')
+        return _REFERENCE_CAPABLE[key]
+
+    @staticmethod
+    async def _get_cached(cache: Optional[PredictionCache], items: List[Tuple[ImageRead, Location]]) -> dict:
+        if cache is None:
+            return {}
+        try:
+            return await cache.get([image.hash for image, _ in items])
+        except Exception as e:
+            logging.warning(f'Failed to get cached predictions. reason: {e}')
+            return {}
+
+    @staticmethod
+    async def _put_cached(cache: Optional[PredictionCache], predictions: dict):
+        if cache is None:
+            return
+        try:
+            await cache.put(predictions)
+        except Exception as e:
+            logging.warning(f'Failed to cache predictions. reason: {e}')
 
     @staticmethod
     async def _ping(client) -> bool:
@@ -69,23 +481,25 @@ class TorchServeClient(InferenceClient):
         return health['status'].lower() == 'healthy'
 
     @staticmethod
-    async def _send_request(client, model, image: ImageRead, path: str):
-        async with aiofiles.open(path, 'rb') as f:
-            data = await f.read()
-        request = inference_pb2.PredictionsRequest(model_name=model,
-                                                   input={'data': data})
+    async def _send_request(client, model, items: List[Tuple[ImageRead, Location]],
+                            by_reference: bool = False) -> List[List[dict]]:
+        """
+        Send images in a request. A single image is sent as `data` like a plain request of TorchServe,
+        and many images are sent as `data_0`, `data_1`, ... which the handler predicts as a batch.
+        :param by_reference: whether to send references of images as `ref` or `ref_0`, `ref_1`, ...
+                             for the handler to read them from the shared data directory
+        :return: list of regions per image in the order of items
+        """
+        if by_reference:
+            prefix = 'ref'
+            data = [location_reference(location).encode('utf-8') for _, location in items]
+        else:
+            prefix = 'data'
+            data = await asyncio.gather(*(async_read_location(location) for _, location in items))
+        if len(data) == 1:
+            inputs = {prefix: data[0]}
+        else:
+            inputs = {batch_input_key(i, prefix): o for i, o in enumerate(data)}
+        request = inference_pb2.PredictionsRequest(model_name=model, input=inputs)
         response = await client.Predictions(request)
-        prediction = json.loads(response.prediction.decode('utf-8'))
-        return image, prediction[0]
-
-    @staticmethod
-    def _parse_response(image: ImageRead, response: List[dict]) -> List[Tuple[int, BBoxBase, Optional[LabelBase]]]:
-        result = []
-        for region in response:
-            base_bbox = BBoxBase(rx1=region['box']['x1'] / image.width,
-                                 ry1=region['box']['y1'] / image.height,
-                                 rx2=region['box']['x2'] / image.width,
-                                 ry2=region['box']['y2'] / image.height)
-
-            result.append((image.id, base_bbox, LabelBase(region=region['name'])))
-        return result
+        return json.loads(response.prediction.decode('utf-8'))
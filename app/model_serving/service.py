@@ -1,6 +1,8 @@
 from config import CONFIG
 from app.model_registry.service import download
 from app.model_registry.schemas import AssetRead
+from app.model_inference.cache import PREDICTION_CACHE
+from .state import set_served_model
 from .utils import *
 
 
@@ -23,6 +25,9 @@ async def serve(asset: AssetRead):
         await api.serve(model=asset.project or asset.model,
                         version=asset.version,
                         serialized_file=serialized_path)
+    set_served_model(asset.project or asset.model, asset.version)
+    # predictions of the previous model are not valid anymore
+    await PREDICTION_CACHE.invalidate(asset.project or asset.model, asset.version)
 
 
 async def stop(model, version, project=None):
@@ -0,0 +1,35 @@
+import json
+import os
+from typing import Optional, Tuple
+
+from config import CONFIG
+
+_served_model: Optional[Tuple[str, str]] = None
+_loaded = False
+
+
+def served_model_path() -> str:
+    return os.path.join(CONFIG['path']['data'], 'served_model.json')
+
+
+def get_served_model() -> Optional[Tuple[str, str]]:
+    """
+    :return: tuple(name, version) of the model served by the inference server. None if no model has been served
+    """
+    global _served_model, _loaded
+    if not _loaded:
+        _loaded = True
+        if os.path.exists(served_model_path()):
+            with open(served_model_path(), 'r') as f:
+                served = json.load(f)
+            _served_model = served['model'], served['version']
+    return _served_model
+
+
+def set_served_model(model: str, version: str):
+    global _served_model, _loaded
+    os.makedirs(os.path.dirname(served_model_path()), exist_ok=True)
+    with open(f'{served_model_path()}.tmp', 'w') as f:
+        json.dump({'model': model, 'version': version}, f)
+    os.replace(f'{served_model_path()}.tmp', served_model_path())
+    _served_model, _loaded = (model, version), True
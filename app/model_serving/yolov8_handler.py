@@ -1,5 +1,7 @@
 import base64
 import io
+import os
+import re
 
 import torch
 import numpy as np
@@ -13,11 +15,16 @@ from ultralytics.yolo.utils import DEFAULT_CFG, ops
 from ultralytics.yolo.cfg import get_cfg
 from ultralytics.yolo.engine.results import Boxes
 
+REFERENCE_CAPABILITY = "reference"
+_SEGMENT_RANGE = re.compile(r"(.+)@([0-9]+):([0-9]+)")
+
 
 class Yolov8Detector(VisionHandler):
 
     def initialize(self, context):
         super().initialize(context)
+        # data directory of the labeling server mounted on this host, to read images sent by reference
+        self.data_dir = os.environ.get("LAP_PATH_DATA")
         if self.model_pt_path.endswith('.onnx'):
             del self.model
             self.model = AutoBackend(self.model_pt_path, device=self.device)
@@ -50,6 +57,60 @@ class Yolov8Detector(VisionHandler):
         img /= 255  # 0 - 255 to 0.0 - 1.0
         return img
 
+    @staticmethod
+    def row_images(row, prefix="data"):
+        """Images of a request row. A multi-image request has them as `data_0`, `data_1`, ...
+
+        Args:
+            row (dict): Input of a request
+            prefix (str): "ref" for references of images instead of their bytes
+
+        Returns:
+            list : Images in the order of their indices
+        """
+        keys = [k for k in row.keys() if k.startswith(prefix + "_") and k[len(prefix) + 1:].isdigit()]
+        if keys:
+            return [row[k] for k in sorted(keys, key=lambda k: int(k[len(prefix) + 1:]))]
+        if prefix != "data":
+            return [row.get(prefix)]
+        # Compat layer: normally the envelope should just return the data
+        # directly, but older versions of Torchserve didn't have envelope.
+        return [row.get("data") or row.get("body")]
+
+    @staticmethod
+    def is_reference_row(row):
+        return any(k == "ref" or k.startswith("ref_") for k in row.keys())
+
+    def capabilities(self):
+        """Optional features of this handler, which clients ask for by a row with a `capabilities` key."""
+        return [REFERENCE_CAPABILITY] if self.data_dir else []
+
+    def read_reference(self, reference):
+        """Read an image by its path relative to the data directory,
+        which is followed by "@<offset>:<length>" for an image in a segment file.
+
+        Args:
+            reference (bytes | str): Reference of an image
+
+        Returns:
+            bytes : The image
+        """
+        if not self.data_dir:
+            raise ValueError("Images can't be read by reference without LAP_PATH_DATA")
+        if isinstance(reference, (bytes, bytearray)):
+            reference = reference.decode("utf-8")
+        matched = _SEGMENT_RANGE.fullmatch(reference)
+        path = matched.group(1) if matched else reference
+        data_dir = os.path.realpath(self.data_dir)
+        full_path = os.path.realpath(os.path.join(data_dir, path))
+        if not full_path.startswith(data_dir + os.sep):
+            raise ValueError(f"Reference {reference} is out of the data directory")
+        with open(full_path, "rb") as f:
+            if not matched:
+                return f.read()
+            f.seek(int(matched.group(2)))
+            return f.read(int(matched.group(3)))
+
     def preprocess(self, data):
         """The preprocess function of MNIST program converts the input data to a float tensor
 
@@ -60,27 +121,37 @@ class Yolov8Detector(VisionHandler):
             list : The preprocess function returns the input image as a list of float tensors.
         """
         images = []
+        # number of images of each row to split predictions back per request
+        self.images_per_row = []
 
         for row in data:
-            # Compat layer: normally the envelope should just return the data
-            # directly, but older versions of Torchserve didn't have envelope.
-            image = row.get("data") or row.get("body")
-            if isinstance(image, str):
-                # if the image is a string of bytesarray.
-                image = base64.b64decode(image)
-
-            # If the image is sent as bytesarray
-            if isinstance(image, (bytearray, bytes)):
-                image = Image.open(io.BytesIO(image))
+            if "capabilities" in row:
+                # answered by postprocess without any image
+                self.images_per_row.append(None)
+                continue
+            if self.is_reference_row(row):
+                row_images = [self.read_reference(o) for o in self.row_images(row, "ref")]
             else:
-                # if the image is a list
-                image = torch.FloatTensor(image)
-
-            images.append(image)
-
-        dataset = load_inference_source(source=images, imgsz=self.model.imgsz)
+                row_images = self.row_images(row)
+            self.images_per_row.append(len(row_images))
+            for image in row_images:
+                if isinstance(image, str):
+                    # if the image is a string of bytesarray.
+                    image = base64.b64decode(image)
+
+                # If the image is sent as bytesarray
+                if isinstance(image, (bytearray, bytes)):
+                    image = Image.open(io.BytesIO(image))
+                else:
+                    # if the image is a list
+                    image = torch.FloatTensor(image)
+
+                images.append(image)
 
         data = []
+        if not images:
+            return data
+        dataset = load_inference_source(source=images, imgsz=self.model.imgsz)
         for batch in dataset:
             _, im0s, _, _ = batch
             """Convert an image to PyTorch tensor and normalize pixel values."""
@@ -108,7 +179,7 @@ class Yolov8Detector(VisionHandler):
         return results
 
     def postprocess(self, data):
-        """Postprocesses predictions and returns a list of Results objects."""
+        """Postprocesses predictions and returns a list of detections per image for each request row."""
         args = get_cfg(DEFAULT_CFG)
         results = []
         for preds, img, orig_imgs in data:
@@ -127,8 +198,18 @@ class Yolov8Detector(VisionHandler):
                     pred[:, :4] = ops.scale_boxes(img.shape[2:], pred[:, :4], orig_img.shape)
                 boxes = Boxes(boxes=pred, orig_shape=orig_shape)
                 batch_result.append(self.yolov8_boxes_to_dict(boxes, orig_shape))
-            results.append(batch_result)
-        return results
+            results.extend(batch_result)
+
+        # images of all rows are predicted together, so regroup them by the rows they came from
+        rows = []
+        start = 0
+        for n in getattr(self, "images_per_row", [len(results)]):
+            if n is None:
+                rows.append({"capabilities": self.capabilities()})
+                continue
+            rows.append(results[start:start + n])
+            start += n
+        return rows
 
     def yolov8_boxes_to_dict(self, boxes, orig_shape, normalize=False):
         """Convert the object to JSON format."""
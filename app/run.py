@@ -6,11 +6,16 @@ from fastapi.responses import JSONResponse
 from starlette.middleware.cors import CORSMiddleware
 
 from config import CONFIG
-from database.core import create_engine, create_tables, dispose_engine
-from common.exceptions import ParameterError, ParameterNotFoundError, OperationError
+from database.core import create_engine, create_tables, dispose_engine, get_session
+from common.exceptions import ParameterError, ParameterNotFoundError, ParameterConflictError, OperationError
+from common.grpcpool import close_channel_pools
 
-from app.file.views import router as file_router
+from app.file.views import router as file_router, purge_deleted_files
 from app.image.views import router as image_router
+from app.image.gc import IMAGE_GC
+from app.image.pyramid import PYRAMID_BACKFILL
+from app.image.phash import NEAR_DUPLICATES
+from app.image.storage import IMAGE_STORAGE
 from app.bbox.views import router as bbox_router
 from app.label.views import router as label_router
 from app.export.views import router as export_router
@@ -18,8 +23,9 @@ from app.model_registry.views import router as model_registry_router
 from app.model_serving.views import router as model_serving_router
 from app.model_registry.service import get_all as get_models
 from app.model_serving.service import serve as serve_model
+from app.model_inference.service import resume as resume_inference
 from app.label.utils import load_labels
-from app.utils import create_directories
+from app.utils import create_directories, cpu_pool, run_in_background
 
 app = FastAPI()
 
@@ -30,6 +36,8 @@ async def add_exception_handler(request: Request, call_next):
         response = await call_next(request)
     except ParameterNotFoundError as e:
         return JSONResponse(status_code=404, content={'detail': str(e)})
+    except ParameterConflictError as e:
+        return JSONResponse(status_code=409, content={'detail': str(e)})
     except ParameterError as e:
         return JSONResponse(status_code=400, content={'detail': str(e)})
     except OperationError as e:
@@ -53,6 +61,14 @@ async def startup_event():
     await create_tables(drop=CONFIG.get('clear', False))
     create_directories(drop=CONFIG.get('clear', False))
     load_labels(dir_name=CONFIG['path']['label'])
+    if NEAR_DUPLICATES is not None:
+        async for session in get_session():
+            await NEAR_DUPLICATES.load(session)
+    run_in_background(purge_deleted_files())
+    run_in_background(resume_inference())
+    run_in_background(IMAGE_GC.run_periodically())
+    if PYRAMID_BACKFILL.pending():
+        run_in_background(PYRAMID_BACKFILL.run())
     assets = await get_models()
     if assets:
         latest_asset = max(assets, key=lambda o: o.version)
@@ -65,6 +81,9 @@ async def startup_event():
 @app.on_event("shutdown")
 def shutdown_event():
     print('shutdown')
+    cpu_pool.shutdown()
+    IMAGE_STORAGE.close()
+    asyncio.get_event_loop().create_task(close_channel_pools())
     asyncio.get_event_loop().create_task(dispose_engine())
 
 
@@ -1,17 +1,33 @@
+import asyncio
 import os
 import shutil
 
 from config import CONFIG
+from common.cpupool import CPUPool
 
 file_dir = os.path.join(CONFIG['path']['data'], 'files')
 image_dir = os.path.join(CONFIG['path']['data'], 'images')
 export_dir = os.path.join(CONFIG['path']['data'], 'exports')
+cache_dir = os.path.join(CONFIG['path']['data'], 'cache')
+
+cpu_pool = CPUPool(int(CONFIG['cpu_workers']) if CONFIG.get('cpu_workers') else None)
 
 
 def create_directories(drop=False):
-    for target_dir in [file_dir, image_dir, export_dir]:
+    for target_dir in [file_dir, image_dir, export_dir, cache_dir]:
         if not os.path.exists(target_dir):
             os.makedirs(target_dir)
         elif drop:
             shutil.rmtree(target_dir)
             os.makedirs(target_dir)
+
+
+# references to background tasks, which would be garbage-collected while running otherwise
+_background_tasks = set()
+
+
+def run_in_background(coro) -> asyncio.Task:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
@@ -0,0 +1,134 @@
+import asyncio
+import json
+import os
+import random
+from typing import Callable, Optional
+
+import grpc
+
+from app.model_inference import inference_pb2
+from app.model_inference.inference_pb2_grpc import InferenceAPIsServiceServicer, \
+    add_InferenceAPIsServiceServicer_to_server
+
+
+LATENCY_DISTRIBUTIONS = ['uniform', 'normal', 'exponential']
+
+
+class FakeTorchServe(InferenceAPIsServiceServicer):
+    """
+    Fake of the gRPC inference API of TorchServe to measure inference clients without a GPU.
+    It returns `detections` detections per image, the first of which is (0, 0, bytes of image, bytes of image),
+    so that clients can check that predictions are paired with the right images.
+    Multi-image requests(`data_0`, `data_1`, ...) are predicted as a batch,
+    which takes `batch_cost` of the latency for each image after the first one.
+    """
+    def __init__(self, latency: float = 0.0, jitter: float = 0.0, workers: int = 8, region: str = 'top',
+                 data_dir: str = None, distribution: str = 'uniform', error_rate: float = 0.0,
+                 batch_cost: float = 0.0, max_batch_size: int = None, detections: int = 1, outages: int = 0,
+                 broken: Optional[Callable[[bytes], bool]] = None):
+        """
+        :param latency: seconds to predict an image
+        :param jitter: spread of latency in seconds by `distribution`
+        :param workers: number of requests processed at once, like workers of TorchServe
+        :param data_dir: data directory to read images sent by reference(`ref`, `ref_0`, ...) like the handler
+        :param distribution: uniform: within +-jitter of latency. normal: standard deviation of jitter.
+                             exponential: latency plus a long tail whose mean is jitter
+        :param error_rate: ratio of requests which fail with INTERNAL, like a handler raising an exception
+        :param batch_cost: ratio of latency added by each image of a batch after the first one.
+                           0 predicts a batch in the time of an image, and 1 in the time of images one by one
+        :param max_batch_size: requests with more images fail with INVALID_ARGUMENT
+        :param outages: number of the first requests which fail with UNAVAILABLE, like a server restarting
+        :param broken: function which tells whether bytes of an image can't be decoded.
+                       Requests with such an image fail with INTERNAL, like a handler raising an exception
+        """
+        if distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f'distribution should be one of {LATENCY_DISTRIBUTIONS}')
+        self._latency = latency
+        self._jitter = jitter
+        self._workers = asyncio.Semaphore(workers)
+        self._region = region
+        self._data_dir = data_dir
+        self._distribution = distribution
+        self._error_rate = error_rate
+        self._batch_cost = batch_cost
+        self._max_batch_size = max_batch_size
+        self._detections = detections
+        self._outages = outages
+        self._broken = broken
+        self.requests = 0
+        self.images = 0
+        self.references = 0
+        self.errors = 0
+        self.pings = 0
+
+    def sample_latency(self, images: int = 1) -> float:
+        if self._distribution == 'normal':
+            latency = random.gauss(self._latency, self._jitter)
+        elif self._distribution == 'exponential':
+            latency = self._latency + (random.expovariate(1 / self._jitter) if self._jitter > 0 else 0.0)
+        else:
+            latency = self._latency + random.uniform(-self._jitter, self._jitter)
+        return max(0.0, latency) * (1 + self._batch_cost * (images - 1))
+
+    async def Ping(self, request, context):
+        self.pings += 1
+        return inference_pb2.TorchServeHealthResponse(health=json.dumps({'status': 'Healthy'}))
+
+    def _read_reference(self, reference: bytes) -> bytes:
+        path, _, byte_range = reference.decode('utf-8').partition('@')
+        with open(os.path.join(self._data_dir, path), 'rb') as f:
+            if not byte_range:
+                return f.read()
+            offset, length = map(int, byte_range.split(':'))
+            f.seek(offset)
+            return f.read(length)
+
+    async def Predictions(self, request, context):
+        asks_capabilities = 'capabilities' in request.input
+        if not asks_capabilities:
+            self.requests += 1
+        if self._outages > 0:
+            self._outages -= 1
+            self.errors += 1
+            await context.abort(grpc.StatusCode.UNAVAILABLE, 'Server is restarting')
+        if asks_capabilities:
+            if self._data_dir is None:
+                await context.abort(grpc.StatusCode.INTERNAL, 'Unknown input')
+            return inference_pb2.PredictionResponse(prediction=json.dumps({'capabilities': ['reference']}).encode())
+        if 'data' in request.input or 'ref' in request.input:
+            inputs = [request.input.get('data') or request.input['ref']]
+        else:
+            inputs = [request.input[k] for k in sorted(request.input.keys(), key=lambda k: int(k.split('_')[-1]))]
+        if self._max_batch_size is not None and len(inputs) > self._max_batch_size:
+            self.errors += 1
+            await context.abort(grpc.StatusCode.INVALID_ARGUMENT,
+                                f'{len(inputs)} images are more than batch size {self._max_batch_size}')
+        async with self._workers:
+            await asyncio.sleep(self.sample_latency(len(inputs)))
+        if random.random() < self._error_rate:
+            self.errors += 1
+            await context.abort(grpc.StatusCode.INTERNAL, 'Prediction failed')
+        if any(k.startswith('ref') for k in request.input.keys()):
+            self.references += len(inputs)
+            inputs = [self._read_reference(o) for o in inputs]
+        if self._broken is not None and any(self._broken(o) for o in inputs):
+            self.errors += 1
+            await context.abort(grpc.StatusCode.INTERNAL, 'Failed to decode an image')
+        self.images += len(inputs)
+        prediction = [[{'name': self._region, 'class': 0, 'confidence': 1.0,
+                        'box': {'x1': i, 'y1': i, 'x2': len(o), 'y2': len(o)}} for i in range(self._detections)]
+                      for o in inputs]
+        return inference_pb2.PredictionResponse(prediction=json.dumps(prediction).encode('utf-8'))
+
+
+async def start_fake_torchserve(port: int = 0, **kwargs):
+    """
+    :param port: 0 to pick a free port
+    :return: tuple(started server, bound port, servicer)
+    """
+    servicer = FakeTorchServe(**kwargs)
+    server = grpc.aio.server()
+    add_InferenceAPIsServiceServicer_to_server(servicer, server)
+    port = server.add_insecure_port(f'127.0.0.1:{port}')
+    await server.start()
+    return server, port, servicer
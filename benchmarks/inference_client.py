@@ -0,0 +1,49 @@
+"""
+Throughput of the gRPC `InferenceClient` against the in-process reference servicer,
+by `compute` in batches and by `computeStream`.
+
+$ PYTHONPATH=. python benchmarks/inference_client.py --images 1000 --latency 0.02 --workers 8
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from app.image.schemas import ImageRead
+from inference import client as inference_client
+from inference.client import InferenceClient
+from inference.servicer import start_reference_server
+
+
+async def benchmark(images: int, latency: float, workers: int, batch_size: int, depths):
+    with tempfile.NamedTemporaryFile(suffix='.jpg') as f:
+        f.write(os.urandom(64 * 1024))
+        f.flush()
+        inputs = [(ImageRead(id=i, file_id=1, hash=f'{i:064x}', width=1000, height=1000, url='url'), f.name)
+                  for i in range(images)]
+        print(f'{"rpc":>13} {"in-flight":>9} {"images/s":>10} {"elapsed":>8}')
+        for streaming in (False, True):
+            server, port, _ = await start_reference_server(latency=latency, workers=workers, streaming=streaming)
+            for depth in depths if not streaming else [1]:
+                client = InferenceClient(config={'enabled': True, 'host': '127.0.0.1', 'port': port,
+                                                 'batch_size': batch_size, 'max_in_flight': depth})
+                t = time.perf_counter()
+                await client.infer(inputs)
+                elapsed = time.perf_counter() - t
+                rpc = 'computeStream' if streaming else 'compute'
+                print(f'{rpc:>13} {depth:>9} {images / elapsed:>10.1f} {elapsed:>8.2f}')
+            inference_client._STREAMING.clear()
+            await server.stop(None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds of the servicer to predict an image')
+    parser.add_argument('--workers', type=int, default=8, help='number of images the servicer predicts at once')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--depths', type=int, nargs='+', default=[1, 2, 4],
+                        help='values of max_in_flight to measure for compute')
+    args = parser.parse_args()
+    asyncio.run(benchmark(args.images, args.latency, args.workers, args.batch_size, args.depths))
@@ -0,0 +1,105 @@
+"""
+Load test of `TorchServeClient` against the fake TorchServe for files of many images.
+It reports throughput, tail latency of images and peak memory of the process.
+The peak is of the whole process so far rather than of each file, since it never decreases.
+Pass a single size to `--files` to measure the peak of a file alone.
+Latency of an image is from when the client takes it until its predictions are returned,
+which includes waiting for a batch and for a request slot.
+
+$ PYTHONPATH=. python benchmarks/inference_load.py --files 1000 10000 100000 --latency 0.02 \\
+    --distribution exponential --jitter 0.01 --batch-size 8 --max-in-flight 8
+"""
+import argparse
+import asyncio
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+
+from app.image.schemas import ImageRead
+from app.model_inference.utils import TorchServeClient
+from benchmarks.fake_torchserve import LATENCY_DISTRIBUTIONS, start_fake_torchserve
+
+
+def percentile(values, ratio: float) -> float:
+    return values[min(len(values) - 1, int(ratio * len(values)))] if values else 0.0
+
+
+def peak_rss_mb() -> float:
+    """
+    Peak resident memory of the process since it started, including files inferred before
+    """
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def run_file(config: dict, path: str, images: int):
+    started = {}
+    latencies = []
+
+    async def inputs():
+        for i in range(images):
+            started[i] = time.perf_counter()
+            yield ImageRead(id=i, file_id=1, hash=f'{i:064x}', width=1000, height=1000, url='url'), path
+
+    client = TorchServeClient(config=config)
+    error = None
+    t = time.perf_counter()
+    try:
+        async for (image, _), _ in client.infer_stream(inputs()):
+            latencies.append(time.perf_counter() - started.pop(image.id))
+    except Exception as e:
+        error = e
+    return time.perf_counter() - t, sorted(latencies), len(client.failures), error
+
+
+async def benchmark(args):
+    server, port, servicer = await start_fake_torchserve(
+        latency=args.latency, jitter=args.jitter, workers=args.workers, distribution=args.distribution,
+        error_rate=args.error_rate, batch_cost=args.batch_cost, detections=args.detections)
+    config = {'host': '127.0.0.1', 'grpc_inference_port': port, 'grpc_management_port': port, 'project': 'fake',
+              'max_in_flight': args.max_in_flight, 'batch_size': args.batch_size, 'retries': args.retries}
+    with tempfile.NamedTemporaryFile(suffix='.jpg') as f:
+        f.write(os.urandom(args.image_bytes))
+        f.flush()
+        print(f'{"images":>7} {"images/s":>9} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"max ms":>8}'
+              f' {"proc peak MB":>12} {"traced MB":>9}')
+        for images in args.files:
+            if args.trace_memory:
+                tracemalloc.start()
+            elapsed, latencies, failed, error = await run_file(config, f.name, images)
+            traced = tracemalloc.get_traced_memory()[1] / 1024 ** 2 if args.trace_memory else 0.0
+            if args.trace_memory:
+                tracemalloc.stop()
+            print(f'{len(latencies):>7} {len(latencies) / elapsed:>9.1f}'
+                  f' {percentile(latencies, 0.5) * 1000:>8.1f} {percentile(latencies, 0.95) * 1000:>8.1f}'
+                  f' {percentile(latencies, 0.99) * 1000:>8.1f} {(latencies[-1] if latencies else 0) * 1000:>8.1f}'
+                  f' {peak_rss_mb():>12.1f} {traced:>9.1f}')
+            if failed:
+                print(f'  {failed} images failed')
+            if error is not None:
+                print(f'  failed after {len(latencies)}/{images} images. reason: {error!r}')
+    print(f'server: {servicer.requests} requests, {servicer.images} images, {servicer.errors} errors')
+    await server.stop(None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--files', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='numbers of images of files to infer one after another')
+    parser.add_argument('--image-bytes', type=int, default=64 * 1024)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds of the fake server to predict an image')
+    parser.add_argument('--jitter', type=float, default=0.005)
+    parser.add_argument('--distribution', choices=LATENCY_DISTRIBUTIONS, default='uniform')
+    parser.add_argument('--workers', type=int, default=8, help='number of workers of the fake server')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='ratio of requests failed by the fake server')
+    parser.add_argument('--batch-cost', type=float, default=0.0,
+                        help='ratio of latency added by each image of a batch after the first one')
+    parser.add_argument('--detections', type=int, default=1, help='detections per image')
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--max-in-flight', type=int, default=8)
+    parser.add_argument('--retries', type=int, default=3, help='retries of requests failed by transient errors')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='measure peak memory allocated by Python during each file, which slows it down')
+    asyncio.run(benchmark(parser.parse_args()))
@@ -0,0 +1,49 @@
+"""
+Throughput of `OnnxClient`, which infers images in this process on CPU, to compare with `TorchServeClient`.
+
+$ PYTHONPATH=. python benchmarks/onnx_client.py --model yolov8n.onnx --images 200 --workers 1 2 4
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+import PIL.Image
+
+from app.image.schemas import ImageRead
+from app.model_inference.onnx_client import OnnxClient
+
+
+async def benchmark(model: str, images: int, width: int, height: int, batch_size: int, threads, workers):
+    with tempfile.TemporaryDirectory() as dirpath:
+        path = os.path.join(dirpath, 'image.jpg')
+        PIL.Image.effect_noise((width, height), 64).convert('RGB').save(path)
+        inputs = [(ImageRead(id=i, file_id=1, hash=f'{i:064x}', width=width, height=height, url='url'), path)
+                  for i in range(images)]
+        print(f'{"threads":>7} {"workers":>7} {"images/s":>10} {"elapsed":>8}')
+        for intra_op_threads in threads:
+            for n_workers in workers:
+                client = OnnxClient(config={'batch_size': batch_size,
+                                            'onnx': {'model_path': model, 'intra_op_threads': intra_op_threads,
+                                                     'workers': n_workers}})
+                # the first call loads the model
+                await client.infer(inputs[:1])
+                t = time.perf_counter()
+                await client.infer(inputs)
+                elapsed = time.perf_counter() - t
+                print(f'{intra_op_threads:>7} {n_workers:>7} {images / elapsed:>10.1f} {elapsed:>8.2f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--model', required=True, help='path of a YOLOv8 model exported to ONNX')
+    parser.add_argument('--images', type=int, default=200)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--batch-size', type=int, default=1, help='effective if the model has dynamic batch size')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2], help='values of intra_op_threads to measure')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='values of workers to measure')
+    args = parser.parse_args()
+    asyncio.run(benchmark(args.model, args.images, args.width, args.height, args.batch_size, args.threads,
+                          args.workers))
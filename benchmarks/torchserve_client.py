@@ -0,0 +1,48 @@
+"""
+Throughput of `TorchServeClient` against a local fake TorchServe.
+
+$ PYTHONPATH=. python benchmarks/torchserve_client.py --images 1000 --latency 0.02 --workers 8
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from app.image.schemas import ImageRead
+from app.model_inference.utils import TorchServeClient
+from benchmarks.fake_torchserve import start_fake_torchserve
+
+
+async def benchmark(images: int, latency: float, jitter: float, workers: int, depths, batch_sizes):
+    server, port, _ = await start_fake_torchserve(latency=latency, jitter=jitter, workers=workers)
+    with tempfile.NamedTemporaryFile(suffix='.jpg') as f:
+        f.write(os.urandom(64 * 1024))
+        f.flush()
+        inputs = [(ImageRead(id=i, file_id=1, hash=f'{i:064x}', width=1000, height=1000, url='url'), f.name)
+                  for i in range(images)]
+        print(f'{"batch":>5} {"in-flight":>9} {"images/s":>10} {"elapsed":>8}')
+        for batch_size in batch_sizes:
+            for depth in depths:
+                client = TorchServeClient(config={'host': '127.0.0.1', 'grpc_inference_port': port,
+                                                  'grpc_management_port': port, 'project': 'fake',
+                                                  'max_in_flight': depth, 'batch_size': batch_size})
+                t = time.perf_counter()
+                await client.infer(inputs)
+                elapsed = time.perf_counter() - t
+                print(f'{batch_size:>5} {depth:>9} {images / elapsed:>10.1f} {elapsed:>8.2f}')
+    await server.stop(None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=1000)
+    parser.add_argument('--latency', type=float, default=0.02, help='seconds of the fake server to predict an image')
+    parser.add_argument('--jitter', type=float, default=0.005)
+    parser.add_argument('--workers', type=int, default=8, help='number of workers of the fake server')
+    parser.add_argument('--depths', type=int, nargs='+', default=[1, 2, 4, 8, 16, 32],
+                        help='values of max_in_flight to measure')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1],
+                        help='values of batch_size to measure')
+    args = parser.parse_args()
+    asyncio.run(benchmark(args.images, args.latency, args.jitter, args.workers, args.depths, args.batch_sizes))
@@ -1,5 +1,5 @@
 import asyncio
-from typing import Optional, Coroutine, Callable
+from typing import Optional, Coroutine, Callable, Iterable, List, Any, AsyncIterable, AsyncIterator, Tuple, Union
 import time
 
 
@@ -64,6 +64,89 @@ class AioTaskPool:
             task.add_done_callback(callback)
 
 
+async def ordered_map(func: Callable[[Any], Coroutine], items: Iterable, tasks: int) -> List:
+    """
+    Await `func(item)` for all items with at most `tasks` of them running at once.
+    Unlike `AioTaskPool`, results are returned in the order of items,
+    and only `tasks` tasks are created however many items there are.
+    If any of them raises an exception, the others are cancelled and the exception is raised.
+    """
+    if tasks < 1:
+        raise ValueError("Number of tasks must be at least 1")
+    items = list(items)
+    results = [None] * len(items)
+    it = iter(enumerate(items))
+
+    async def worker():
+        # iterators are shared safely because workers switch only at await
+        for i, item in it:
+            results[i] = await func(item)
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(min(tasks, len(items)))]
+    try:
+        await asyncio.gather(*workers)
+    except BaseException:
+        for worker_ in workers:
+            worker_.cancel()
+        raise
+    return results
+
+
+async def as_completed_map(func: Callable[[Any], Coroutine], items: Union[Iterable, AsyncIterable], tasks: int) -> \
+        AsyncIterator[Tuple[Any, Any]]:
+    """
+    Await `func(item)` for items of a (async) iterable with at most `tasks` of them running at once,
+    and yield tuple(item, result) as soon as each of them is done.
+    Items are pulled only when a task is free and results wait for the consumer,
+    so a slow producer or consumer slows the others down instead of piling items up in memory.
+    If any of them raises an exception, the others are cancelled and the exception is raised.
+    """
+    if tasks < 1:
+        raise ValueError("Number of tasks must be at least 1")
+    if isinstance(items, AsyncIterable):
+        iterator = items.__aiter__()
+    else:
+        async def _aiter():
+            for item in items:
+                yield item
+        iterator = _aiter()
+    lock = asyncio.Lock()
+    done = asyncio.Queue(maxsize=tasks)
+
+    async def worker():
+        while True:
+            # an async iterator can't be advanced by many tasks at once
+            async with lock:
+                try:
+                    item = await iterator.__anext__()
+                except StopAsyncIteration:
+                    return
+            await done.put((item, await func(item)))
+
+    workers = [asyncio.ensure_future(worker()) for _ in range(tasks)]
+    finished = asyncio.gather(*workers)
+    try:
+        while True:
+            get = asyncio.ensure_future(done.get())
+            await asyncio.wait([get, finished], return_when=asyncio.FIRST_COMPLETED)
+            if get.done():
+                yield get.result()
+                continue
+            get.cancel()
+            # raise the exception of a worker if any
+            finished.result()
+            while not done.empty():
+                yield done.get_nowait()
+            return
+    finally:
+        for worker_ in workers:
+            worker_.cancel()
+        if not finished.done():
+            finished.cancel()
+        # retrieve the exception of cancelled workers not to be logged as never retrieved
+        await asyncio.gather(finished, return_exceptions=True)
+
+
 if __name__ == '__main__':
     async def example():
         async def coro1():
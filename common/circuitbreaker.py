@@ -0,0 +1,90 @@
+import asyncio
+from time import monotonic
+from typing import Dict, Optional
+
+from common.exceptions import OperationError
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_COOLDOWN = 30.0
+DEFAULT_POLL_INTERVAL = 0.05
+
+
+class CircuitOpenError(OperationError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stop calling a server after `failure_threshold` calls in a row fail, so that callers fail fast
+    instead of waiting for an unhealthy server with every call.
+    Calls are rejected for `cooldown` seconds. Then a call is let through to try the server,
+    and the circuit closes again when it succeeds or opens for another cooldown when it fails.
+    Calls made while it is trying can wait for the result by `wait`.
+    """
+    def __init__(self, name: str, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                 cooldown: float = DEFAULT_COOLDOWN):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at: Optional[float] = None
+        # when the call trying the server was let through. Another one is let through if it doesn't end in a cooldown
+        self._tried_at: Optional[float] = None
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    @property
+    def trying(self) -> bool:
+        return self._tried_at is not None and monotonic() - self._tried_at < self.cooldown
+
+    async def wait(self, poll_interval: float = DEFAULT_POLL_INTERVAL):
+        """
+        Wait until a call trying the server ends, and then check
+        """
+        while self.trying:
+            await asyncio.sleep(poll_interval)
+        self.check()
+
+    def check(self):
+        """
+        Call this before a call to the server
+        :raise CircuitOpenError: if the circuit is open and it is not the time to try the server again
+        """
+        if self._opened_at is None:
+            return
+        now = monotonic()
+        if now - max(self._opened_at, self._tried_at or 0.0) < self.cooldown:
+            raise CircuitOpenError(f'Circuit to {self.name} is open after {self._failures} failures in a row')
+        self._tried_at = now
+
+    def success(self):
+        self._failures = 0
+        self._opened_at = None
+        self._tried_at = None
+
+    def failure(self):
+        self._failures += 1
+        if self._failures >= self.failure_threshold:
+            self._opened_at = monotonic()
+        self._tried_at = None
+
+
+_BREAKERS: Dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(name: str, failure_threshold: int = DEFAULT_FAILURE_THRESHOLD,
+                        cooldown: float = DEFAULT_COOLDOWN) -> CircuitBreaker:
+    """
+    :return: circuit breaker of a server shared by all callers in the process
+    """
+    if name not in _BREAKERS:
+        _BREAKERS[name] = CircuitBreaker(name, failure_threshold, cooldown)
+    breaker = _BREAKERS[name]
+    breaker.failure_threshold, breaker.cooldown = failure_threshold, cooldown
+    return breaker
+
+
+def reset_circuit_breakers():
+    _BREAKERS.clear()
@@ -0,0 +1,29 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+
+
+class CPUPool:
+    def __init__(self, workers: Optional[int] = None):
+        """
+        Run CPU-bound functions in worker processes so that they don't block the event loop.
+        Worker processes are started at the first call.
+        :param workers: Number of worker processes. Default is the number of processors on the machine.
+        """
+        if workers is not None and workers < 1:
+            raise ValueError("Number of workers must be at least 1")
+        self._workers = workers
+        self._executor = None
+
+    async def run(self, func: Callable, *args):
+        """
+        :param func: It must be picklable, e.g. a function defined at the top level of a module
+        """
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self._workers)
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
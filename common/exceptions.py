@@ -32,5 +32,10 @@ class ParameterEmptyError(ParameterError):
         super(ParameterEmptyError, self).__init__(f'{value} is empty.')
 
 
+class ParameterConflictError(ParameterError):
+    def __init__(self, value, reason='has been modified by another request'):
+        super(ParameterConflictError, self).__init__(f'{value} {reason}.')
+
+
 class OperationError(Exception):
     pass
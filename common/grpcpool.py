@@ -0,0 +1,180 @@
+import asyncio
+import logging
+from itertools import count
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import grpc
+
+DEFAULT_SUB_CHANNELS = 2
+DEFAULT_HEALTH_CHECK_INTERVAL = 10.0
+DEFAULT_HEALTH_CHECK_TIMEOUT = 5.0
+# seconds RPCs in flight on an unhealthy sub-channel are given to finish before it is closed
+DEFAULT_CLOSE_GRACE = 30.0
+MAX_MESSAGE_LENGTH = 100 * 1024 * 1024
+CHANNEL_OPTIONS = [
+    ('grpc.max_send_message_length', MAX_MESSAGE_LENGTH),
+    ('grpc.max_receive_message_length', MAX_MESSAGE_LENGTH),
+    # ping idle connections so that dead ones are found before a request is sent on them
+    ('grpc.keepalive_time_ms', 30 * 1000),
+    ('grpc.keepalive_timeout_ms', 10 * 1000),
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.max_pings_without_data', 0),
+    # reconnect quickly after the server restarts
+    ('grpc.initial_reconnect_backoff_ms', 500),
+    ('grpc.max_reconnect_backoff_ms', 5 * 1000),
+    # each sub-channel has its own connection instead of sharing one of the global subchannel pool
+    ('grpc.use_local_subchannel_pool', 1),
+]
+
+HealthCheck = Callable[[grpc.aio.Channel], Awaitable[bool]]
+
+
+class ChannelPool:
+    """
+    Persistent channels to a gRPC server shared by all callers in a process.
+
+    Requests are spread over `size` sub-channels round-robin, each of which is its own connection.
+    Health is checked in the background every `health_check_interval` seconds instead of before every request,
+    and a sub-channel that fails the check is replaced with a new one.
+    The replaced one is closed in the background once its RPCs in flight finish, or after `close_grace` seconds.
+    Channels are bound to an event loop, so they are recreated if the pool is used in another loop.
+    """
+    def __init__(self, addr: str, size: int = DEFAULT_SUB_CHANNELS, health_check: Optional[HealthCheck] = None,
+                 health_check_interval: float = DEFAULT_HEALTH_CHECK_INTERVAL,
+                 health_check_timeout: float = DEFAULT_HEALTH_CHECK_TIMEOUT,
+                 close_grace: float = DEFAULT_CLOSE_GRACE,
+                 options: Optional[List[Tuple[str, object]]] = None):
+        """
+        :param health_check: coroutine function which tells whether the server is healthy through a channel.
+                             Exceptions raised by it are regarded as unhealthy.
+        """
+        if size < 1:
+            raise ValueError("Number of sub-channels must be at least 1")
+        self.addr = addr
+        self._size = size
+        self._health_check = health_check
+        self._health_check_interval = health_check_interval
+        self._health_check_timeout = health_check_timeout
+        self._close_grace = close_grace
+        self._options = options or CHANNEL_OPTIONS
+        self._channels: List[Optional[grpc.aio.Channel]] = [None] * size
+        self._healthy: List[Optional[bool]] = [None] * size
+        self._round_robin = count()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._health_task: Optional[asyncio.Task] = None
+        # unhealthy sub-channels being closed after their RPCs in flight
+        self._retired: Dict[grpc.aio.Channel, asyncio.Task] = {}
+
+    @property
+    def healthy(self) -> Optional[bool]:
+        """
+        :return: True if any sub-channel passed the last health check. None if it has never been checked
+        """
+        if all(o is None for o in self._healthy):
+            return None
+        return any(self._healthy)
+
+    def _bind_loop(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is loop:
+            return
+        # channels of a closed loop can't be used nor closed, so just drop them
+        self._loop = loop
+        self._channels = [None] * self._size
+        self._healthy = [None] * self._size
+        self._health_task = None
+        self._retired = {}
+
+    def _open(self, i: int) -> grpc.aio.Channel:
+        if self._channels[i] is None:
+            self._channels[i] = grpc.aio.insecure_channel(self.addr, options=self._options)
+        return self._channels[i]
+
+    def channel(self) -> grpc.aio.Channel:
+        """
+        :return: the next sub-channel which passed the last health check, or the next one if none passed
+        """
+        self._bind_loop()
+        self._start_health_check()
+        start = next(self._round_robin)
+        for j in range(self._size):
+            i = (start + j) % self._size
+            if self._healthy[i] is not False:
+                return self._open(i)
+        return self._open(start % self._size)
+
+    async def check(self) -> bool:
+        """
+        Check health of all sub-channels now and reconnect the unhealthy ones
+        :return: whether any sub-channel is healthy
+        """
+        self._bind_loop()
+        if self._health_check is None:
+            self._healthy = [True] * self._size
+            return True
+        await asyncio.gather(*(self._check(i) for i in range(self._size)))
+        return bool(self.healthy)
+
+    async def _check(self, i: int):
+        channel = self._open(i)
+        try:
+            healthy = await asyncio.wait_for(self._health_check(channel), self._health_check_timeout)
+        except (grpc.aio.AioRpcError, asyncio.TimeoutError):
+            healthy = False
+        except Exception:
+            logging.exception(f'Unexpected exception occurred when checking health of {self.addr}')
+            healthy = False
+        if not healthy and self._healthy[i] is not False:
+            logging.warning(f'Sub-channel {i} to {self.addr} is unhealthy. It will be reconnected')
+        self._healthy[i] = healthy
+        if not healthy and self._channels[i] is channel:
+            self._channels[i] = None
+            self._retire(channel)
+
+    def _retire(self, channel: grpc.aio.Channel):
+        # closing a channel cancels its RPCs, so new ones go to a new channel while they finish
+        task = asyncio.create_task(channel.close(grace=self._close_grace))
+        self._retired[channel] = task
+        task.add_done_callback(lambda _: self._retired.pop(channel, None))
+
+    def _start_health_check(self):
+        if self._health_check is None or self._health_task is not None:
+            return
+        self._health_task = asyncio.create_task(self._check_periodically())
+
+    async def _check_periodically(self):
+        while True:
+            await asyncio.sleep(self._health_check_interval)
+            await self.check()
+
+    async def close(self):
+        if self._health_task is not None:
+            self._health_task.cancel()
+            self._health_task = None
+        channels, self._channels = self._channels, [None] * self._size
+        retired, self._retired = self._retired, {}
+        self._healthy = [None] * self._size
+        if self._loop is asyncio.get_running_loop():
+            for channel in channels + list(retired):
+                if channel is not None:
+                    await channel.close()
+            await asyncio.gather(*retired.values(), return_exceptions=True)
+
+
+_CHANNEL_POOLS: Dict[str, ChannelPool] = {}
+
+
+def get_channel_pool(addr: str, **kwargs) -> ChannelPool:
+    """
+    :return: the channel pool of `addr` in this process. It is created with `kwargs` at the first call
+    """
+    if addr not in _CHANNEL_POOLS:
+        _CHANNEL_POOLS[addr] = ChannelPool(addr, **kwargs)
+    return _CHANNEL_POOLS[addr]
+
+
+async def close_channel_pools():
+    pools = list(_CHANNEL_POOLS.values())
+    _CHANNEL_POOLS.clear()
+    for pool in pools:
+        await pool.close()
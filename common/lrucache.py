@@ -0,0 +1,39 @@
+from collections import OrderedDict
+from typing import Hashable, Any, Optional, Iterable
+
+
+class LRUCache:
+    def __init__(self, maxsize: int):
+        """
+        In-process cache that discards the least recently used items when it is full.
+        :param maxsize: Maximum number of items. It must be at least 1.
+        """
+        if maxsize < 1:
+            raise ValueError("Maximum size must be at least 1")
+        self._maxsize = maxsize
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key: Hashable):
+        return key in self._items
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        if key not in self._items:
+            return default
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def put(self, key: Hashable, value: Any):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self._maxsize:
+            self._items.popitem(last=False)
+
+    def pop(self, keys: Iterable[Hashable]):
+        for key in keys:
+            self._items.pop(key, None)
+
+    def clear(self):
+        self._items.clear()
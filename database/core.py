@@ -1,5 +1,6 @@
 import asyncio
 from typing import AsyncIterable, Optional, TypeVar
+from sqlalchemy import event
 from sqlalchemy.orm import sessionmaker, declarative_base
 from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine, async_scoped_session
 
@@ -13,18 +14,19 @@ Session = async_scoped_session(sessionmaker(expire_on_commit=False, class_=Async
 
 
 class CustomBase:
-
-    @property
-    def _columns_exclude_updating(self):
-        return []
+    _columns_exclude_updating = []
 
     def column_keys(self):
         return self.__table__.columns.keys()
 
+    @classmethod
+    def updatable_values(cls, **kwargs) -> dict:
+        return {k: v for k, v in kwargs.items()
+                if k not in cls._columns_exclude_updating and k in cls.__table__.columns.keys()}
+
     def update(self, **kwargs):
-        for k, v in kwargs.items():
-            if k not in self._columns_exclude_updating and k in self.__table__.columns.keys():
-                setattr(self, k, v)
+        for k, v in self.updatable_values(**kwargs).items():
+            setattr(self, k, v)
 
     def dict(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns}
@@ -42,9 +44,22 @@ def create_engine(uri: str = None):
         else:
             uri = '{dialect}+{driver}://{user}:{password}@{host}/{dbname}'.format(**CONFIG['db'])
     engine = create_async_engine(uri, echo=False)
+    if engine.dialect.name == 'sqlite':
+        enable_sqlite_foreign_keys(engine)
     Session.configure(bind=engine)
 
 
+def enable_sqlite_foreign_keys(async_engine: AsyncEngine):
+    """
+    SQLite ignores foreign key constraints(including ON DELETE CASCADE) unless it is enabled per connection.
+    """
+    @event.listens_for(async_engine.sync_engine, 'connect')
+    def _set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+
 async def create_tables(drop=False):
     async with engine.begin() as conn:
         if drop:
@@ -1,9 +1,10 @@
-from typing import Type
+from typing import Type, Optional
 
+from sqlalchemy import update
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.sql import selectable
 
-from common.exceptions import ParameterNotFoundError
+from common.exceptions import ParameterNotFoundError, ParameterConflictError
 
 from .core import SQLAlchemyModel
 
@@ -23,3 +24,43 @@ async def get_one(session: AsyncSession, model: Type[SQLAlchemyModel], id_: int,
     if r is None and not silent:
         raise ParameterNotFoundError(f'{model.__name__} {id_}')
     return r
+
+
+async def update_one(session: AsyncSession, model: Type[SQLAlchemyModel], id_: int, values: dict,
+                     version: Optional[int] = None) -> SQLAlchemyModel:
+    """
+    Update a row with a single UPDATE statement instead of loading it first.
+    Uses UPDATE ... RETURNING if the dialect supports it(e.g. sqlite, postgresql),
+    otherwise(e.g. mysql) the updated row is read back after the UPDATE.
+
+    :param values: column values to update. Columns that are excluded from updating are ignored.
+    :param version: expected value of the `version` column.
+                    If given, the row is updated only when its version still equals to it.
+    :raises: 1.`ParameterNotFoundError` if there is no row of `id_`
+             2.`ParameterConflictError` if the row has been updated by another request since `version`
+    """
+    has_version = 'version' in model.__table__.columns.keys()
+    values = model.updatable_values(**values)
+    stmt = update(model).where(model.id == id_)
+    if has_version:
+        values['version'] = model.version + 1
+        if version is not None:
+            stmt = stmt.where(model.version == version)
+    stmt = stmt.values(**values).execution_options(synchronize_session=False)
+
+    if session.get_bind().dialect.update_returning:
+        r = await session.scalar(stmt.returning(model), execution_options={'populate_existing': True})
+        updated = r is not None
+    else:
+        result = await session.execute(stmt)
+        updated = result.rowcount > 0
+        r = await session.get(model, id_, populate_existing=True) if updated else None
+
+    if not updated:
+        await session.rollback()
+        if version is not None and await session.get(model, id_) is not None:
+            raise ParameterConflictError(f'{model.__name__} {id_}')
+        raise ParameterNotFoundError(f'{model.__name__} {id_}')
+
+    await session.commit()
+    return r
@@ -1,119 +1,301 @@
 import asyncio
 import logging
+import mmap
+import os
 import grpc
-import aiofiles
 import time
 
-from typing import List, Tuple, Optional
+from collections import deque
+from contextlib import ExitStack
+from typing import AsyncIterator, Dict, List, Tuple, Optional
+from common.grpcpool import ChannelPool, get_channel_pool
 from inference.inference_pb2_grpc import InferenceStub
 from inference.inference_pb2 import Request, Reply
+from inference.data_pb2 import Image, Region
 
 from app.image.schemas import ImageRead
+from app.image.storage import location_reference
 from app.bbox.schemas import BBoxBase
 from app.label.schemas import LabelBase
 from app.label.utils import translate
 
+COMPUTE_METHOD = '/inference.Inference/compute'
+COMPUTE_STREAM_METHOD = '/inference.Inference/computeStream'
+# a batch is sent while the next one is read, so the server is not idle between batches
+DEFAULT_MAX_IN_FLIGHT = 2
+# wire format tags of `Request.images` and `Image.data`
+_REQUEST_IMAGES_TAG = b'\x0a'
+_IMAGE_DATA_TAG = b'\x22'
+# whether servers support `computeStream`, which is found before the first inference by each of them
+_STREAMING: Dict[str, bool] = {}
+REFERENCE_CAPABILITY = 'reference'
+# capabilities of servers told by health checks
+_CAPABILITIES: Dict[str, set] = {}
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
 
 class InferenceClient:
     def __init__(self, config: dict = None):
+        """
+        :param config: `enabled`, `host`, `port` and `batch_size` of the inference server,
+                       and optionally `max_in_flight`, the number of batches sent concurrently,
+                       and `read_by_reference`, whether to send paths of images relative to the data directory
+                       instead of their bytes if the server mounts the same directory
+        """
         self._enabled = False
         self._addr = None
         self._batch_size = 1
+        self._max_in_flight = DEFAULT_MAX_IN_FLIGHT
+        self._read_by_reference = False
         if config:
             self._enabled = config['enabled']
             if self._enabled:
                 self._addr = '{host}:{port}'.format(**config)
                 self._batch_size = config['batch_size']
+                self._max_in_flight = int(config.get('max_in_flight') or DEFAULT_MAX_IN_FLIGHT)
+                self._read_by_reference = bool(config.get('read_by_reference'))
 
     def enabled(self):
         return self._enabled
 
+    @property
+    def channel_pool(self) -> ChannelPool:
+        """
+        Channels to the inference server shared by all clients in the process. Its health is checked in the background
+        """
+        return get_channel_pool(self._addr, health_check=self._health_check)
+
+    async def _health_check(self, channel) -> bool:
+        reply = await InferenceStub(channel).compute(Request())
+        _CAPABILITIES[self._addr] = set(reply.capabilities)
+        return True
+
+    async def _by_reference(self) -> bool:
+        """
+        Whether to send references of images, which is possible only if the server tells the capability
+        """
+        if not self._read_by_reference:
+            return False
+        if self._addr not in _CAPABILITIES:
+            await self.channel_pool.check()
+        return REFERENCE_CAPABILITY in _CAPABILITIES.get(self._addr, ())
+
     async def ping(self) -> bool:
         if not self._enabled:
             return False
-        try:
-            async with grpc.aio.insecure_channel(self._addr) as channel:
-                client = InferenceStub(channel)
-                request = Request()
-                await client.compute(request)
-                return True
-        except grpc.aio.AioRpcError:
-            return False
-        # This handler is for unknown exceptions. Known exceptions should be handled explicitly
-        except:
-            logging.exception('Unexpected exception occurred when request health check to inference server.')
-            return False
+        # exceptions are handled by the pool, which regards them as unhealthy
+        return await self.channel_pool.check()
 
     async def infer(self, images: List[Tuple[ImageRead, str]]) -> \
             List[Tuple[int, BBoxBase, Optional[LabelBase]]]:
         """
+        Images are streamed by `computeStream` if the server supports it, otherwise sent in batches by `compute`
         :param images: list of tuple(schemas.Image, path of image file)
         :return: list of tuple(image id, schemas.RegionBase, schemas.LabelBase)
         """
         if not images:
             return []
+        by_reference = await self._by_reference()
+        if await self._supports_streaming():
+            return await self._infer_stream(images, by_reference)
+        return await self._infer_batches(images, by_reference)
 
+    async def _supports_streaming(self) -> bool:
+        """
+        Find whether the server supports `computeStream` by an empty stream, which is done once for each server.
+        Nothing is sent on it, so that the status of the server is not hidden by a failure to send images.
+        """
+        if self._addr in _STREAMING:
+            return _STREAMING[self._addr]
+        compute = self.channel_pool.channel().stream_stream(COMPUTE_STREAM_METHOD,
+                                                            response_deserializer=Region.FromString)
+        try:
+            async for _ in compute(()):
+                pass
+        except grpc.aio.AioRpcError as e:
+            if e.code() != grpc.StatusCode.UNIMPLEMENTED:
+                # unknown until the server is available
+                return False
+            logging.info(f'Inference server {self._addr} does not support computeStream. compute is used instead')
+            _STREAMING[self._addr] = False
+        else:
+            _STREAMING[self._addr] = True
+        return _STREAMING[self._addr]
+
+    async def _infer_stream(self, images: List[Tuple[ImageRead, str]], by_reference: bool = False) -> \
+            List[Tuple[int, BBoxBase, Optional[LabelBase]]]:
+        """
+        Stream images in a single call. Regions are received while the rest of images are sent.
+        """
         result = []
+        total = len(images)
+        call = None
         try:
-            async with grpc.aio.insecure_channel(self._addr,
-                                                 options=[('grpc.max_send_message_length', 100 * 1024 * 1024),
-                                                          ('grpc.max_receive_message_length', 100 * 1024 * 1024)]) \
-                    as channel:
-                client = InferenceStub(channel)
-                total = len(images)
-                for i in range(total // self._batch_size + 1):
-                    request = Request()
-                    coros = []
-                    s = i * self._batch_size
-                    e = (i + 1) * self._batch_size
-                    for image, path in images[s:e]:
-                        coros.append(self._make_request(request, image, path))
-                    if coros:
-                        await asyncio.gather(*coros)
-                        try:
-                            t = time.time()
-                            reply = await client.compute(request)
-                            result.extend(self._parse_reply(reply))
-                            logging.debug(
-                                f'Parsing replies completed. elapsed: {time.time() - t}. image ids: {s} ~ {e} / {total}')
-                        except KeyboardInterrupt:
-                            logging.info(f'Stopped to parse replies. image ids {s} ~ {e} / {total}')
-                            return result
-                        except grpc.aio.AioRpcError:
-                            logging.exception(f'Failed to parse replies. image ids {s} ~ {e} / {total}')
+            compute = self.channel_pool.channel().stream_stream(COMPUTE_STREAM_METHOD,
+                                                                response_deserializer=Region.FromString)
+            call = compute(self._stream_images(images, by_reference))
+            async for region in call:
+                result.append(self._parse_region(region))
+        except grpc.aio.AioRpcError:
+            logging.exception(f'Failed to parse streamed replies. Total count of received regions is {len(result)}')
+        except Exception:
+            file_ids = list({o[0].file_id for o in images})
+            file_ids_str = ','.join(map(str, file_ids[:3])) + (',...' if len(file_ids) > 3 else '')
+            logging.exception(f'Unexpected exception occurred when stream images of files'
+                              f' [{file_ids_str}] to inference server. Total count of images is {total}.')
+        finally:
+            if call is not None:
+                call.cancel()
+        return result
+
+    async def _stream_images(self, images: List[Tuple[ImageRead, str]], by_reference: bool = False) -> \
+            AsyncIterator[bytes]:
+        """
+        Serialized `Image`s to stream. The next `batch_size` images are read while the current ones are sent
+        """
+        starts = range(0, len(images), self._batch_size)
+        prepared = asyncio.create_task(
+            asyncio.to_thread(self._make_images, images[:self._batch_size], by_reference))
+        try:
+            for s in starts:
+                e = s + self._batch_size
+                messages = await prepared
+                prepared = None
+                if e < len(images):
+                    prepared = asyncio.create_task(
+                        asyncio.to_thread(self._make_images, images[e:e + self._batch_size], by_reference))
+                for message in messages:
+                    yield message
+        finally:
+            if prepared is not None:
+                prepared.cancel()
+
+    async def _infer_batches(self, images: List[Tuple[ImageRead, str]], by_reference: bool = False) -> \
+            List[Tuple[int, BBoxBase, Optional[LabelBase]]]:
+        """
+        Images are sent in batches of `batch_size`, and up to `max_in_flight` batches are sent concurrently.
+        The next batch is read and serialized while the others are in flight.
+        :return: predictions in the order of images
+        """
+        result = []
+        total = len(images)
+        starts = range(0, total, self._batch_size)
+        pending = deque()
+        prepared = None
+        try:
+            pool = self.channel_pool
+            prepared = asyncio.create_task(
+                asyncio.to_thread(self._make_request, images[:self._batch_size], by_reference))
+            for s in starts:
+                e = min(s + self._batch_size, total)
+                request = await prepared
+                prepared = None
+                if e < total:
+                    prepared = asyncio.create_task(
+                        asyncio.to_thread(self._make_request, images[e:e + self._batch_size], by_reference))
+                pending.append(asyncio.create_task(self._compute(pool, request, s, e, total)))
+                if len(pending) >= self._max_in_flight:
+                    result.extend(await pending.popleft())
+            while pending:
+                result.extend(await pending.popleft())
+        except KeyboardInterrupt:
+            logging.info(f'Stopped to parse replies. Total count of processed images is {len(result)}/{total}')
         except Exception:
             file_ids = list({o[0].file_id for o in images})
             file_ids_str = ','.join(map(str, file_ids[:3])) + (',...' if len(file_ids) > 3 else '')
             logging.exception(f'Unexpected exception occurred when request images of files'
                               f' [{file_ids_str}] to inference server.'
                               f' Total count of processed images is {len(result)}/{total}.')
+        finally:
+            for task in [prepared, *pending]:
+                if task is not None:
+                    task.cancel()
 
         return result
 
+    async def _compute(self, pool: ChannelPool, request: bytes, s: int, e: int, total: int) -> \
+            List[Tuple[int, BBoxBase, Optional[LabelBase]]]:
+        """
+        Send a serialized `Request` as it is, so that it isn't copied again
+        """
+        try:
+            t = time.time()
+            compute = pool.channel().unary_unary(COMPUTE_METHOD, response_deserializer=Reply.FromString)
+            reply = await compute(request)
+            result = self._parse_reply(reply)
+            logging.debug(f'Parsing replies completed. elapsed: {time.time() - t}. image ids: {s} ~ {e} / {total}')
+            return result
+        except grpc.aio.AioRpcError:
+            logging.exception(f'Failed to parse replies. image ids {s} ~ {e} / {total}')
+            return []
+
     @staticmethod
-    async def _make_request(request: Request, image: ImageRead, path: str):
-        request_image = request.images.add()
-        request_image.id = image.id
-        request_image.width = image.width
-        request_image.height = image.height
-        async with aiofiles.open(path, 'rb') as f:
-            request_image.data = await f.read()
+    def _image_parts(stack: ExitStack, image: ImageRead, path: str, by_reference: bool = False) -> \
+            Tuple[list, int]:
+        """
+        Parts of a serialized `Image`. Its data is the image file mapped into memory,
+        which is copied only once when the parts are joined,
+        instead of being read into bytes, set to a message and copied again by serialization.
+        :param by_reference: whether to have the reference of the image instead of its data
+        :return: tuple(list of parts, length of the serialized message)
+        """
+        if by_reference:
+            message = Image(id=image.id, width=image.width, height=image.height,
+                            reference=location_reference(path)).SerializeToString()
+            return [message], len(message)
+        f = stack.enter_context(open(path, 'rb'))
+        size = os.fstat(f.fileno()).st_size
+        header = Image(id=image.id, width=image.width, height=image.height).SerializeToString()
+        if not size:
+            return [header], len(header)
+        header += _IMAGE_DATA_TAG + _varint(size)
+        return [header, stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))], len(header) + size
+
+    @classmethod
+    def _make_request(cls, images: List[Tuple[ImageRead, str]], by_reference: bool = False) -> bytes:
+        """
+        Serialize a `Request` of images. It blocks on reading files, so run it in a thread.
+        """
+        parts = []
+        with ExitStack() as stack:
+            for image, path in images:
+                image_parts, length = cls._image_parts(stack, image, path, by_reference)
+                parts.append(_REQUEST_IMAGES_TAG + _varint(length))
+                parts.extend(image_parts)
+            return b''.join(parts)
+
+    @classmethod
+    def _make_images(cls, images: List[Tuple[ImageRead, str]], by_reference: bool = False) -> List[bytes]:
+        """
+        Serialize an `Image` of each image. It blocks on reading files, so run it in a thread.
+        """
+        with ExitStack() as stack:
+            return [b''.join(cls._image_parts(stack, image, path, by_reference)[0]) for image, path in images]
+
+    @classmethod
+    def _parse_reply(cls, reply: Reply) -> List[Tuple[int, BBoxBase, Optional[LabelBase]]]:
+        return [cls._parse_region(region) for region in reply.regions]
 
     @staticmethod
-    def _parse_reply(reply: Reply) -> List[Tuple[int, BBoxBase, Optional[LabelBase]]]:
-        result = []
-        for region in reply.regions:
-            image_id = region.image.id
-            base_region = BBoxBase(rx1=region.bbox.rx1, ry1=region.bbox.ry1,
-                                   rx2=region.bbox.rx2, ry2=region.bbox.ry2)
-            labels = {}
-            for label in region.labels:
-                label_type, label_name = translate(label.type), translate(label.name, label.type)
-                if label_type and label_name:
-                    labels[label_type] = label_name
-            if labels:
-                base_label = LabelBase(**labels)
-            else:
-                base_label = None
-            result.append((image_id, base_region, base_label))
-        return result
+    def _parse_region(region: Region) -> Tuple[int, BBoxBase, Optional[LabelBase]]:
+        image_id = region.image.id
+        base_region = BBoxBase(rx1=region.bbox.rx1, ry1=region.bbox.ry1,
+                               rx2=region.bbox.rx2, ry2=region.bbox.ry2)
+        labels = {}
+        for label in region.labels:
+            label_type, label_name = translate(label.type), translate(label.name, label.type)
+            if label_type and label_name:
+                labels[label_type] = label_name
+        if labels:
+            base_label = LabelBase(**labels)
+        else:
+            base_label = None
+        return image_id, base_region, base_label
@@ -0,0 +1,117 @@
+import asyncio
+import os
+from typing import Callable, List, Optional
+
+import grpc
+
+from inference.data_pb2 import Image, Region
+from inference.inference_pb2 import Reply
+from inference.inference_pb2_grpc import InferenceServicer, add_InferenceServicer_to_server
+
+
+def predict_whole_image(image: Image) -> List[Region]:
+    region = Region()
+    region.image.id, region.image.width, region.image.height = image.id, image.width, image.height
+    region.bbox.rx1, region.bbox.ry1, region.bbox.rx2, region.bbox.ry2 = 0.0, 0.0, 1.0, 1.0
+    return [region]
+
+
+class ReferenceInferenceServicer(InferenceServicer):
+    """
+    In-process implementation of the inference protocol to test and benchmark clients without a model.
+    Images are predicted by `predict`, which regards a whole image as a region by default.
+    `compute` replies when all images of a request are predicted,
+    while `computeStream` sends regions of each image as soon as it is predicted.
+    """
+    def __init__(self, predict: Optional[Callable[[Image], List[Region]]] = None, latency: float = 0.0,
+                 workers: int = 8, streaming: bool = True, data_dir: Optional[str] = None):
+        """
+        :param latency: seconds to predict an image
+        :param workers: number of images predicted at once
+        :param streaming: False to behave like a server which does not support `computeStream`
+        :param data_dir: data directory shared with clients to read images sent by reference
+        """
+        self._predict = predict or predict_whole_image
+        self._latency = latency
+        self._workers = asyncio.Semaphore(workers)
+        self._streaming = streaming
+        self._data_dir = data_dir
+        self.requests = 0
+        # ids of images of each request of `compute`
+        self.batches: List[List[int]] = []
+        self.streams = 0
+        self.images = 0
+        self.references = 0
+
+    @property
+    def capabilities(self) -> List[str]:
+        return ['reference'] if self._data_dir else []
+
+    def _read_reference(self, reference: str) -> bytes:
+        path, _, byte_range = reference.partition('@')
+        with open(os.path.join(self._data_dir, path), 'rb') as f:
+            if not byte_range:
+                return f.read()
+            offset, length = map(int, byte_range.split(':'))
+            f.seek(offset)
+            return f.read(length)
+
+    async def predict(self, image: Image) -> List[Region]:
+        if image.reference:
+            self.references += 1
+            data = await asyncio.to_thread(self._read_reference, image.reference)
+            image = Image(id=image.id, width=image.width, height=image.height, data=data)
+        async with self._workers:
+            await asyncio.sleep(self._latency)
+        self.images += 1
+        return self._predict(image)
+
+    async def compute(self, request, context):
+        if not request.images:
+            # a health check
+            return Reply(capabilities=self.capabilities)
+        self.requests += 1
+        self.batches.append([o.id for o in request.images])
+        reply = Reply()
+        for regions in await asyncio.gather(*(self.predict(o) for o in request.images)):
+            reply.regions.extend(regions)
+        return reply
+
+    async def computeStream(self, request_iterator, context):
+        if not self._streaming:
+            await context.abort(grpc.StatusCode.UNIMPLEMENTED, 'computeStream is not supported')
+        self.streams += 1
+        predicted = asyncio.Queue()
+
+        async def receive():
+            tasks = []
+            try:
+                async for image in request_iterator:
+                    task = asyncio.create_task(self.predict(image))
+                    task.add_done_callback(predicted.put_nowait)
+                    tasks.append(task)
+                await asyncio.gather(*tasks)
+            finally:
+                predicted.put_nowait(None)
+
+        receiver = asyncio.create_task(receive())
+        try:
+            while (task := await predicted.get()) is not None:
+                for region in task.result():
+                    yield region
+            await receiver
+        finally:
+            receiver.cancel()
+
+
+async def start_reference_server(port: int = 0, **kwargs):
+    """
+    :param port: 0 to pick a free port
+    :return: tuple(started server, bound port, servicer)
+    """
+    servicer = ReferenceInferenceServicer(**kwargs)
+    server = grpc.aio.server()
+    add_InferenceServicer_to_server(servicer, server)
+    port = server.add_insecure_port(f'127.0.0.1:{port}')
+    await server.start()
+    return server, port, servicer
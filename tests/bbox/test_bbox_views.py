@@ -1,6 +1,11 @@
 import asyncio
+import io
 import os
 from collections import Counter
+from email.parser import BytesParser
+from unittest.mock import patch
+
+import PIL.Image
 
 from fastapi.testclient import TestClient
 
@@ -14,7 +19,7 @@ os.environ['LAP_INFERENCE_ENABLED'] = 'false'
 
 from app.run import app
 
-from ..utils import insert_db_data, remove_data_dir
+from ..utils import insert_db_data, insert_image_files, remove_data_dir
 
 
 def test_get_bboxes_from_file():
@@ -28,6 +33,8 @@ def test_get_bboxes_from_file():
         result = response.json()
         assert len(result['items']) == len(testset['bboxes'])
         assert result['total'] == len(testset['bboxes'])
+        hashes = {o.id: o.hash for o in testset['images']}
+        assert all(o['image_hash'] == hashes[o['image_id']] for o in result['items'])
     remove_data_dir()
 
 
@@ -44,6 +51,7 @@ def test_get_bboxes_from_image():
             result = response.json()
             assert len(result['items']) == answers[image.id], \
                 f'total count of bboxes of {image} should be matched with prepared data'
+            assert all(o['image_hash'] == image.hash for o in result['items'])
     remove_data_dir()
 
 
@@ -189,3 +197,86 @@ def test_update_coordinates():
         result = response.json()
         for attr in attrs_to_update:
             assert getattr(bbox, attr) == result[attr]
+        assert result['image_hash'] == bbox.image_hash
+
+
+def test_update_coordinates_with_stale_version():
+    with TestClient(app) as client:
+        testsets = asyncio.get_event_loop().run_until_complete(insert_db_data())
+        assert len(testsets) > 0
+        testset = testsets[0]
+
+        bbox = testset['bboxes'][0]
+        bbox.rx1 = bbox.rx1 * 0.5
+
+        response = client.put(f"/bboxes/{bbox.id}",
+                              json=bbox.dict(),
+                              headers={'Content-Type': 'application/json'})
+        assert response.status_code == 200
+        assert response.json()['version'] == bbox.version + 1
+
+        response = client.put(f"/bboxes/{bbox.id}",
+                              json=bbox.dict(),
+                              headers={'Content-Type': 'application/json'})
+        assert response.status_code == 409, \
+            'updating a bbox with an outdated version should be rejected'
+    remove_data_dir()
+
+
+def parse_multipart(response) -> dict:
+    message = BytesParser().parsebytes(
+        f"Content-Type: {response.headers['Content-Type']}\r\n\r\n".encode() + response.content)
+    return {o.get_param('name', header='content-disposition'): o.get_payload(decode=True)
+            for o in message.get_payload()}
+
+
+def test_get_crops_by_ids():
+    with TestClient(app) as client:
+        insert_image_files()
+        testsets = asyncio.get_event_loop().run_until_complete(insert_db_data())
+        assert len(testsets) > 0
+        testset = testsets[0]
+        ids = [o.id for o in testset['bboxes'][:3]]
+
+        response = client.get('/bboxes/crops', params={'ids': ids + [int(1e9)], 'size': 64})
+        assert response.status_code == 200
+        assert response.headers['Content-Type'].startswith('multipart/form-data')
+        crops = parse_multipart(response)
+        assert list(crops.keys()) == [str(o) for o in ids], 'bboxes which do not exist should be ignored'
+        for crop in crops.values():
+            assert max(PIL.Image.open(io.BytesIO(crop)).size) <= 64
+
+        response = client.get('/bboxes/crops', params={'ids': ids + [int(1e9)], 'size': 64},
+                              headers={'If-None-Match': response.headers['ETag']})
+        assert response.status_code == 304
+    remove_data_dir()
+
+
+def test_get_crops_of_page():
+    with TestClient(app) as client:
+        insert_image_files()
+        testsets = asyncio.get_event_loop().run_until_complete(insert_db_data())
+        assert len(testsets) > 0
+        testset = testsets[0]
+
+        params = {'file_id': testset['file'].id, 'page': 1, 'items_per_page': 2}
+        bboxes = client.get('/bboxes', params=params).json()['items']
+        response = client.get('/bboxes/crops', params=params)
+        assert response.status_code == 200
+        assert list(parse_multipart(response).keys()) == [str(o['id']) for o in bboxes]
+    remove_data_dir()
+
+
+def test_get_crops_of_capped_page():
+    with TestClient(app) as client:
+        insert_image_files()
+        testsets = asyncio.get_event_loop().run_until_complete(insert_db_data())
+        file_id = testsets[0]['file'].id
+        bboxes = client.get('/bboxes', params={'file_id': file_id, 'page': 1, 'items_per_page': 2}).json()['items']
+        with patch('app.bbox.views.MAX_CROPS_PER_REQUEST', 2):
+            for params in ({}, {'items_per_page': -1}, {'items_per_page': 100}):
+                response = client.get('/bboxes/crops', params={'file_id': file_id, **params})
+                assert response.status_code == 200
+                assert list(parse_multipart(response).keys()) == [str(o['id']) for o in bboxes], \
+                    'a page should have at most the maximum number of crops'
+    remove_data_dir()
@@ -0,0 +1,150 @@
+import asyncio
+import hashlib
+import io
+import os
+import shutil
+import unittest
+from unittest.mock import patch
+
+import PIL.Image
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_pipeline')
+os.environ['LAP_PATH_DATA'] = DATA_DIR
+
+from config import CONFIG
+from database.core import create_engine, create_tables, dispose_engine, get_session
+from common.grpcpool import close_channel_pools
+from app.bbox.service import get_all as get_bboxes
+from app.file.schemas import FileCreate
+from app.file.service import insert as insert_file, get_one as get_file
+from app.file.pipeline import FilePipeline
+from app.file.progress import PROGRESS
+from app.image.phash import NearDuplicateIndex
+from app.image.schemas import ImageBase
+from app.image.service import get_all as get_images
+from app.image.storage import IMAGE_STORAGE
+from app.image.utils import is_image_hash_pinned, pin_image_hashes
+from benchmarks.fake_torchserve import start_fake_torchserve
+
+
+class TestFilePipeline(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.dbpath = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_file_pipeline.db')
+        create_engine(f'sqlite+aiosqlite:///{self.dbpath}')
+        await create_tables(drop=True)
+        self.server, self.port, self.servicer = await start_fake_torchserve(latency=0.01)
+        self.inference_config = {'host': '127.0.0.1', 'grpc_inference_port': self.port,
+                                 'grpc_management_port': self.port, 'project': 'fake'}
+        self.requests_before_last_download = 0
+        self.downloaded = {}
+
+    async def asyncTearDown(self) -> None:
+        await close_channel_pools()
+        await self.server.stop(None)
+        await dispose_engine()
+        os.remove(self.dbpath)
+        if os.path.exists(DATA_DIR):
+            shutil.rmtree(DATA_DIR)
+
+    async def fake_download(self, _, url):
+        await asyncio.sleep(0.01)
+        if url.endswith('broken'):
+            return False, f'url: {url}. response: 404'
+        buffer = io.BytesIO()
+        width = 100 + int(url.rsplit('/', 1)[-1])
+        PIL.Image.new('RGB', (width, 100)).save(buffer, format='JPEG')
+        data = buffer.getvalue()
+        image_hash = hashlib.sha256(data).hexdigest()
+        await IMAGE_STORAGE.write(image_hash, data)
+        self.downloaded[url] = data
+        self.requests_before_last_download = self.servicer.requests
+        return True, ImageBase(hash=image_hash, width=width, height=100, url=url)
+
+    async def run_pipeline(self, urls):
+        async for session in get_session():
+            file = await insert_file(session, FileCreate(name='file.csv', size=1))
+        file.cnt_url = len(urls)
+        with patch('app.file.pipeline.download_image', self.fake_download), \
+                patch.dict(CONFIG, {'inference_server': self.inference_config}):
+            await FilePipeline(file, urls).run()
+        async for session in get_session():
+            file, bboxes = await get_file(session, file.id), await get_bboxes(session, file_id=file.id)
+        return file, bboxes
+
+    async def test_run(self):
+        urls = [f'http://images/{i}' for i in range(100)] + ['http://images/broken', 'http://images/0']
+        file, bboxes = await self.run_pipeline(urls)
+        self.assertEqual(100, file.cnt_image)
+        self.assertEqual(1, file.cnt_download_failure)
+        self.assertEqual(1, file.cnt_duplicated_image)
+        self.assertEqual(100, file.cnt_bbox)
+        self.assertEqual(100, len(bboxes))
+        self.assertIsNone(file.error)
+
+        progress = PROGRESS.get(file.id)
+        self.assertEqual({'downloaded': 101, 'inserted': 100, 'inferred': 100, 'persisted': 100},
+                         progress.counts)
+        self.assertEqual(2, progress.skipped, 'a failed download and a duplicate should be skipped')
+        self.assertTrue(progress.finished)
+
+    async def test_skip_near_duplicates(self):
+        download = self.fake_download
+
+        async def fake_download_with_phash(session, url):
+            success, image = await download(session, url)
+            if success:
+                image.phash = 0
+            return success, image
+
+        self.fake_download = fake_download_with_phash
+        urls = [f'http://images/{i}' for i in range(5)] + ['http://images/0']
+        with patch('app.image.service.NEAR_DUPLICATES', NearDuplicateIndex(distance=0, action='skip')):
+            file, _ = await self.run_pipeline(urls)
+        self.assertEqual(1, file.cnt_image)
+        self.assertEqual(4, file.cnt_near_duplicated_image)
+        self.assertEqual(1, file.cnt_duplicated_image, 'skipped near-duplicates should not be counted as duplicates')
+
+    async def test_unpin_images_when_cancelled(self):
+        download = self.fake_download
+        pinned = []
+
+        async def fake_download_with_pin(session, url):
+            success, image = await download(session, url)
+            pin_image_hashes([image.hash])
+            pinned.append(image.hash)
+            return success, image
+
+        self.fake_download = fake_download_with_pin
+        with patch.dict(CONFIG, {'pipeline': {'queue_size': 1}}):
+            task = asyncio.create_task(self.run_pipeline([f'http://images/{i}' for i in range(100)]))
+            while len(pinned) < 20:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        self.assertEqual([], [o for o in pinned if is_image_hash_pinned(o)],
+                         'images which are not inserted should be unpinned')
+
+    async def test_infer_while_downloading(self):
+        await self.run_pipeline([f'http://images/{i}' for i in range(100)])
+        self.assertGreater(self.requests_before_last_download, 0,
+                           'inference should start before all images are downloaded')
+
+    async def test_insert_images_when_inference_fails(self):
+        self.inference_config['grpc_inference_port'] = 1
+        file, bboxes = await self.run_pipeline([f'http://images/{i}' for i in range(10)])
+        self.assertEqual(10, file.cnt_image)
+        self.assertEqual(-1, file.cnt_bbox)
+        self.assertEqual(0, len(bboxes))
+
+    async def test_isolate_failed_images(self):
+        self.servicer._broken = lambda data: data == self.downloaded.get('http://images/5')
+        file, bboxes = await self.run_pipeline([f'http://images/{i}' for i in range(10)])
+        self.assertEqual(10, file.cnt_image)
+        self.assertEqual(9, file.cnt_bbox, 'a broken image should not stop the others')
+        self.assertEqual(1, file.cnt_inference_failure)
+        self.assertIsNone(file.error)
+        async for session in get_session():
+            images = await get_images(session, file.id)
+        self.assertEqual(['http://images/5'], [o.url for o in images if o.inference_error is not None])
+        self.assertEqual(['http://images/5'], [o.url for o in images if o.inferred_at is None])
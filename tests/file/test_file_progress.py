@@ -0,0 +1,95 @@
+import json
+import os
+import unittest
+from unittest.mock import patch
+
+os.environ['LAP_PATH_DATA'] = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_progress')
+
+from app.file import progress as progress_module
+from app.file.progress import FileProgress, ProgressRegistry, PROGRESS, progress_events
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestFileProgress(unittest.TestCase):
+    def setUp(self) -> None:
+        self.clock = FakeClock()
+        patcher = patch.object(progress_module, 'monotonic', self.clock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_throughput_over_window(self):
+        progress = FileProgress(1, total=100)
+        for _ in range(5):
+            self.clock.now += 1
+            progress.add('downloaded', 10)
+            progress.add('persisted', 2)
+        throughput = progress.throughput()
+        self.assertAlmostEqual(10, throughput['downloaded'])
+        self.assertAlmostEqual(2, throughput['persisted'])
+        self.assertEqual(0, throughput['inferred'])
+        self.assertAlmostEqual((100 - 10) / 2, progress.eta(throughput))
+
+        # throughput falls while a stage makes no progress
+        self.clock.now += 5
+        self.assertAlmostEqual(5, progress.throughput()['downloaded'])
+
+    def test_samples_are_bounded_by_window(self):
+        progress = FileProgress(1)
+        for _ in range(1000):
+            self.clock.now += 0.1
+            progress.add('inferred')
+        window = progress_module.throughput_window() / progress_module.progress_interval()
+        self.assertLessEqual(len(progress._samples), window + 2)
+        self.assertAlmostEqual(10, progress.throughput()['inferred'])
+        self.assertIsNone(progress.eta(), 'eta is unknown without total')
+
+    def test_skipped_images_are_not_waited_for(self):
+        progress = FileProgress(1, total=10)
+        self.clock.now += 1
+        progress.add('persisted', 5)
+        progress.skip(5)
+        self.assertEqual(0, progress.eta())
+
+    def test_finish(self):
+        registry = ProgressRegistry()
+        progress = registry.start(1, total=10)
+        registry.finish(1, error='Failed to get inference result')
+        self.assertTrue(progress.finished)
+        self.assertIsNone(progress.eta())
+        self.assertEqual('Failed to get inference result', registry.get(1).dict()['error'])
+
+        with patch.object(progress_module, 'FINISHED_RETENTION', -1):
+            self.assertIsNone(registry.get(1), 'finished progress should expire')
+            self.assertEqual([], registry.get_all())
+
+
+class TestProgressEvents(unittest.IsolatedAsyncioTestCase):
+    async def asyncTearDown(self) -> None:
+        PROGRESS.clear()
+
+    async def test_events_of_changed_progress(self):
+        PROGRESS.start(1, total=10).add('downloaded', 3)
+        PROGRESS.finish(1)
+        checks = 0
+
+        async def is_disconnected():
+            nonlocal checks
+            checks += 1
+            return checks > 3
+
+        with patch.object(progress_module, 'progress_interval', lambda: 0.01):
+            events = [o async for o in progress_events(is_disconnected)]
+        # finished progress doesn't change, so it is sent only once
+        self.assertEqual(1, len(events))
+        name, data = events[0].rstrip('\n').split('\n')
+        self.assertEqual('event: progress', name)
+        progress = json.loads(data.removeprefix('data: '))
+        self.assertEqual([1], [o['file_id'] for o in progress])
+        self.assertEqual(3, progress[0]['downloaded'])
@@ -1,13 +1,19 @@
 import unittest
 import os
+from sqlalchemy import select
 from sqlalchemy.ext.asyncio import create_async_engine
 
+from database.core import Base, enable_sqlite_foreign_keys
+from app.bbox.models import BBox
+from app.label.models import Label
 from app.file.schemas import FileCreate, FileUpdate
-from app.file.service import insert, get_all, get_one, update, delete
+from app.file.service import insert, get_all, get_one, update, delete, soft_delete, purge
+from app.image.service import get_all as get_images
 from common.exceptions import ParameterExistError, ParameterNotFoundError
 
 from ..database import create_database, dispose_database, get_session, remove_session
 from ..factories import FileFactory
+from ..utils import insert_db_data
 
 
 class TestFileService(unittest.IsolatedAsyncioTestCase):
@@ -65,3 +71,43 @@ class TestFileService(unittest.IsolatedAsyncioTestCase):
         await delete(self.session, file.id)
         with self.assertRaises(ParameterNotFoundError):
             await get_one(self.session, file.id)
+
+    async def test_soft_delete(self):
+        datasets = await insert_db_data(f'{self.dirname}/{self.dbname}')
+        file_id = datasets[0]['file'].id
+        await soft_delete(self.session, file_id)
+        with self.assertRaises(ParameterNotFoundError):
+            await get_one(self.session, file_id)
+        r = await get_one(self.session, file_id, include_deleted=True)
+        self.assertIsNotNone(r.deleted_at)
+        self.assertNotIn(file_id, [o.id for o in await get_all(self.session)])
+
+    async def test_purge(self):
+        datasets = await insert_db_data(f'{self.dirname}/{self.dbname}')
+        await self._test_purge(datasets)
+
+    async def test_purge_tables_without_cascade(self):
+        # tables created before their foreign keys had ON DELETE CASCADE are never altered by create_all
+        await dispose_database(self.engine)
+        enable_sqlite_foreign_keys(self.engine)
+        constraints = [o for table in Base.metadata.tables.values() for o in table.foreign_key_constraints
+                       if o.ondelete == 'CASCADE']
+        try:
+            for constraint in constraints:
+                constraint.ondelete = None
+            await create_database(self.engine)
+        finally:
+            for constraint in constraints:
+                constraint.ondelete = 'CASCADE'
+        datasets = await insert_db_data(f'{self.dirname}/{self.dbname}')
+        await self._test_purge(datasets)
+
+    async def _test_purge(self, datasets: list):
+        file_id = datasets[0]['file'].id
+        r = await purge(self.session, file_id, chunk_size=2)
+        self.assertEqual(len(datasets[0]['images']), r)
+        self.assertEqual(0, len(await get_images(self.session, file_id)))
+        self.assertIsNone(await get_one(self.session, file_id, silent=True, include_deleted=True))
+        self.assertEqual(len(datasets[1]['bboxes']), len(list(await self.session.scalars(select(BBox.id)))),
+                         'only bboxes of the purged file should be deleted')
+        self.assertEqual(len(datasets[1]['bboxes']), len(list(await self.session.scalars(select(Label.id)))))
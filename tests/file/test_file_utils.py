@@ -1,7 +1,6 @@
 import unittest
 import os
 import shutil
-import time
 import io
 
 from fastapi import UploadFile
@@ -12,14 +11,12 @@ os.environ['LAP_PATH_DATA'] = DATA_DIR
 from common.exceptions import (ParameterEmptyError, ParameterExistError,
                                ParameterValueError, ParameterNotFoundError)
 from app.file.utils import (get_file_dirpath, save_file, remove_file,
-                            urls_from_file, download_images)
+                            urls_from_file)
 
 
 class TestFileUtil(unittest.IsolatedAsyncioTestCase):
     def setUp(self) -> None:
         self.non_image_url = 'https://google.com'
-        # Set a valid image url to test some test cases
-        self.image_url = ''
 
     def tearDown(self) -> None:
         if os.path.exists(DATA_DIR):
@@ -91,20 +88,3 @@ class TestFileUtil(unittest.IsolatedAsyncioTestCase):
         self.assertFalse(os.path.exists(os.path.join(get_file_dirpath(), file_name)))
         with self.assertRaises(ParameterNotFoundError):
             await urls_from_file('non_exist_file.csv')
-
-    async def test_download_images_from_url(self):
-        self.assertTrue(len(self.image_url) > 0,
-                        msg='you should add a valid image url to the variable "valid_image_url"')
-
-        r = await download_images([self.image_url])
-        self.assertEqual(1, len(r))
-
-    async def test_download_images_from_non_existent_url(self):
-        image_url = f'http://non-existent.image.url/{int(time.time())}'
-
-        r = await download_images([image_url])
-        self.assertEqual(0, len(r))
-
-    async def test_download_images_from_non_image_url(self):
-        r = await download_images([self.non_image_url])
-        self.assertEqual(0, len(r))
@@ -12,6 +12,7 @@ os.environ['LAP_DB_DBNAME'] = './test_file_views.db'
 os.environ['LAP_CLEAR'] = 'true'
 os.environ['LAP_INFERENCE_ENABLED'] = 'false'
 
+from app.file.progress import PROGRESS
 from app.file.utils import get_file_dirpath
 from app.run import app
 
@@ -104,6 +105,72 @@ def test_delete():
     remove_data_dir()
 
 
+def test_delete_purges_bboxes():
+    with TestClient(app) as client:
+        datasets = asyncio.get_event_loop().run_until_complete(insert_db_data())
+        file_id = datasets[0]['file'].id
+        response = client.delete(f"/files/{file_id}")
+        assert response.status_code == 204
+
+        response = client.get(f"/files/{file_id}")
+        assert response.status_code == 404, 'deleted file should not be found even before it is purged'
+
+        # wait for background process of purging the file to complete
+        end_time = time.time() + 10
+        while time.time() < end_time:
+            response = client.get('/bboxes', params={'file_id': file_id})
+            assert response.status_code == 200
+            if response.json()['total'] == 0:
+                break
+            time.sleep(0.1)
+        assert response.json()['total'] == 0
+    remove_data_dir()
+
+
+def test_reinfer_without_served_model():
+    with TestClient(app) as client:
+        datasets = asyncio.get_event_loop().run_until_complete(insert_db_data())
+        response = client.post(f"/files/{datasets[0]['file'].id}/reinfer")
+        assert response.status_code == 409
+        response = client.post(f"/files/{int(1e9)}/reinfer")
+        assert response.status_code == 404
+    remove_data_dir()
+
+
+def test_reinfer_failed_images_of_processing_file():
+    with TestClient(app) as client:
+        datasets = asyncio.get_event_loop().run_until_complete(insert_db_data())
+        # files of the test data are not inferred yet
+        response = client.post(f"/files/{datasets[0]['file'].id}/reinfer/failed")
+        assert response.status_code == 409
+        response = client.post(f"/files/{int(1e9)}/reinfer/failed")
+        assert response.status_code == 404
+    remove_data_dir()
+
+
+def test_get_progress():
+    with TestClient(app) as client:
+        datasets = asyncio.get_event_loop().run_until_complete(insert_db_data())
+        file_id = datasets[0]['file'].id
+        progress = PROGRESS.start(file_id, total=10)
+        progress.add('downloaded', 3)
+
+        response = client.get(f"/files/{file_id}/progress")
+        assert response.status_code == 200
+        assert response.json()['total'] == 10
+        assert response.json()['downloaded'] == 3
+        assert response.json()['finished_at'] is None
+
+        response = client.get('/files/progress')
+        assert response.status_code == 200
+        assert file_id in [o['file_id'] for o in response.json()]
+
+        PROGRESS.clear()
+        response = client.get(f"/files/{file_id}/progress")
+        assert response.status_code == 404
+    remove_data_dir()
+
+
 def _insert_file(_client, filename, content):
     response = _client.post('/files', files={'file': (filename, content, 'text/csv')})
     assert response.status_code == 200
@@ -0,0 +1,62 @@
+import unittest
+import io
+import os
+import shutil
+
+import PIL.Image
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_crop')
+os.environ['LAP_PATH_DATA'] = DATA_DIR
+
+from common.exceptions import ParameterValueError
+from app.image.crop import CropCache, render_crop, verify_crop_parameters
+from app.image.utils import get_image_file_path
+
+
+class TestImageCrop(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.hash = '6dc982440b8174cdf7f6251637c3f8d7acd32d2cc606746d5b1495ba86a34e32'
+        self.path = get_image_file_path(self.hash, not_exist_ok=True)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        PIL.Image.new('RGB', (2000, 1000), color=(255, 0, 0)).save(self.path, format='JPEG')
+
+    def tearDown(self) -> None:
+        if os.path.exists(DATA_DIR):
+            shutil.rmtree(DATA_DIR)
+
+    def test_render_crop(self):
+        data = render_crop(self.path, (0.0, 0.0, 0.5, 0.5), 100, 'jpeg')
+        pil_image = PIL.Image.open(io.BytesIO(data))
+        self.assertEqual('JPEG', pil_image.format)
+        self.assertEqual((100, 50), pil_image.size, 'crop should keep aspect ratio within the given size')
+
+    def test_render_crop_webp(self):
+        data = render_crop(self.path, (0.1, 0.1, 0.2, 0.2), 64, 'webp')
+        pil_image = PIL.Image.open(io.BytesIO(data))
+        self.assertEqual('WEBP', pil_image.format)
+
+    def test_verify_invalid_parameters(self):
+        with self.assertRaises(ParameterValueError):
+            verify_crop_parameters((0.5, 0.0, 0.4, 1.0), 100, 'jpeg')
+        with self.assertRaises(ParameterValueError):
+            verify_crop_parameters((0.0, 0.0, 1.0, 1.0), 100000, 'jpeg')
+        with self.assertRaises(ParameterValueError):
+            verify_crop_parameters((0.0, 0.0, 1.0, 1.0), 100, 'gif')
+
+    async def test_cache(self):
+        cache = CropCache(max_bytes=1024 ** 2)
+        box = (0.0, 0.0, 1.0, 1.0)
+        data = await cache.get(self.hash, box, 64, 'jpeg')
+        self.assertTrue(os.path.exists(cache.path(cache.key(self.hash, box, 64, 'jpeg'))))
+        self.assertEqual(data, await cache.get(self.hash, box, 64, 'jpeg'))
+
+    async def test_cache_eviction(self):
+        box1, box2 = (0.0, 0.0, 0.5, 0.5), (0.5, 0.5, 1.0, 1.0)
+        data = await CropCache(max_bytes=1024 ** 2).get(self.hash, box1, 64, 'jpeg')
+
+        cache = CropCache(max_bytes=len(data) + 1)
+        await cache.get(self.hash, box1, 64, 'jpeg')
+        await cache.get(self.hash, box2, 64, 'jpeg')
+        self.assertFalse(os.path.exists(cache.path(cache.key(self.hash, box1, 64, 'jpeg'))),
+                         'least recently used crop should be evicted')
+        self.assertTrue(os.path.exists(cache.path(cache.key(self.hash, box2, 64, 'jpeg'))))
@@ -0,0 +1,122 @@
+import unittest
+import os
+import shutil
+from unittest.mock import patch
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_gc')
+os.environ['LAP_PATH_DATA'] = DATA_DIR
+
+from config import CONFIG
+from app.file.schemas import FileCreate
+from app.file.service import insert as insert_file
+from app.image.gc import ImageGarbageCollector
+from app.image.storage import ShardedStorage, variant_key
+from app.image.schemas import ImageBase
+from app.image.service import insert
+from app.image.utils import get_image_file_path, pin_image_hashes, unpin_image_hashes
+from app.export.utils import get_export_dir
+
+from ..database import create_database, dispose_database, get_session, remove_session
+
+
+class TestImageGarbageCollector(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.dirname = os.path.dirname(os.path.realpath(__file__))
+        self.dbname = 'test_image_gc.db'
+        self.engine = create_async_engine(f'sqlite+aiosqlite:///{self.dirname}/{self.dbname}')
+        await create_database(self.engine)
+        self.session = get_session(self.engine)
+        self.gc = ImageGarbageCollector({'batch_size': 2, 'batch_interval': 0, 'min_age': 0})
+
+    async def asyncTearDown(self) -> None:
+        await remove_session(self.session)
+        await dispose_database(self.engine)
+        os.remove(f'{self.dirname}/{self.dbname}')
+        if os.path.exists(DATA_DIR):
+            shutil.rmtree(DATA_DIR)
+
+    @staticmethod
+    def fake_image_file(hash_: str) -> str:
+        hash_path = get_image_file_path(hash_, not_exist_ok=True)
+        os.makedirs(os.path.dirname(hash_path), exist_ok=True)
+        with open(hash_path, 'w') as f:
+            f.write('temporary file')
+        return hash_path
+
+    async def test_dry_run(self):
+        orphan = self.fake_image_file('a' * 64)
+        r = await self.gc.run(self.session, dry_run=True)
+        self.assertEqual(1, r.orphans)
+        self.assertEqual(os.path.getsize(orphan), r.reclaimed_bytes)
+        self.assertTrue(os.path.exists(orphan), 'dry run should not delete files')
+        self.assertEqual(0, self.gc.statistics().reclaimed_bytes)
+
+    async def test_delete_orphans_only(self):
+        orphan = self.fake_image_file('a' * 64)
+        referenced = self.fake_image_file('b' * 64)
+        exported = self.fake_image_file('c' * 64)
+        pinned = self.fake_image_file('d' * 64)
+        file = await insert_file(self.session, FileCreate(name='file.csv', size=1))
+        await insert(self.session, [ImageBase(hash='b' * 64, width=1, height=1, url='url')], file_id=file.id)
+        os.makedirs(get_export_dir(), exist_ok=True)
+        os.symlink(exported, os.path.join(get_export_dir(), os.path.basename(exported)))
+        pin_image_hashes(['d' * 64])
+
+        try:
+            r = await self.gc.run(self.session, dry_run=False)
+        finally:
+            unpin_image_hashes(['d' * 64])
+        self.assertEqual(4, r.scanned)
+        self.assertEqual(1, r.orphans)
+        self.assertEqual(1, r.skipped, 'pinned image file should be skipped')
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(referenced))
+        self.assertTrue(os.path.exists(exported))
+        self.assertTrue(os.path.exists(pinned))
+        self.assertEqual(r.reclaimed_bytes, self.gc.statistics().reclaimed_bytes)
+
+    async def test_keep_image_ingested_during_collection(self):
+        orphan = self.fake_image_file('a' * 64)
+        file = await insert_file(self.session, FileCreate(name='file.csv', size=1))
+        referenced = self.gc._referenced
+
+        async def ingest_while_querying(session, hashes):
+            r = await referenced(session, hashes)
+            if 'a' * 64 not in r:
+                # the file of the image exists, so ingestion doesn't write it again
+                pin_image_hashes(['a' * 64])
+                try:
+                    async with AsyncSession(self.engine, expire_on_commit=False) as ingestion:
+                        await insert(ingestion, [ImageBase(hash='a' * 64, width=1, height=1, url='url')],
+                                     file_id=file.id)
+                finally:
+                    unpin_image_hashes(['a' * 64])
+            return r
+
+        with patch.object(self.gc, '_referenced', ingest_while_querying):
+            r = await self.gc.run(self.session, dry_run=False)
+        self.assertEqual(0, r.orphans)
+        self.assertEqual(1, r.skipped)
+        self.assertTrue(os.path.exists(orphan), 'image file referenced during collection should not be deleted')
+
+    async def test_skip_recently_written_files(self):
+        gc = ImageGarbageCollector({'min_age': 3600})
+        orphan = self.fake_image_file('a' * 64)
+        r = await gc.run(self.session, dry_run=False)
+        self.assertEqual(0, r.orphans)
+        self.assertEqual(1, r.skipped)
+        self.assertTrue(os.path.exists(orphan))
+
+    @patch.dict(CONFIG, {'pyramid': {'sizes': [64]}})
+    async def test_delete_variants_of_orphans(self):
+        orphan = self.fake_image_file('a' * 64)
+        variant = ShardedStorage.path(variant_key('a' * 64, 64))
+        with open(variant, 'w') as f:
+            f.write('temporary variant')
+
+        r = await self.gc.run(self.session, dry_run=False)
+        self.assertEqual(1, r.scanned, 'variants should not be scanned as original image files')
+        self.assertEqual(len('temporary file') + len('temporary variant'), r.reclaimed_bytes)
+        self.assertFalse(os.path.exists(orphan))
+        self.assertFalse(os.path.exists(variant))
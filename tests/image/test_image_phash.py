@@ -0,0 +1,45 @@
+import unittest
+import io
+import random
+
+import PIL.Image
+
+from app.image.phash import NearDuplicateIndex, compute_dhash, hamming_distance
+
+
+def encode(im: PIL.Image.Image, **kwargs) -> bytes:
+    buffer = io.BytesIO()
+    im.save(buffer, format='JPEG', **kwargs)
+    return buffer.getvalue()
+
+
+def random_image(seed: int) -> PIL.Image.Image:
+    rand = random.Random(seed)
+    im = PIL.Image.new('L', (16, 12))
+    im.putdata([rand.randrange(256) for _ in range(16 * 12)])
+    return im.resize((640, 480), PIL.Image.Resampling.BILINEAR).convert('RGB')
+
+
+class TestImagePHash(unittest.TestCase):
+    def test_dhash_of_resized_image(self):
+        im = random_image(0)
+        original = compute_dhash(encode(im, quality=95))
+        resized = compute_dhash(encode(im.resize((320, 240)), quality=60))
+        different = compute_dhash(encode(random_image(1), quality=95))
+        self.assertLessEqual(hamming_distance(original, resized), 4)
+        self.assertGreater(hamming_distance(original, different), 10)
+        self.assertTrue(-(1 << 63) <= original < (1 << 63), 'hash should fit in a signed 64 bit integer')
+
+    def test_index(self):
+        index = NearDuplicateIndex(distance=3)
+        index.add(1, 0b1111)
+        index.add(2, -1)
+        self.assertEqual(1, index.find(0b0111))
+        self.assertEqual(1, index.find(0b1111 | (1 << 63)))
+        self.assertEqual(2, index.find(-1 ^ 0b111))
+        self.assertIsNone(index.find(0xFFFF << 16))
+
+        index.remove([1])
+        self.assertEqual(1, len(index))
+        self.assertIsNone(index.find(0b0111))
+
@@ -0,0 +1,47 @@
+import unittest
+import io
+import os
+import shutil
+from unittest.mock import patch
+
+import PIL.Image
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_pyramid')
+os.environ['LAP_PATH_DATA'] = DATA_DIR
+
+from config import CONFIG
+from app.image.pyramid import render_variants, locate_nearest_image, create_variants, pyramid_sizes
+from app.image.storage import ShardedStorage, variant_key
+from app.image.utils import get_image_file_path
+
+
+@patch.dict(CONFIG, {'pyramid': {'sizes': [64, 128]}})
+class TestImagePyramid(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.hash = '6dc982440b8174cdf7f6251637c3f8d7acd32d2cc606746d5b1495ba86a34e32'
+        self.path = get_image_file_path(self.hash, not_exist_ok=True)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        PIL.Image.new('RGB', (400, 200)).save(self.path, format='JPEG')
+
+    def tearDown(self) -> None:
+        if os.path.exists(DATA_DIR):
+            shutil.rmtree(DATA_DIR)
+
+    def test_pyramid_sizes_from_string(self):
+        with patch.dict(CONFIG, {'pyramid': {'sizes': '512,256'}}):
+            self.assertEqual([256, 512], pyramid_sizes())
+
+    def test_render_variants(self):
+        r = dict(render_variants(self.path, [64, 128, 1024]))
+        self.assertEqual([128, 64], list(r.keys()), 'variants larger than the original should not be rendered')
+        self.assertEqual((128, 64), PIL.Image.open(io.BytesIO(r[128])).size)
+        self.assertEqual((64, 32), PIL.Image.open(io.BytesIO(r[64])).size)
+
+    async def test_locate_nearest_image(self):
+        self.assertEqual(2, await create_variants(self.hash))
+        self.assertEqual(0, await create_variants(self.hash), 'existing variants should not be rendered again')
+        variant_path = ShardedStorage.path(variant_key(self.hash, 64))
+        self.assertEqual((variant_key(self.hash, 64), variant_path), locate_nearest_image(self.hash, 10))
+        self.assertEqual(variant_key(self.hash, 128), locate_nearest_image(self.hash, 100)[0])
+        self.assertEqual((self.hash, self.path), locate_nearest_image(self.hash, 300))
+        self.assertEqual((self.hash, self.path), locate_nearest_image(self.hash))
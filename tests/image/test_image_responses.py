@@ -0,0 +1,77 @@
+import unittest
+import os
+import shutil
+
+from starlette.requests import Request
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_responses')
+os.environ['LAP_PATH_DATA'] = DATA_DIR
+
+from app.image.responses import make_etag, etag_matches, parse_range, RangeNotSatisfiable, \
+    file_response, content_response, IMMUTABLE
+
+
+def fake_request(**headers) -> Request:
+    return Request({'type': 'http',
+                    'headers': [(k.replace('_', '-').encode(), v.encode()) for k, v in headers.items()]})
+
+
+class TestImageResponses(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.etag = make_etag('6dc982440b8174cdf7f6251637c3f8d7acd32d2cc606746d5b1495ba86a34e32')
+        self.content = bytes(range(100))
+        os.makedirs(DATA_DIR, exist_ok=True)
+        self.path = os.path.join(DATA_DIR, 'image.jpg')
+        with open(self.path, 'wb') as f:
+            f.write(self.content)
+
+    def tearDown(self) -> None:
+        if os.path.exists(DATA_DIR):
+            shutil.rmtree(DATA_DIR)
+
+    def test_etag_matches(self):
+        self.assertFalse(etag_matches(fake_request(), self.etag))
+        self.assertTrue(etag_matches(fake_request(if_none_match=self.etag), self.etag))
+        self.assertTrue(etag_matches(fake_request(if_none_match=f'"other", W/{self.etag}'), self.etag))
+        self.assertTrue(etag_matches(fake_request(if_none_match='*'), self.etag))
+        self.assertFalse(etag_matches(fake_request(if_none_match='"other"'), self.etag))
+
+    def test_parse_range(self):
+        self.assertIsNone(parse_range(fake_request(), self.etag, 100))
+        self.assertEqual((0, 9), parse_range(fake_request(range='bytes=0-9'), self.etag, 100))
+        self.assertEqual((90, 99), parse_range(fake_request(range='bytes=90-'), self.etag, 100))
+        self.assertEqual((80, 99), parse_range(fake_request(range='bytes=-20'), self.etag, 100))
+        self.assertEqual((90, 99), parse_range(fake_request(range='bytes=90-200'), self.etag, 100))
+        self.assertIsNone(parse_range(fake_request(range='bytes=0-1,5-6'), self.etag, 100),
+                          'multiple ranges are not supported')
+        self.assertIsNone(parse_range(fake_request(range='bytes=0-9', if_range='"other"'), self.etag, 100),
+                          'whole content should be sent if the entity has changed')
+        with self.assertRaises(RangeNotSatisfiable):
+            parse_range(fake_request(range='bytes=100-'), self.etag, 100)
+
+    async def test_file_response(self):
+        r = await file_response(fake_request(), self.path, self.etag)
+        self.assertEqual(200, r.status_code)
+        self.assertEqual(self.etag, r.headers['etag'])
+        self.assertEqual(IMMUTABLE, r.headers['cache-control'])
+
+        r = await file_response(fake_request(if_none_match=self.etag), self.path, self.etag)
+        self.assertEqual(304, r.status_code)
+
+        r = await file_response(fake_request(range='bytes=10-19'), self.path, self.etag)
+        self.assertEqual(206, r.status_code)
+        self.assertEqual('bytes 10-19/100', r.headers['content-range'])
+        body = b''.join([chunk async for chunk in r.body_iterator])
+        self.assertEqual(self.content[10:20], body)
+
+        r = await file_response(fake_request(range='bytes=200-'), self.path, self.etag)
+        self.assertEqual(416, r.status_code)
+
+    def test_content_response(self):
+        r = content_response(fake_request(range='bytes=-10'), self.content, self.etag, 'image/jpeg')
+        self.assertEqual(206, r.status_code)
+        self.assertEqual(self.content[90:], r.body)
+
+        r = content_response(fake_request(if_none_match=self.etag), self.content, self.etag, 'image/jpeg')
+        self.assertEqual(304, r.status_code)
+        self.assertEqual(b'', r.body)
@@ -1,7 +1,9 @@
 import unittest
 import os
+from unittest.mock import patch
 from sqlalchemy.ext.asyncio import create_async_engine
 
+from app.image.phash import NearDuplicateIndex
 from app.image.schemas import ImageBase
 from app.image.service import insert, get_all, get_one
 from common.exceptions import ParameterNotFoundError
@@ -26,10 +28,10 @@ class TestImageService(unittest.IsolatedAsyncioTestCase):
     async def test_insert(self):
         file = FileFactory()
         image = ImageFactory.build()
-        r = await insert(self.session,
-                         [ImageBase(
-                             hash=image.hash, width=image.width, height=image.height, url=image.url)],
-                         file_id=file.id)
+        r, _ = await insert(self.session,
+                            [ImageBase(
+                                hash=image.hash, width=image.width, height=image.height, url=image.url)],
+                            file_id=file.id)
         self.assertEqual(1, len(r))
         self.assertIsNotNone(r[0].id)
         self.assertEqual(file.id, r[0].file_id)
@@ -37,10 +39,10 @@ class TestImageService(unittest.IsolatedAsyncioTestCase):
     async def test_insert_duplicate_imagehash_on_same_file(self):
         file = FileFactory()
         image = ImageFactory(file=file)
-        r = await insert(self.session,
-                         [ImageBase(
-                             hash=image.hash, width=image.width, height=image.height, url=image.url)],
-                         file_id=image.file_id)
+        r, _ = await insert(self.session,
+                            [ImageBase(
+                                hash=image.hash, width=image.width, height=image.height, url=image.url)],
+                            file_id=image.file_id)
         self.assertEqual(0, len(r),
                          msg='Inserting an image with a duplicate hash on same file should be ignored silently')
 
@@ -48,13 +50,35 @@ class TestImageService(unittest.IsolatedAsyncioTestCase):
         file1 = FileFactory()
         file2 = FileFactory()
         image = ImageFactory(file=file1)
-        r = await insert(self.session,
-                         [ImageBase(
-                             hash=image.hash, width=image.width, height=image.height, url=image.url)],
-                         file_id=file2.id)
+        r, _ = await insert(self.session,
+                            [ImageBase(
+                                hash=image.hash, width=image.width, height=image.height, url=image.url)],
+                            file_id=file2.id)
         self.assertEqual(0, len(r),
                          msg='Inserting an image with a duplicate hash on other files should be ignored silently')
 
+    async def test_insert_near_duplicates(self):
+        file = FileFactory()
+        images = [ImageBase(hash=f'{i:064x}', width=1, height=1, url='url', phash=o)
+                  for i, o in enumerate([0b000, 0b011, 0b111 << 8])]
+        with patch('app.image.service.NEAR_DUPLICATES', NearDuplicateIndex(distance=2)):
+            r, matches = await insert(self.session, images, file_id=file.id)
+        self.assertEqual(3, len(r), msg='Near-duplicates should be flagged')
+        self.assertEqual([None, r[0].id, None], [o.near_duplicate_of for o in r])
+        self.assertEqual({images[1].hash: r[0].id}, matches)
+        self.assertTrue(all(o.near_duplicate_of is None for o in images), msg='Given images should not be modified')
+
+    async def test_insert_near_duplicates_with_skip(self):
+        file = FileFactory()
+        images = [ImageBase(hash=f'{i:064x}', width=1, height=1, url='url', phash=o)
+                  for i, o in enumerate([0b000, 0b011])]
+        index = NearDuplicateIndex(distance=2, action='skip')
+        with patch('app.image.service.NEAR_DUPLICATES', index):
+            r, matches = await insert(self.session, images, file_id=file.id)
+        self.assertEqual(1, len(r), msg='Near-duplicates should not be inserted')
+        self.assertEqual({images[1].hash: r[0].id}, matches)
+        self.assertEqual(1, len(index))
+
     async def test_get_all(self):
         file = FileFactory()
         ImageFactory(file=file)
@@ -0,0 +1,116 @@
+import asyncio
+import unittest
+import os
+import shutil
+from unittest.mock import patch
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_storage')
+os.environ['LAP_PATH_DATA'] = DATA_DIR
+
+from common.exceptions import OperationError, ParameterNotFoundError, ParameterValueError
+from app.export.utils import get_export_dir
+from app.image import storage as storage_module
+from app.image.storage import PackedStorage, ShardedStorage, location_reference, migrate, parse_key, read_location, \
+    variant_key
+
+
+class TestImageStorage(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self.storage = PackedStorage(os.path.join(DATA_DIR, 'packs'), segment_size=10)
+
+    def tearDown(self) -> None:
+        self.storage.close()
+        if os.path.exists(DATA_DIR):
+            shutil.rmtree(DATA_DIR)
+
+    def test_parse_key(self):
+        self.assertEqual(('ab' * 32, 0), parse_key('ab' * 32))
+        self.assertEqual(('ab' * 32, 512), parse_key(variant_key('ab' * 32, 512)))
+        with self.assertRaises(ParameterValueError):
+            parse_key('../ab')
+
+    async def test_location_reference(self):
+        sharded = ShardedStorage()
+        await sharded.write('a' * 64, b'first image')
+        await self.storage.write('a' * 64, b'first image')
+        self.assertEqual(os.path.join('images', 'aa', f"{'a' * 64}.jpg"), location_reference(sharded.locate('a' * 64)))
+        self.assertEqual(os.path.join('packs', '00000001.pack') + '@0:11',
+                         location_reference(self.storage.locate('a' * 64)))
+
+    async def test_packed_write_and_read(self):
+        await self.storage.write('a' * 64, b'first image')
+        await self.storage.write('a' * 64, b'first image')
+        await self.storage.write(variant_key('a' * 64, 64), b'variant')
+        await self.storage.write('b' * 64, b'second image')
+
+        self.assertEqual(b'first image', read_location(self.storage.locate('a' * 64)))
+        self.assertEqual(b'variant', read_location(self.storage.locate(variant_key('a' * 64, 64))))
+        self.assertEqual(b'second image', read_location(self.storage.locate('b' * 64)))
+        self.assertEqual(2, len(self.storage.segments()), 'a new segment should be started when it is full')
+        self.assertEqual(['a' * 64, variant_key('a' * 64, 64), 'b' * 64], list(self.storage.keys()))
+
+        self.assertEqual(len(b'first image'), self.storage.delete('a' * 64))
+        self.assertIsNone(self.storage.stat('a' * 64))
+        with self.assertRaises(ParameterNotFoundError):
+            self.storage.locate('a' * 64)
+
+    async def test_packed_concurrent_writes(self):
+        images = {f'{i:02x}' * 32: f'image {i}'.encode() for i in range(10)}
+        await asyncio.gather(*[self.storage.write(k, v) for k, v in images.items()],
+                             self.storage.write('00' * 32, b'image 0'))
+
+        self.assertEqual(sorted(images), list(self.storage.keys()))
+        for key, data in images.items():
+            self.assertEqual(data, read_location(self.storage.locate(key)))
+
+    @patch.object(storage_module, 'RETIRED_SEGMENT_GRACE', 0)
+    async def test_packed_compaction(self):
+        await self.storage.write('a' * 64, b'deleted image')
+        await self.storage.write('b' * 64, b'live image')
+        await self.storage.write('c' * 64, b'active image')
+        self.storage.delete('a' * 64)
+        segments = self.storage.segments()
+
+        report = await self.storage.compact()
+        self.assertEqual(1, report.compacted_segments)
+        self.assertEqual(len(b'deleted image'), report.reclaimed_bytes)
+        self.assertNotIn(segments[0], self.storage.segments())
+        self.assertEqual(b'live image', read_location(self.storage.locate('b' * 64)))
+        self.assertEqual(b'active image', read_location(self.storage.locate('c' * 64)))
+
+    @patch.object(storage_module, 'GENERATION_CHECK_INTERVAL', 0)
+    async def test_packed_mappings_dropped_by_compaction(self):
+        # mappings of other processes are dropped when they see the generation bumped by compaction
+        await self.storage.write('a' * 64, b'first image')
+        await self.storage.write('b' * 64, b'second image')
+        first = self.storage.locate('a' * 64)
+        read_location(first)
+        self.assertIn(first[0], storage_module._segments)
+
+        self.storage._bump_generation()
+        self.assertEqual(b'second image', read_location(self.storage.locate('b' * 64)))
+        self.assertNotIn(first[0], storage_module._segments)
+        self.assertEqual(b'first image', read_location(first))
+
+    async def test_migrate(self):
+        sharded = ShardedStorage()
+        await sharded.write('a' * 64, b'first image')
+        await sharded.write(variant_key('a' * 64, 64), b'variant')
+
+        self.assertEqual(2, await migrate(sharded, self.storage, delete_source=True))
+        self.assertEqual([], list(sharded.keys()))
+        self.assertEqual(b'variant', read_location(self.storage.locate(variant_key('a' * 64, 64))))
+
+        self.assertEqual(2, await migrate(self.storage, sharded))
+        self.assertEqual(b'first image', read_location(sharded.locate('a' * 64)))
+
+    async def test_migrate_with_exports(self):
+        sharded = ShardedStorage()
+        await sharded.write('a' * 64, b'first image')
+        os.makedirs(get_export_dir())
+        os.symlink(sharded.locate('a' * 64), os.path.join(get_export_dir(), f"{'a' * 64}.jpg"))
+
+        with self.assertRaises(OperationError):
+            await migrate(sharded, self.storage, delete_source=True)
+        self.assertEqual(['a' * 64], list(sharded.keys()))
+        self.assertEqual(1, await migrate(sharded, self.storage))
@@ -1,6 +1,7 @@
 import asyncio
 import os
 import io
+from unittest.mock import patch
 
 import PIL.Image
 from fastapi.testclient import TestClient
@@ -13,6 +14,7 @@ os.environ['LAP_DB_DBNAME'] = './test_image_views.db'
 os.environ['LAP_CLEAR'] = 'true'
 os.environ['LAP_INFERENCE_ENABLED'] = 'false'
 
+from config import CONFIG
 from app.run import app
 
 from ..utils import insert_db_data, insert_image_files, remove_data_dir
@@ -48,8 +50,59 @@ def test_get_exists():
     remove_data_dir()
 
 
+def test_get_not_modified():
+    with TestClient(app) as client:
+        insert_image_files()
+        testsets = asyncio.get_event_loop().run_until_complete(insert_db_data())
+        assert len(testsets) > 0
+        testset = testsets[0]
+        response = client.get(f"/images/{testset['images'][0].id}")
+        assert response.status_code == 200
+        assert 'immutable' in response.headers.get('Cache-Control')
+        etag = response.headers.get('ETag')
+        assert etag == f'"{testset["images"][0].hash}"'
+
+        response = client.get(f"/images/{testset['images'][0].id}", headers={'If-None-Match': etag})
+        assert response.status_code == 304
+        assert len(response.content) == 0
+    remove_data_dir()
+
+
+def test_get_original_in_place_of_missing_variant():
+    with TestClient(app) as client:
+        insert_image_files()
+        testsets = asyncio.get_event_loop().run_until_complete(insert_db_data())
+        image = testsets[0]['images'][0]
+        # variants of the test images are not rendered
+        with patch.dict(CONFIG, {'pyramid': {'sizes': [256]}}):
+            response = client.get(f"/images/{image.id}", params={'size': 256})
+        assert response.status_code == 200
+        assert response.headers.get('ETag') == f'"{image.hash}"'
+        assert 'immutable' not in response.headers.get('Cache-Control'), \
+            'the original should not be cached as the variant for good'
+    remove_data_dir()
+
+
 def test_get_non_exists():
     with TestClient(app) as client:
         response = client.get(f"/images/{int(1e9)}")
         assert response.status_code == 404
     remove_data_dir()
+
+
+def test_get_by_hash():
+    with TestClient(app) as client:
+        insert_image_files()
+        testsets = asyncio.get_event_loop().run_until_complete(insert_db_data())
+        assert len(testsets) > 0
+        testset = testsets[0]
+        response = client.get(f"/images/by-hash/{testset['images'][0].hash}")
+        assert response.status_code == 200
+        pil_image = PIL.Image.open(io.BytesIO(response.content))
+        assert pil_image.width == testset['images'][0].width
+
+        response = client.get(f"/images/by-hash/{'0' * 64}")
+        assert response.status_code == 404
+        response = client.get('/images/by-hash/not-a-hash')
+        assert response.status_code == 400
+    remove_data_dir()
@@ -1,8 +1,11 @@
 import os
 import unittest
+from unittest.mock import patch
 
+from config import CONFIG
 from inference import InferenceClient
 from inference.inference_pb2 import Request, Reply
+from inference.servicer import start_reference_server
 from app.image.schemas import ImageRead
 
 # You need to run "grpc_tools.protoc" to parse "../../protos/*.proto" files
@@ -45,10 +48,14 @@ class TestInferenceClient(unittest.IsolatedAsyncioTestCase):
 
     async def test_make_request(self):
         client = InferenceClient()
-        request = Request()
         image = ImageRead(**self.db_image)
-        await client._make_request(request, image, self.db_image_path)
-        self.assertEqual(1, len(request.images))
+        request = Request.FromString(client._make_request([(image, self.db_image_path), (image, os.devnull)]))
+        self.assertEqual(2, len(request.images))
+        with open(self.db_image_path, 'rb') as f:
+            self.assertEqual(f.read(), request.images[0].data)
+        self.assertEqual((image.id, image.width, image.height),
+                         (request.images[0].id, request.images[0].width, request.images[0].height))
+        self.assertEqual(b'', request.images[1].data)
 
     def test_parse_reply(self):
         client = InferenceClient()
@@ -67,3 +74,41 @@ class TestInferenceClient(unittest.IsolatedAsyncioTestCase):
         data = r[0]
         self.assertEqual(tuple, type(data))
         self.assertEqual(image.id, data[0], msg='inferred data should have the requested image id')
+
+    async def infer_with_reference_server(self, batch_size: int = 2, read_by_reference: bool = False, **kwargs):
+        server, port, servicer = await start_reference_server(**kwargs)
+        try:
+            client = InferenceClient({'enabled': True, 'host': '127.0.0.1', 'port': port,
+                                      'batch_size': batch_size, 'max_in_flight': 3,
+                                      'read_by_reference': read_by_reference})
+            images = [(ImageRead(**{**self.db_image, 'id': i}), self.db_image_path) for i in range(1, 6)]
+            return await client.infer(images), servicer
+        finally:
+            await server.stop(None)
+
+    async def test_infer_by_stream(self):
+        r, servicer = await self.infer_with_reference_server()
+        self.assertEqual([1, 2, 3, 4, 5], sorted(o[0] for o in r))
+        self.assertEqual(0, servicer.requests, msg='compute should not be called if computeStream is supported')
+        self.assertEqual(5, servicer.images)
+
+    async def test_infer_in_concurrent_batches_without_stream(self):
+        r, servicer = await self.infer_with_reference_server(streaming=False)
+        self.assertEqual([1, 2, 3, 4, 5], [o[0] for o in r], msg='predictions should be in the order of images')
+        self.assertEqual([[1, 2], [3, 4], [5]], sorted(servicer.batches),
+                         msg='images should be sent in batches without an empty one')
+        self.assertEqual(5, servicer.images)
+
+    async def test_infer_by_reference(self):
+        data_dir = os.path.dirname(os.path.dirname(self.db_image_path))
+        with patch.dict(CONFIG['path'], {'data': data_dir}):
+            for streaming in (True, False):
+                r, servicer = await self.infer_with_reference_server(read_by_reference=True, streaming=streaming,
+                                                                     data_dir=data_dir)
+                self.assertEqual([1, 2, 3, 4, 5], sorted(o[0] for o in r))
+                self.assertEqual(5, servicer.references, msg='images should be sent by reference')
+
+    async def test_send_bytes_if_server_does_not_read_by_reference(self):
+        r, servicer = await self.infer_with_reference_server(read_by_reference=True)
+        self.assertEqual([1, 2, 3, 4, 5], sorted(o[0] for o in r))
+        self.assertEqual((0, 5), (servicer.references, servicer.images))
@@ -2,12 +2,13 @@ import unittest
 import os
 from sqlalchemy.ext.asyncio import create_async_engine
 
-from common.exceptions import ParameterNotFoundError
+from common.exceptions import ParameterNotFoundError, ParameterConflictError
 from app.label.schemas import LabelBase, LabelUpdate, LabelFilter
 from app.label.service import insert, get_one, update, get_all
 
 from ..database import create_database, dispose_database, get_session, remove_session
 from ..factories import LabelFactory, FileFactory, ImageFactory, BBoxFactory
+from ..utils import insert_db_data
 
 
 class TestLabelService(unittest.IsolatedAsyncioTestCase):
@@ -58,6 +59,19 @@ class TestLabelService(unittest.IsolatedAsyncioTestCase):
         self.assertEqual(unused, r.unused)
         self.assertEqual(reviewed, r.reviewed)
 
+    async def test_update_with_stale_version(self):
+        datasets = await insert_db_data(f'{self.dirname}/{self.dbname}')
+        label1 = datasets[0]['bboxes'][0].label
+
+        r = await update(self.session, LabelUpdate(id=label1.id, reviewed=True, version=label1.version))
+        self.assertEqual(label1.version + 1, r.version)
+        with self.assertRaises(ParameterConflictError):
+            await update(self.session, LabelUpdate(id=label1.id, reviewed=False, version=label1.version))
+
+    async def test_update_non_exists(self):
+        with self.assertRaises(ParameterNotFoundError):
+            await update(self.session, LabelUpdate(id=int(1e9), reviewed=True))
+
     async def test_get_all(self):
         LabelFactory(unused=False, reviewed=False)
         LabelFactory(unused=False, reviewed=False)
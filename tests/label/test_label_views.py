@@ -50,6 +50,28 @@ def test_update_reviewed():
     remove_data_dir()
 
 
+def test_update_with_stale_version():
+    with TestClient(app) as client:
+        testsets = asyncio.get_event_loop().run_until_complete(insert_db_data())
+        assert len(testsets) > 0
+        testset = testsets[0]
+
+        label = testset['bboxes'][0].label
+        label.reviewed = not label.reviewed
+        response = client.put(f"/labels/{label.id}",
+                              json=label.dict(),
+                              headers={'Content-Type': 'application/json'})
+        assert response.status_code == 200
+        assert response.json()['version'] == label.version + 1
+
+        response = client.put(f"/labels/{label.id}",
+                              json=label.dict(),
+                              headers={'Content-Type': 'application/json'})
+        assert response.status_code == 409, \
+            'updating a label with an outdated version should be rejected'
+    remove_data_dir()
+
+
 def test_get_statistics():
     with TestClient(app) as client:
         testsets = asyncio.get_event_loop().run_until_complete(insert_db_data())
@@ -0,0 +1,133 @@
+import os
+import shutil
+import unittest
+from typing import Union
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_onnx_client')
+os.environ['LAP_PATH_DATA'] = DATA_DIR
+
+import PIL.Image
+
+from common.exceptions import OperationError, ParameterValueError
+from app.image.schemas import ImageRead
+from app.model_inference.onnx_client import OnnxClient, detect, np, onnxruntime
+from app.model_inference.service import create_inference_client
+
+try:
+    import onnx
+    from onnx import helper, TensorProto
+except ImportError:
+    onnx = None
+
+IMGSZ = 32
+# cx, cy, w, h and scores of 2 classes of 3 anchors.
+# The second one overlaps the first one of the same class, and the third one is of another class
+ANCHORS = [[16, 16, 8, 8, 0.9, 0.1],
+           [17, 16, 8, 8, 0.8, 0.1],
+           [16, 16, 8, 8, 0.1, 0.6]]
+
+
+def save_fake_yolov8(path: str, batch: Union[int, str] = 'batch'):
+    """
+    Save a model of the interface of YOLOv8, which detects the anchors in any image
+    :param batch: fixed batch size of the model, or a name of its dynamic batch size
+    """
+    anchors = np.array(ANCHORS, dtype=np.float32).T[None]
+    nodes = [
+        helper.make_node('Flatten', ['images'], ['flat']),
+        helper.make_node('ReduceMean', ['flat'], ['mean'], axes=[1], keepdims=1),
+        helper.make_node('Unsqueeze', ['mean', 'axes'], ['mean3d']),
+        helper.make_node('Mul', ['mean3d', 'zero'], ['zeros']),
+        helper.make_node('Add', ['zeros', 'anchors'], ['output0']),
+    ]
+    graph = helper.make_graph(
+        nodes, 'fake_yolov8',
+        [helper.make_tensor_value_info('images', TensorProto.FLOAT, [batch, 3, IMGSZ, IMGSZ])],
+        [helper.make_tensor_value_info('output0', TensorProto.FLOAT, [batch, 6, 3])],
+        [helper.make_tensor('axes', TensorProto.INT64, [1], [2]),
+         helper.make_tensor('zero', TensorProto.FLOAT, [], [0.0]),
+         helper.make_tensor('anchors', TensorProto.FLOAT, anchors.shape, anchors.flatten())])
+    model = helper.make_model(graph, opset_imports=[helper.make_opsetid('', 13)])
+    model.ir_version = 8
+    helper.set_model_props(model, {'names': "{0: 'top', 1: 'bottom'}", 'imgsz': f'[{IMGSZ}, {IMGSZ}]'})
+    onnx.save(model, path)
+
+
+@unittest.skipIf(onnxruntime is None, 'numpy and onnxruntime are not installed')
+class TestOnnxClient(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        os.makedirs(DATA_DIR, exist_ok=True)
+
+    def tearDown(self) -> None:
+        shutil.rmtree(DATA_DIR)
+
+    def test_detect_suppresses_overlaps_of_each_class(self):
+        boxes, scores, classes = detect(np.array(ANCHORS, dtype=np.float32).T, confidence=0.25, iou=0.7)
+        self.assertEqual([0, 1], classes.tolist())
+        self.assertEqual([[12, 12, 20, 20], [12, 12, 20, 20]], boxes.tolist())
+        self.assertAlmostEqual(0.9, scores[0], places=5)
+
+    @unittest.skipIf(onnx is None, 'onnx is not installed to make a model')
+    async def test_infer(self):
+        model_path = os.path.join(DATA_DIR, 'fake_yolov8.onnx')
+        save_fake_yolov8(model_path)
+        images = []
+        for i in range(1, 6):
+            path = os.path.join(DATA_DIR, f'{i}.jpg')
+            PIL.Image.new('RGB', (64, 32), (i * 40, 0, 0)).save(path)
+            images.append((ImageRead(id=i, file_id=1, hash=f'{i:064x}', width=64, height=32, url='url'), path))
+
+        client = OnnxClient(config={'onnx': {'model_path': model_path}, 'batch_size': 2, 'batch_max_wait': 0.01})
+        r = await client.infer(images)
+        self.assertEqual([1, 1, 2, 2, 3, 3, 4, 4, 5, 5], [o[0] for o in r], 'predictions should be in order of images')
+        # the image is scaled by 0.5 and padded by 8 pixels at the top in the input of the model
+        image_id, bbox, label = r[0]
+        self.assertEqual((0.375, 0.25, 0.625, 0.75), (bbox.rx1, bbox.ry1, bbox.rx2, bbox.ry2))
+        self.assertEqual('top', label.region)
+        self.assertEqual('bottom', r[1][2].region)
+
+    @unittest.skipIf(onnx is None, 'onnx is not installed to make a model')
+    async def test_isolate_broken_image(self):
+        model_path = os.path.join(DATA_DIR, 'fake_yolov8.onnx')
+        save_fake_yolov8(model_path)
+        images = []
+        for i in range(1, 5):
+            path = os.path.join(DATA_DIR, f'{i}.jpg')
+            if i == 2:
+                with open(path, 'wb') as f:
+                    f.write(b'not an image')
+            else:
+                PIL.Image.new('RGB', (64, 32)).save(path)
+            images.append((ImageRead(id=i, file_id=1, hash=f'{i:064x}', width=64, height=32, url='url'), path))
+
+        client = OnnxClient(config={'onnx': {'model_path': model_path}, 'batch_size': 4, 'batch_max_wait': 0.01})
+        r = await client.infer(images)
+        self.assertEqual([1, 1, 3, 3, 4, 4], [o[0] for o in r], 'images batched with the broken one should be inferred')
+        self.assertEqual([2], list(client.failures))
+
+    @unittest.skipIf(onnx is None, 'onnx is not installed to make a model')
+    async def test_infer_by_fixed_batch_model(self):
+        # models are shared by the path, so the path differs from the one of the model of dynamic batch size
+        model_path = os.path.join(DATA_DIR, 'fake_yolov8_batch4.onnx')
+        save_fake_yolov8(model_path, batch=4)
+        images = []
+        for i in range(1, 6):
+            path = os.path.join(DATA_DIR, f'{i}.jpg')
+            if i == 2:
+                with open(path, 'wb') as f:
+                    f.write(b'not an image')
+            else:
+                PIL.Image.new('RGB', (64, 32)).save(path)
+            images.append((ImageRead(id=i, file_id=1, hash=f'{i:064x}', width=64, height=32, url='url'), path))
+
+        client = OnnxClient(config={'onnx': {'model_path': model_path}, 'batch_max_wait': 0.01})
+        r = await client.infer(images)
+        # the last image and images split from the batch of the broken one are run in padded batches
+        self.assertEqual([1, 1, 3, 3, 4, 4, 5, 5], [o[0] for o in r])
+        self.assertEqual([2], list(client.failures))
+
+    def test_create_inference_client(self):
+        with self.assertRaises(ParameterValueError):
+            create_inference_client({'backend': 'unknown'})
+        with self.assertRaises(OperationError):
+            create_inference_client({'backend': 'onnx', 'onnx': {'model_path': os.path.join(DATA_DIR, 'none.onnx')}})
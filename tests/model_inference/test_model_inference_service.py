@@ -0,0 +1,188 @@
+import os
+import shutil
+import unittest
+from unittest.mock import patch
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_service')
+os.environ['LAP_PATH_DATA'] = DATA_DIR
+
+from sqlalchemy import update, select, func
+
+from config import CONFIG
+from database.core import create_engine, create_tables, dispose_engine, get_session
+from common.grpcpool import close_channel_pools
+from app.file.schemas import FileCreate, FileUpdate
+from app.file.service import insert as insert_file, update as update_file, get_one as get_file
+from app.image.models import Image
+from app.image.schemas import ImageBase
+from app.image.service import insert as insert_images, get_all as get_images, mark_inferred
+from app.image.storage import IMAGE_STORAGE
+from app.model_inference.cache import PredictionCache
+from app.model_inference.models import CachedPrediction
+from app.model_inference.service import infer, resume, reinfer, reinfer_failed
+from app.bbox.service import get_all as get_bboxes
+from app.label.models import Label
+from app.model_inference.utils import TorchServeClient
+from app.model_serving import state
+from app.model_serving.state import served_model_path, set_served_model
+from benchmarks.fake_torchserve import start_fake_torchserve
+
+
+class TestInfer(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.dbpath = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_model_inference_service.db')
+        create_engine(f'sqlite+aiosqlite:///{self.dbpath}')
+        await create_tables(drop=True)
+        self.server, self.port, self.servicer = await start_fake_torchserve()
+        self.config = {'host': '127.0.0.1', 'grpc_inference_port': self.port, 'grpc_management_port': self.port,
+                       'project': 'fake', 'chunk_size': 5}
+        images = []
+        for i in range(1, 13):
+            image_hash = f'{i:064x}'
+            await IMAGE_STORAGE.write(image_hash, b'0' * i)
+            images.append(ImageBase(hash=image_hash, width=100, height=100, url='url'))
+        async for session in get_session():
+            self.file = await insert_file(session, FileCreate(name='file.csv', size=1))
+            self.file.cnt_url = 12
+            await update_file(session, FileUpdate(**self.file.dict()))
+            self.images, _ = await insert_images(session, images, self.file.id)
+
+    async def asyncTearDown(self) -> None:
+        state._served_model, state._loaded = None, False
+        # the data directory of the config may be another one than DATA_DIR when tests of many modules run
+        if os.path.exists(served_model_path()):
+            os.remove(served_model_path())
+        await close_channel_pools()
+        await self.server.stop(None)
+        await dispose_engine()
+        os.remove(self.dbpath)
+        if os.path.exists(DATA_DIR):
+            shutil.rmtree(DATA_DIR)
+
+    async def inferred_image_ids(self):
+        async for session in get_session():
+            images = await get_images(session, self.file.id)
+        return [o.id for o in images if o.inferred_at is not None]
+
+    async def test_infer_uninferred_images_only(self):
+        async for session in get_session():
+            await mark_inferred(session, [o.id for o in self.images[:3]])
+        with patch.dict(CONFIG, {'inference_server': self.config}):
+            await infer(self.file)
+        self.assertEqual(9, self.servicer.images)
+        self.assertEqual(12, len(await self.inferred_image_ids()))
+        self.assertEqual(9, self.file.cnt_bbox)
+
+    async def test_resume_after_failure(self):
+        original_infer = TorchServeClient.infer
+        calls = 0
+
+        async def fail_at_third_chunk(client, images):
+            nonlocal calls
+            calls += 1
+            if calls == 3:
+                raise ConnectionError()
+            return await original_infer(client, images)
+
+        with patch.dict(CONFIG, {'inference_server': self.config}):
+            with patch.object(TorchServeClient, 'infer', fail_at_third_chunk):
+                await infer(self.file)
+            self.assertEqual(-1, self.file.cnt_bbox)
+            self.assertEqual([o.id for o in self.images[:10]], await self.inferred_image_ids(),
+                             'predictions of chunks before the failure should be saved')
+
+            async for session in get_session():
+                self.file.cnt_bbox = None
+                await update_file(session, FileUpdate(**self.file.dict()))
+            await resume()
+        self.assertEqual(12, self.servicer.images, 'only the rest of images should be inferred')
+        async for session in get_session():
+            file = await get_file(session, self.file.id)
+        self.assertEqual(12, file.cnt_bbox)
+
+    async def test_reuse_cached_predictions(self):
+        cache = PredictionCache()
+        set_served_model('fake', '1')
+        with patch.dict(CONFIG, {'inference_server': self.config}), \
+                patch('app.model_inference.service.PREDICTION_CACHE', cache):
+            await infer(self.file)
+            self.assertEqual(0, self.file.cnt_cached_prediction)
+            async for session in get_session():
+                await session.execute(update(Image).values(inferred_at=None))
+                await session.commit()
+            await infer(self.file)
+        self.assertEqual(12, self.servicer.images, 'cached images should not be sent again')
+        self.assertEqual(12, self.file.cnt_cached_prediction)
+        self.assertEqual(12, self.file.cnt_bbox)
+
+        set_served_model('fake', '2')
+        await cache.invalidate('fake', '2')
+        async for session in get_session():
+            cnt = await session.scalar(select(func.count()).select_from(CachedPrediction))
+        self.assertEqual(0, cnt, 'predictions of the previous model should be dropped')
+
+    async def test_reinfer_with_new_model(self):
+        with patch.dict(CONFIG, {'inference_server': self.config}), \
+                patch('app.model_inference.service.PREDICTION_CACHE', PredictionCache(enabled=False)):
+            set_served_model('fake', '1')
+            await infer(self.file)
+            async for session in get_session():
+                bboxes = await get_bboxes(session, file_id=self.file.id)
+                await session.execute(update(Label).where(Label.bbox_id == bboxes[0].id).values(reviewed=True))
+                await session.commit()
+
+            set_served_model('fake', '2')
+            await reinfer(self.file)
+            self.assertEqual(24, self.servicer.images)
+            async for session in get_session():
+                bboxes = await get_bboxes(session, file_id=self.file.id)
+            self.assertEqual(12, len(bboxes), 'unreviewed bboxes should be replaced')
+            self.assertEqual(12, self.file.cnt_bbox)
+            reviewed = [o for o in bboxes if o.label.reviewed]
+            self.assertEqual(1, len(reviewed))
+            self.assertEqual('1', reviewed[0].model_version, 'reviewed bbox should be kept')
+            self.assertEqual(['2'] * 11, [o.model_version for o in bboxes if not o.label.reviewed])
+            self.assertEqual(['2'] * 11, [o.label.model_version for o in bboxes if not o.label.reviewed])
+
+            await reinfer(self.file)
+            self.assertEqual(24, self.servicer.images, 'images inferred by the served model should be skipped')
+
+    async def test_reinfer_failed_images(self):
+        # images are the bytes of their ids
+        self.servicer._broken = lambda data: len(data) in (4, 9)
+        with patch.dict(CONFIG, {'inference_server': self.config}):
+            await infer(self.file)
+            self.assertEqual(10, self.file.cnt_bbox, 'broken images should not stop the others')
+            self.assertEqual(2, self.file.cnt_inference_failure)
+            async for session in get_session():
+                images = await get_images(session, self.file.id)
+            self.assertEqual({4, 9}, {o.id for o in images if o.inference_error is not None})
+            self.assertEqual(10, len(await self.inferred_image_ids()))
+
+            self.servicer._broken = None
+            images_before = self.servicer.images
+            await reinfer_failed(self.file)
+        self.assertEqual(2, self.servicer.images - images_before, 'only failed images should be inferred again')
+        self.assertEqual(12, self.file.cnt_bbox)
+        self.assertEqual(0, self.file.cnt_inference_failure)
+        async for session in get_session():
+            images = await get_images(session, self.file.id)
+        self.assertEqual([], [o.id for o in images if o.inference_error is not None])
+
+    async def test_record_failures_when_circuit_opens(self):
+        def broken(data):
+            # the server goes down after answering that the first image is broken
+            self.servicer._outages = 100
+            return len(data) == 1
+
+        self.servicer._broken = broken
+        self.config.update({'max_in_flight': 1, 'retries': 0, 'circuit_breaker_threshold': 1})
+        with patch.dict(CONFIG, {'inference_server': self.config}):
+            await infer(self.file)
+        self.assertEqual('Inference server is unavailable', self.file.error)
+        # the second image failed by the outage which opened the circuit, and the rest failed fast together
+        self.assertEqual(2, self.file.cnt_inference_failure)
+        async for session in get_session():
+            images = await get_images(session, self.file.id)
+        self.assertEqual([1, 2], [o.id for o in images if o.inference_error is not None],
+                         'images which failed before the circuit opened should be recorded')
@@ -0,0 +1,197 @@
+import asyncio
+import unittest
+import os
+import shutil
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_utils')
+os.environ['LAP_PATH_DATA'] = DATA_DIR
+
+import PIL.Image
+
+from common.circuitbreaker import CircuitOpenError, reset_circuit_breakers
+from common.grpcpool import ChannelPool, close_channel_pools
+from app.image.schemas import ImageRead
+from app.image.storage import IMAGE_STORAGE, read_location, variant_key
+from app.model_inference import inference_pb2
+from app.model_inference.inference_pb2_grpc import InferenceAPIsServiceStub
+from app.model_inference.utils import TorchServeClient
+from app.model_serving import state
+from app.model_serving.state import served_model_path, set_served_model
+from benchmarks.fake_torchserve import start_fake_torchserve
+
+
+class TestTorchServeClient(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self) -> None:
+        self.server, self.port, self.servicer = await start_fake_torchserve(latency=0.01, jitter=0.01)
+        self.config = {'host': '127.0.0.1', 'grpc_inference_port': self.port, 'grpc_management_port': self.port,
+                       'project': 'fake', 'max_in_flight': 4}
+        os.makedirs(DATA_DIR, exist_ok=True)
+        self.images = []
+        for i in range(1, 21):
+            path = os.path.join(DATA_DIR, f'{i}.jpg')
+            with open(path, 'wb') as f:
+                f.write(b'0' * i)
+            self.images.append((ImageRead(id=i, file_id=1, hash=f'{i:064x}', width=100, height=100, url='url'),
+                                path))
+
+    async def asyncTearDown(self) -> None:
+        await close_channel_pools()
+        reset_circuit_breakers()
+        await self.server.stop(None)
+        shutil.rmtree(DATA_DIR)
+
+    async def restart_server(self, **kwargs):
+        await self.server.stop(None)
+        self.server, port, self.servicer = await start_fake_torchserve(**kwargs)
+        self.config.update({'grpc_inference_port': port, 'grpc_management_port': port})
+
+    async def test_infer_concurrently_in_order(self):
+        r = await TorchServeClient(config=self.config).infer(self.images)
+        self.assertEqual([o[0].id for o in self.images], [o[0] for o in r],
+                         'predictions should be in the order of images')
+        for image_id, bbox, label in r:
+            self.assertAlmostEqual(image_id / 100, bbox.rx2, msg='prediction should be paired with its image')
+            self.assertEqual('top', label.region)
+
+    async def test_infer_in_batches(self):
+        self.config.update({'batch_size': 8, 'batch_max_wait': 0.01})
+        r = await TorchServeClient(config=self.config).infer(self.images)
+        self.assertEqual([o[0].id for o in self.images], [o[0] for o in r],
+                         'predictions should be in the order of images')
+        for image_id, bbox, label in r:
+            self.assertAlmostEqual(image_id / 100, bbox.rx2, msg='prediction should be split back to its image')
+        self.assertEqual(len(self.images), self.servicer.images)
+        self.assertEqual(3, self.servicer.requests, '20 images should be sent in 3 requests')
+
+    async def test_infer_by_reference(self):
+        await self.server.stop(None)
+        self.server, port, self.servicer = await start_fake_torchserve(data_dir=DATA_DIR)
+        self.config.update({'grpc_inference_port': port, 'grpc_management_port': port, 'read_by_reference': True,
+                            'batch_size': 8, 'batch_max_wait': 0.01})
+        r = await TorchServeClient(config=self.config).infer(self.images)
+        for image_id, bbox, label in r:
+            self.assertAlmostEqual(image_id / 100, bbox.rx2, msg='handler should read the image by its reference')
+        self.assertEqual(len(self.images), self.servicer.references)
+
+    async def test_ask_capabilities_again_after_transient_error(self):
+        await self.restart_server(data_dir=DATA_DIR, outages=1)
+        self.config['read_by_reference'] = True
+        client = TorchServeClient(config=self.config)
+        await client.infer(self.images[:1])
+        self.assertEqual(0, self.servicer.references, 'bytes should be sent if capabilities are unknown')
+        await client.infer(self.images)
+        self.assertEqual(len(self.images), self.servicer.references,
+                         'capabilities should be asked again after the server is back')
+
+    async def test_send_bytes_if_handler_does_not_read_by_reference(self):
+        self.config['read_by_reference'] = True
+        r = await TorchServeClient(config=self.config).infer(self.images)
+        self.assertEqual([o[0].id for o in self.images], [o[0] for o in r])
+        self.assertEqual(0, self.servicer.references)
+        self.assertEqual(len(self.images), self.servicer.images)
+
+    async def test_downsize_images_to_input_size(self):
+        images = []
+        for i in range(1, 4):
+            path = os.path.join(DATA_DIR, f'large_{i}.jpg')
+            PIL.Image.new('RGB', (400, 200), (i * 50, 0, 0)).save(path)
+            images.append((ImageRead(id=i, file_id=1, hash=f'{i:064x}', width=400, height=200, url='url'), path))
+        self.config['input_size'] = 100
+        r = await TorchServeClient(config=self.config).infer(images)
+
+        self.assertEqual(3, len(r))
+        for (image, _), (image_id, bbox, _) in zip(images, r):
+            variant = read_location(IMAGE_STORAGE.locate(variant_key(image.hash, 100)))
+            # the fake predicts a box of (0, 0, bytes, bytes) in the image it received, which is 100 x 50
+            self.assertAlmostEqual(len(variant) / 100, bbox.rx2, msg='box should be mapped back to the original')
+            self.assertAlmostEqual(len(variant) / 50, bbox.ry2)
+
+    async def test_retry_transient_errors(self):
+        await self.restart_server(outages=3)
+        self.config['retry_backoff'] = 0.01
+        client = TorchServeClient(config=self.config)
+        r = await client.infer(self.images)
+        self.assertEqual([o[0].id for o in self.images], [o[0] for o in r])
+        self.assertEqual({}, client.failures)
+        self.assertEqual(3, self.servicer.errors)
+
+    async def test_isolate_broken_image(self):
+        # the 7th image has 7 bytes
+        await self.restart_server(broken=lambda data: len(data) == 7)
+        self.config.update({'batch_size': 8, 'batch_max_wait': 0.01})
+        client = TorchServeClient(config=self.config)
+        r = await client.infer(self.images)
+        self.assertEqual([o[0].id for o in self.images if o[0].id != 7], [o[0] for o in r],
+                         'images batched with the broken image should be inferred')
+        self.assertEqual([7], list(client.failures))
+        self.assertIn('Failed to decode an image', client.failures[7])
+
+    async def test_open_circuit_when_server_is_unavailable(self):
+        await self.restart_server(outages=1000)
+        self.config.update({'retries': 1, 'retry_backoff': 0.01, 'circuit_breaker_threshold': 3,
+                            'circuit_breaker_cooldown': 60})
+        client = TorchServeClient(config=self.config)
+        with self.assertRaises(CircuitOpenError):
+            await client.infer(self.images)
+        # requests sent before the circuit opened may still be on their way to the server
+        await asyncio.sleep(0.05)
+        requests = self.servicer.requests
+        self.assertLess(requests, len(self.images), 'requests should stop when the circuit opens')
+        with self.assertRaises(CircuitOpenError):
+            await client.infer(self.images)
+        self.assertEqual(requests, self.servicer.requests, 'requests should fail fast while the circuit is open')
+
+        # let a request try the server after the cooldown, which closes the circuit when it succeeds
+        self.servicer._outages = 0
+        self.config['circuit_breaker_cooldown'] = 0.01
+        await asyncio.sleep(0.02)
+        r = await TorchServeClient(config=self.config).infer(self.images)
+        self.assertEqual(len(self.images), len(r))
+
+    async def test_no_cache_unless_given(self):
+        set_served_model('fake', '1')
+        try:
+            client = TorchServeClient(config=self.config)
+            await client.infer(self.images)
+        finally:
+            os.remove(served_model_path())
+            state._served_model, state._loaded = None, False
+        self.assertEqual(0, client.cache_hits)
+        self.assertEqual(len(self.images), self.servicer.images)
+
+    async def test_reuse_channels(self):
+        client = TorchServeClient(config=self.config)
+        await client.infer(self.images)
+        await client.infer(self.images)
+        self.assertIs(client.channel_pool, TorchServeClient(config=self.config).channel_pool,
+                      'channels should be shared by clients')
+        self.assertEqual(2, self.servicer.pings, 'health should be checked once per sub-channel, not per call')
+
+    async def test_reconnect_unhealthy_channel(self):
+        async def health_check(channel):
+            return healthy
+
+        healthy = False
+        pool = ChannelPool(f'127.0.0.1:{self.port}', size=1, health_check=health_check, health_check_interval=0.01)
+        channel = pool.channel()
+        self.assertFalse(await pool.check())
+        healthy = True
+        await asyncio.sleep(0.1)
+        self.assertTrue(pool.healthy, 'health should be checked in the background')
+        self.assertIsNot(channel, pool.channel(), 'unhealthy channel should be reconnected')
+        await pool.close()
+
+    async def test_finish_calls_on_unhealthy_channel(self):
+        async def health_check(channel):
+            return False
+
+        await self.restart_server(latency=0.2)
+        pool = ChannelPool(f"127.0.0.1:{self.config['grpc_inference_port']}", size=1, health_check=health_check,
+                           health_check_interval=60)
+        request = inference_pb2.PredictionsRequest(model_name='fake', input={'data': b'0' * 10})
+        call = InferenceAPIsServiceStub(pool.channel()).Predictions(request)
+        await asyncio.sleep(0.05)
+        self.assertFalse(await pool.check())
+        response = await call
+        self.assertTrue(response.prediction, 'calls in flight should finish on an unhealthy channel')
+        await pool.close()
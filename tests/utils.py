@@ -71,6 +71,8 @@ async def insert_db_data(dbname=None):
                     session.add(db_bbox)
                     db_bboxes.append(db_bbox)
             await session.commit()
+            for db_bbox in db_bboxes:
+                await session.refresh(db_bbox, ['image_hash'])
             result.append({'file': FileRead.from_orm(db_file),
                            'images': [ImageRead.from_orm(o) for o in db_images],
                            'bboxes': [BBoxRead.from_orm(o) for o in db_bboxes]})
@@ -59,6 +59,18 @@ class Server extends API {
         return this.GET(`${this.apibase}/files`)
     }
 
+    get_files_progress() {
+        return this.GET(`${this.apibase}/files/progress`)
+    }
+
+    // onProgress is called with a list of progress of files whenever it changes. Call close() of the returned
+    // EventSource to stop receiving it
+    stream_files_progress(onProgress) {
+        const source = new EventSource(`${this.apibase}/files/progress/stream`);
+        source.addEventListener('progress', (e) => onProgress(JSON.parse(e.data)));
+        return source
+    }
+
     get_file(fileId) {
         return this.GET(`${this.apibase}/files/${fileId}`)
     }
@@ -67,6 +79,14 @@ class Server extends API {
         return this.DELETE(`${this.apibase}/files/${fileId}`)
     }
 
+    reinfer_file(fileId) {
+        return this.POST(`${this.apibase}/files/${fileId}/reinfer`)
+    }
+
+    reinfer_failed_images(fileId) {
+        return this.POST(`${this.apibase}/files/${fileId}/reinfer/failed`)
+    }
+
     get_images(fileId) {
         return this.GET(`${this.apibase}/images?file_id=${fileId}`)
     }